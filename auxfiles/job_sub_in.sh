@@ -33,11 +33,16 @@ shapefile=$(readlink -f $2)
 AGGREGATE=$3
 
 for file in $1/query/*.pkl; do
-    tile_id=$(echo $file | sed 's/.*\/\([_0-9]\+\).*/\1/g')
-    feature=$1/new/contain_$tile_id.txt
+    tile_id=$(echo $file | sed 's/.*\/\([_0-9]\+\(_c[0-9]\+\)\?\).pkl/\1/g')
+    # the feature lists of the footprints split by wit-query are next to their datasets
+    features=$1/new
+    if [ -s $1/query/contain_$tile_id.txt ] || [ -s $1/query/intersect_$tile_id.txt ]; then
+        features=$1/query
+    fi
+    feature=$features/contain_$tile_id.txt
     aggregate=0
     if [ ! -s $feature ]; then
-        feature=$1/new/intersect_$tile_id.txt
+        feature=$features/intersect_$tile_id.txt
         if [ ! -s $feature ]; then
             echo feature list for $tile_id not exist
             continue
@@ -15,6 +15,9 @@ from bokeh.transform import factor_cmap
 from bokeh.events import DoubleTap
 
 dio = DIO.get()
+# the same catchments are queried over and over by every session
+if dio.result_cache is None:
+    dio.enable_result_cache()
 
 def inundation_by_catchment(start_year, end_year):
     source = None
@@ -22,7 +25,7 @@ def inundation_by_catchment(start_year, end_year):
         catchment_name = dio.get_name_by_id('catchments', i+1)[0][0]
         if catchment_name == '':
             continue
-        rows = dio.get_polys_by_catchment_id(i+1, 5000)
+        rows = dio.get_polys_by_catchment_id(i+1, maxrows=5000)
         poly_list = list(np.array(rows)[:,0])
         print(len(poly_list))
         if source is None:
@@ -15,6 +15,9 @@ from bokeh.transform import factor_cmap, LinearColorMapper
 from bokeh.events import DoubleTap
 
 dio = DIO.get()
+# the same catchments are queried over and over by every session
+if dio.result_cache is None:
+    dio.enable_result_cache()
 
 def get_catchments():
     catchment_names = {}
@@ -30,7 +33,7 @@ def metric_by_catchment(catchment_name):
     for key, name in catchments.items():
         if name != catchment_name:
             continue
-        rows = dio.get_polys_by_catchment_id(key, 2000)
+        rows = dio.get_polys_by_catchment_id(key, maxrows=2000)
         poly_list = list(np.array(rows)[:,0])
         print(len(poly_list))
         if source is None:
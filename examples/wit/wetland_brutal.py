@@ -22,7 +22,9 @@ import logging
 from datetime import datetime
 
 import click
+import collections
 import copy
+import itertools
 import pickle
 import pandas as pd
 import re
@@ -30,9 +32,12 @@ from zipfile import ZipFile
 
 from mpi4py import MPI
 from mpi4py.futures import MPIPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from wit_tooling.polygon_drill import cal_area
 from wit_tooling.database.io import DIO
-from wit_tooling import poly_wkt, convert_shape_to_polygon, query_wit_data, plot_to_png, query_wit_metrics, load_timeslice, generate_raster
+from wit_tooling.spatial_index import PathRowIndex, overlap_graph, to_polygons
+from wit_tooling.query_planner import plan_queries
+from wit_tooling import FeatureStore, poly_wkb, convert_shape_to_polygon, convert_shapes_to_polygons, iter_wit_data, wit_frame, plot_to_png, query_wit_metrics, load_timeslice, generate_raster
 from dea_tools import waterbodies
 
 _LOG = logging.getLogger('wit_tool')
@@ -45,7 +50,7 @@ landsat_shp = '/g/data/u46/users/ea6141/aus_map/landsat_au.shp'
 waterbody_str = 'water_body_polygons'
 
 def db_insert_polygon(dio, poly_name, geometry, shapefile, feature_id):
-    geometry = poly_wkt(geometry)
+    geometry = poly_wkb(geometry)
     poly_id, state = dio.insert_polygon(poly_name=poly_name, geometry=geometry, shapefile=shapefile, feature_id=feature_id)
     return poly_id, state
 
@@ -92,6 +97,20 @@ def query_store_polygons(args):
     else:
         return (None, -1)
 
+def register_polygons(poly_list):
+    poly_list = list(poly_list)
+    geometries = convert_shapes_to_polygons([shape['geometry'] for shape, _, _ in poly_list])
+    features = [dict(poly_name=get_polyName(shape), geometry=geometry,
+                    shapefile=shapefile, feature_id=int(shape['id']))
+                    for (shape, crs, shapefile), geometry in zip(poly_list, geometries)]
+    dio = DIO.get()
+    results = dio.register_polygons(features)
+    for (shape, _, _), (poly_id, state) in zip(poly_list, results):
+        if not state:
+            yield (shape['geometry'], poly_id)
+        else:
+            yield (None, -1)
+
 def aggregate_data(fc_results, water_results):
     j = 1
     tmp = {}
@@ -273,26 +292,19 @@ def all_polygons(fc_product, grouped, poly_vessel, mask_array_dict, aggregate, t
     for poly_id in fid_list:
         filter_store_result((poly_id, time, True, result))
 
-def get_intersect_polygons(poly_id, geometry, shapefile):
-    dio = DIO.get()
-    intersect_with = dio.get_intersect_polygons(poly_id, poly_wkt(geometry), shapefile)
-    return ([geometry, poly_id], intersect_with)
-
 def split_polygons(results, shapefile):
     initial_key = 1
     poly_vessel = dict({0:[]})
     shape_vessel = dict({0:[]})
 
-    future_list = []
-    with MPIPoolExecutor(max_workers=8) as executor:
-        for re in results:
-            if re[0] is not None:
-                future = executor.submit(get_intersect_polygons, re[1], re[0], shapefile)
-                future_list.append(future)
+    # the polygons only conflict with the others of this job, their overlaps
+    # are found locally at once
+    results = [[geometry, poly_id] for geometry, poly_id in results if geometry is not None]
+    overlaps = overlap_graph(to_polygons([re[0] for re in results]), [re[1] for re in results])
 
-    for future in future_list:
-        re, intersect_with = future.result()
-        if intersect_with == ():
+    for re in results:
+        intersect_with = overlaps[re[1]]
+        if intersect_with == []:
             shape_vessel[0].append(re)
             poly_vessel[0].append(re[1])
         else:
@@ -300,7 +312,7 @@ def split_polygons(results, shapefile):
             while j < initial_key:
                 append_match = False
                 for sp in intersect_with:
-                    if sp[0] in poly_vessel[j]:
+                    if sp in poly_vessel[j]:
                         append_match = True
                         break
                 if append_match:
@@ -344,7 +356,7 @@ def intersect_with_landsat(shape):
     if shape.get('geometry') is None:
         return (shape['id'], contain, intersect)
     dio = DIO.get()
-    results = dio.get_intersect_landsat_pathrow(poly_wkt(shape['geometry']))
+    results = dio.get_intersect_landsat_pathrow(poly_wkb(shape['geometry']))
     for re in results:
         if re[1] < 0.9:
             intersect.append(str(re[0]))
@@ -372,8 +384,7 @@ def iter_shapes(t_file, shapefile, geo_hash=None):
         with open(geo_hash, 'r') as f:
             hash_list = f.read().splitlines()
     else:
-        shapes = shape_list(shapefile)
-        shape = next(shapes)
+        store = FeatureStore(shapefile)
 
     with open(t_file, 'r') as f:
         for line in f:
@@ -382,19 +393,9 @@ def iter_shapes(t_file, shapefile, geo_hash=None):
                 gh = hash_list[int(shape_id) - 1]
                 shape = convert_hash_to_shape(gh, int(shape_id))
             else:
-                while int(shape_id) != int(shape['id']):
-                    shape = next(shapes)
+                shape = store[shape_id]
             yield shape
 
-def union_shapes(shape_list):
-    query_poly = None
-    for shape in shape_list:
-        if query_poly is None:
-            query_poly = box(*shape.bounds)
-        else:
-            query_poly = query_poly.union(box(*shape.bounds))
-    return query_poly
-
 def iter_queries(fc_product, query_poly, start_date, end_date):
     query_date = date_sequence(start=pd.to_datetime(start_date),
                                 end=pd.to_datetime(end_date),
@@ -570,33 +571,24 @@ def wit_dump(shapefile, input_folder, input_name, feature):
 @click.option('--feature',  type=int, help='An individual polygon to plot', default=None)
 @click.option('--zip-file', '-z',  type=str, help='Zip the output files into the given file name', default=None)
 @click.option('--with-title', type=bool, help='Plot in png with title legend, and etc.', default=True)
+@click.option('--processes', type=int, help='Processes rendering the plots', default=1)
 
-def wit_plot(shapefile, geo_hash, output_location, output_name, feature, zip_file, with_title):
+def wit_plot(shapefile, geo_hash, output_location, output_name, feature, zip_file, with_title, processes):
     if not path.exists(output_location):
         os.makedirs(output_location)
 
     if geo_hash is not None and shapefile == "":
         shapefile = waterbody_str
-    for shape in shape_list(shapefile, geo_hash):
-        if feature is not None:
-            if int(shape['id']) != feature:
-                continue
-
-        _LOG.debug("shape id %s", shape['id'])
-        poly_name, count = query_wit_data(shape)
-        _LOG.debug("data size %s", count.size)
-        if count.size == 0:
-            continue
-        file_name = generate_file_name(shape, output_name)
-        poly_name = file_name
-        _LOG.debug("shape name %s", poly_name)
+    shapes = shape_list(shapefile, geo_hash)
+    if feature is not None:
+        shapes = (shape for shape in shapes if int(shape['id']) == feature)
 
+    def write_plot(file_name, count, b_image):
         tmp_csv_file = '/'.join([output_location, file_name+'.csv'])
         tmp_png_file = '/'.join([output_location, file_name+'.png'])
 
-        b_image = plot_to_png(count, poly_name, with_title)
         csv_buf = io.StringIO()
-        pd.DataFrame(data=count, columns=['TIME', 'BS', 'NPV', 'PV', 'WET', 'WATER']).to_csv(csv_buf, index=False)
+        wit_frame(count).to_csv(csv_buf, index=False)
         csv_buf.seek(0)
         if zip_file is None:
             with open(tmp_csv_file, 'w') as f:
@@ -607,9 +599,36 @@ def wit_plot(shapefile, geo_hash, output_location, output_name, feature, zip_fil
             with ZipFile('/'.join([output_location, zip_file+'.zip']), 'a') as o_zip:
                 o_zip.writestr(tmp_csv_file, csv_buf.read())
                 o_zip.writestr(tmp_png_file, b_image.read())
+
+    # each process renders with its own WitPlotRenderer, the plots are
+    # written in order while a few more are rendered
+    executor = ProcessPoolExecutor(processes) if processes > 1 else None
+    pending = collections.deque()
+    for shape, poly_name, count in iter_wit_data(shapes, typed=True):
+        _LOG.debug("shape id %s", shape['id'])
+        _LOG.debug("data size %s", count['datetime'].size)
+        if count['datetime'].size == 0:
+            continue
+        file_name = generate_file_name(shape, output_name)
+        poly_name = file_name
+        _LOG.debug("shape name %s", poly_name)
+
+        if executor is None:
+            write_plot(file_name, count, plot_to_png(count, poly_name, with_title))
+        else:
+            pending.append((file_name, count, executor.submit(plot_to_png, count, poly_name, with_title)))
+            while len(pending) > 2 * processes:
+                file_name, count, future = pending.popleft()
+                write_plot(file_name, count, future.result())
         if feature is not None:
             break
 
+    while pending:
+        file_name, count, future = pending.popleft()
+        write_plot(file_name, count, future.result())
+    if executor is not None:
+        executor.shutdown()
+
 @main.command(name='wit-query', help='Query datasets by path/row')
 @shapefile_path
 @click.option('--geo-hash', '-g', type=str, help='File of a list of Geohash of water body polygons', default=None)
@@ -617,9 +636,10 @@ def wit_plot(shapefile, geo_hash, output_location, output_name, feature, zip_fil
 @click.option('--start-date',  type=str, help='Start date, default=1987-01-01', default='1987-01-01')
 @click.option('--end-date',  type=str, help='End date, default=2021-01-01', default='2021-01-01')
 @click.option('--output-location',  type=str, help='Location to save the query results', default='./query_results')
+@click.option('--max-size',  type=float, help='Largest width and height of a query footprint in the units of the crs', default=50000)
 @product_definition
 
-def wit_query(shapefile, geo_hash, input_folder, start_date, end_date, output_location, product_yaml):
+def wit_query(shapefile, geo_hash, input_folder, start_date, end_date, output_location, max_size, product_yaml):
     tile_files = []
 
     if not path.exists(output_location):
@@ -642,54 +662,48 @@ def wit_query(shapefile, geo_hash, input_folder, start_date, end_date, output_lo
     for t_file in tile_files:
         tile_id = re.findall(r"\d+", t_file)
         _LOG.debug("query %s", '_'.join(tile_id))
-        if path.exists(output_location+'/'+'_'.join(tile_id)+'.pkl'):
+        # a tile split into footprints is done once its marker is written
+        #  after the last of them, a rerun picks up the missing ones
+        done_marker = output_location + '/' + '_'.join(tile_id) + '.done'
+        if path.exists(output_location+'/'+'_'.join(tile_id)+'.pkl') or path.exists(done_marker):
             continue
-        future_list = []
-        query_poly = []
-        poly_list = iter_shapes('/'.join([input_folder, t_file]), shapefile, geo_hash)
-        with MPIPoolExecutor() as executor:
-            while True:
-                if len(query_poly) == 1:
-                    break
-                if future_list != []:
-                    poly_list = future_list
-                    future_list = []
-                    query_poly = []
-                for poly in poly_list:
-                    if isinstance(poly, dict):
-                        query_poly.append(convert_shape_to_polygon(poly['geometry']))
-                    else:
-                        query_poly.append(poly.result())
-                    if len(query_poly) == 10:
-                        future = executor.submit(union_shapes, query_poly)
-                        future_list.append(future)
-                        query_poly = []
-                if (len(future_list) > 0 and len(query_poly) == 1) or len(query_poly) > 1:
-                    future = executor.submit(union_shapes, query_poly)
-                    future_list.append(future)
-                    query_poly = []
-                _LOG.debug("len future list %s", len(future_list))
-
-        query_poly = query_poly[0]
-        query_poly = Geometry(mapping(box(*query_poly.bounds)), CRS(crs))
-        query_list = iter_queries(fc_product, query_poly, start_date, end_date)
-        with MPIPoolExecutor(max_workers=8) as executor:
-            results = executor.map(query_process, query_list)
-
-        data_box = None
-        for grouped in results:
-            if data_box is None:
-                data_box = grouped.box
-            else:
-                data_box = xr.concat([data_box, grouped.box], dim='time')
+        shapes = list(iter_shapes('/'.join([input_folder, t_file]), shapefile, geo_hash))
+        plan = plan_queries(to_polygons(shape.get('geometry') for shape in shapes), max_size=max_size)
+        _LOG.debug("%s polygons in %s footprints", len(shapes), len(plan))
+
+        # every footprint gets its own datasets, with the list of its features
+        # next to them if the polygons were split
+        for k, (members, footprint) in enumerate(plan):
+            name = '_'.join(tile_id) if len(plan) == 1 else '_'.join(tile_id) + '_c%s' % (k,)
+            if path.exists(output_location + '/' + name + '.pkl'):
+                continue
+            query_poly = Geometry(mapping(footprint), CRS(crs))
+            query_list = iter_queries(fc_product, query_poly, start_date, end_date)
+            with MPIPoolExecutor(max_workers=8) as executor:
+                results = executor.map(query_process, query_list)
+
+            data_box = None
+            for grouped in results:
+                if data_box is None:
+                    data_box = grouped.box
+                else:
+                    data_box = xr.concat([data_box, grouped.box], dim='time')
 
-        datasets = VirtualDatasetBox(data_box.sortby('time'), grouped.geobox,
-                grouped.load_natively, grouped.product_definitions, grouped.geopolygon)
+            datasets = VirtualDatasetBox(data_box.sortby('time'), grouped.geobox,
+                    grouped.load_natively, grouped.product_definitions, grouped.geopolygon)
 
-        _LOG.debug("query done %s", datasets)
-        if datasets.box.data.size > 0:
-            with open(output_location + '/' + '_'.join(tile_id) + '.pkl', 'wb') as f:
-                pickle.dump(datasets,f)
+            _LOG.debug("query done %s", datasets)
+            if datasets.box.data.size > 0:
+                if len(plan) > 1:
+                    with open(output_location + '/' + t_file.split('_')[0] + '_' + name + '.txt', 'w') as f:
+                        f.write(''.join(shapes[i]['id'] + '\n' for i in members))
+                # written aside first so that a run dying midway leaves no
+                #  truncated pickle to be skipped
+                with open(output_location + '/' + name + '.pkl.tmp', 'wb') as f:
+                    pickle.dump(datasets,f)
+                os.replace(output_location + '/' + name + '.pkl.tmp', output_location + '/' + name + '.pkl')
+        if len(plan) > 1:
+            open(done_marker, 'w').close()
     return
 
 @main.command(name='wit-pathrow', help='Sort polygons into path/row')
@@ -704,27 +718,27 @@ def match_pathrow(shapefile,  geo_hash, output_location):
         with open(geo_hash, 'r') as f:
             hash_list = f.read().splitlines()
 
-    future_list = []
     total_poly = 0
+    index = PathRowIndex.from_database()
 
-    with MPIPoolExecutor(max_worker=8) as executor:
-        for shape in shape_list(shapefile, geo_hash):
-            future = executor.submit(intersect_with_landsat, shape)
-            future_list.append(future)
-
-        _LOG.info("submit all %s", shape['id'])
-        for future in future_list:
-            pl_name, contain, intersect = future.result()
+    shapes = shape_list(shapefile, geo_hash)
+    while True:
+        batch = list(itertools.islice(shapes, 10000))
+        if len(batch) == 0:
+            break
+        polygons = to_polygons(shape.get('geometry') for shape in batch)
+        for shape, (contain, intersect) in zip(batch, index.classify(polygons)):
+            pl_name = shape['id']
             total_poly += 1
-            _LOG.info("return query %s", total_poly)
             if contain != []:
-                key = contain[0]
+                key = str(contain[0])
                 with open(output_location + '/contain_' + key + '.txt', 'a') as f:
                     f.write(pl_name+'\n')
             elif intersect != []:
-                key = '_'.join(intersect)
+                key = '_'.join(str(label) for label in intersect)
                 with open(output_location + '/intersect_' + key + '.txt', 'a') as f:
                         f.write(pl_name+'\n')
+        _LOG.info("sorted %s polygons", total_poly)
 
     _LOG.info("total poly %s", total_poly)
     return
@@ -764,8 +778,7 @@ def wit_cal(shapefile, geo_hash, time_chunk, feature_list, datasets, aggregate,
     poly_list =  get_polygon_list(feature_list, shapefile, geo_hash)
 
     time_start_insert = datetime.now()
-    with MPIPoolExecutor(max_workers=8) as executor:
-        result = executor.map(query_store_polygons, poly_list)
+    result = register_polygons(poly_list)
 
     shape_vessel, poly_vessel = split_polygons(result, shapefile)
 
@@ -4,7 +4,7 @@ import numpy as np
 from mpi4py import MPI
 from mpi4py.futures import MPIPoolExecutor 
 from wetland_brutal import intersect_with_landsat, shape_list
-from wit_tooling import hash_from_shape, poly_wkt
+from wit_tooling import hash_from_shape, poly_wkb
 from wit_tooling.database.io import DIO
 from shapely.geometry import Polygon, MultiPolygon
 import json
@@ -15,7 +15,7 @@ def db_insert_catchment(dio, shape):
     shapefile = shape['properties']['path']
     feature_id = shape['id']
     catchment_id = dio.insert_catchment(catchment_name=catchment_name,
-            shapefile=shapefile, feature_id=feature_id, geometry=poly_wkt(geometry))
+            shapefile=shapefile, feature_id=feature_id, geometry=poly_wkb(geometry))
     return catchment_id 
 
 def insert_catchment(catchment_shape):
@@ -38,14 +38,14 @@ def update_polygon_geom(shapefile):
     for shape in shape_list(shapefile):
         if str(shape['id']) in feature_list:
             poly_id = poly_list[feature_list.index(str(shape['id']))]
-            poly_id = dio.update_polygon_geom(poly_id, poly_wkt(shape['geometry']))
+            poly_id = dio.update_polygon_geom(poly_id, poly_wkb(shape['geometry']))
             print("update poly", poly_id)
 
 def update_polygon_properties(shapefile):
     dio = DIO.get()
     for shape in shape_list(shapefile):
         geometry = shape['geometry']
-        poly_id, _ = dio.get_id_by_geom("polygons", geometry=poly_wkt(geometry))
+        poly_id, _ = dio.get_id_by_geom("polygons", geometry=poly_wkb(geometry))
         print("query", poly_id)
         properties = json.dumps(shape['properties'])
         poly_id = dio.update_polygon_properties(poly_id, properties)
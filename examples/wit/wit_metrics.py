@@ -1,10 +1,10 @@
+import collections
 import numpy as np
 import pandas as pd
-import fiona
 import io
 from shapely import geometry
 import click
-from wit_tooling import query_wit_data
+from wit_tooling import iter_wit_data, wit_frame, FeatureStore
 
 def shape_list(key, values, shapefile):
     """
@@ -14,20 +14,14 @@ def shape_list(key, values, shapefile):
             shapefile: the name of your shape file
             e.g. key='ORIGID', values=[1, 2, 3, 4, 5], 
             shapefile='/g/data/r78/DEA_Wetlands/shapefiles/MDB_ANAE_Aug2017_modified_2019_SB_3577.shp'
+        the shapes are looked up in the FeatureStore of the shapefile, in the order of the sorted values
     """
-    count = len(values)
-    with fiona.open(shapefile) as allshapes:
-        for shape in allshapes:
-            shape_id = shape['properties'].get(key)
-            if shape_id is None:
-                continue
-            if isinstance(shape_id, float):
-                shape_id = int(shape_id)
-            if shape_id in values:
-                yield(shape_id, shape)
-                count -= 1
-            if count <= 0:
-                break
+    store = FeatureStore(shapefile)
+    for _, shape in store.find_many(key, np.unique(np.ravel(values))):
+        shape_id = shape['properties'][key]
+        if isinstance(shape_id, float):
+            shape_id = int(shape_id)
+        yield(shape_id, shape)
     
 def get_areas(features, pkey='SYSID'):
     """
@@ -60,10 +54,17 @@ def dump_wit_data(key, feature_list, output, batch=-1):
     else:
         sub_fname = output
 
-    for f_id, f in feature_list:
-        _, wit_data = query_wit_data(f)
+    # iter_wit_data reads the features ahead in batches, keep their ids in order
+    f_ids = collections.deque()
+    def features():
+        for f_id, f in feature_list:
+            f_ids.append(f_id)
+            yield f
+
+    for _, _, wit_data in iter_wit_data(features(), typed=True):
+        f_id = f_ids.popleft()
         csv_buf = io.StringIO()
-        wit_df = pd.DataFrame(data=wit_data, columns=['TIME', 'BS', 'NPV', 'PV', 'WET', 'WATER'])
+        wit_df = wit_frame(wit_data)
         wit_df.insert(0, key, f_id)
         wit_df.to_csv(csv_buf, index=False, header=False)
         csv_buf.seek(0)
@@ -45,12 +45,14 @@ setup(
     author='Emma Ai',
     author_email='emma.ai@ga.gov.au',
     packages=find_packages(exclude=['test']),
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     setup_requires=["Cython>=0.23"],
     # install_requires=["numpy>=1.16", "Cython>=0.23", "mpi4py>=3.0.3"],
     install_requires=["numpy>=1.16", "Cython>=0.23"],
     extras_require={
                     'dev': ['check-manifest'],
+                    'async': ['asyncpg>=0.21'],
+                    'features': ['pyarrow>=1.0'],
     },
     cmdclass = {'build_ext': build_ext},
     ext_modules = extensions
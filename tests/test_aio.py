@@ -0,0 +1,118 @@
+"""Compare the readers of AsyncDIO with those of DIO on the database given by
+WIT_DB_HOSTNAME, DB_USERNAME and DB_DATABASE, skipped without one
+"""
+import asyncio
+import datetime
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('asyncpg')
+psycopg2 = pytest.importorskip('psycopg2')
+
+from wit_tooling.database.aio import AsyncDIO
+from wit_tooling.database.io import DIO
+
+
+@pytest.fixture(scope='module')
+def dio():
+    if os.getenv('WIT_DB_HOSTNAME') is None:
+        pytest.skip('WIT_DB_HOSTNAME not set, no local Postgres')
+    try:
+        return DIO.get()
+    except psycopg2.OperationalError as e:
+        pytest.skip('no local Postgres: %s' % e)
+
+
+@pytest.fixture(scope='module')
+def poly_ids(dio):
+    rows = dio.query_with_return("SELECT DISTINCT poly_id FROM data ORDER BY poly_id LIMIT 10")
+    if not rows:
+        pytest.skip('no data to compare')
+    return [row[0] for row in rows]
+
+
+@pytest.fixture(scope='module')
+def geometries(dio, poly_ids):
+    if not dio.query_with_return("SELECT 1 FROM pg_extension WHERE extname = 'postgis'"):
+        pytest.skip('postgis not installed')
+    rows = dio.query_with_return("SELECT ST_AsEWKB(geometry) FROM polygons WHERE poly_id IN (%s) ORDER BY poly_id"
+            % (','.join(str(poly_id) for poly_id in poly_ids)))
+    return [bytes(row[0]) for row in rows]
+
+
+def run(read):
+    async def main():
+        async with AsyncDIO() as adio:
+            return await read(adio)
+    return asyncio.run(main())
+
+
+def collect(generator):
+    async def main():
+        return [item async for item in generator]
+    return main()
+
+
+def assert_same(expected, actual):
+    """ Compare results, floats as float4 as the REAL columns are decoded
+    differently by psycopg2 and asyncpg
+    """
+    if isinstance(expected, dict):
+        assert list(expected) == list(actual)
+        for name in expected:
+            assert_same(expected[name], actual[name])
+    elif isinstance(expected, np.ndarray):
+        if expected.dtype.kind == 'f':
+            np.testing.assert_allclose(actual, expected, rtol=1e-6)
+        else:
+            np.testing.assert_array_equal(actual, expected)
+    elif isinstance(expected, (list, tuple)):
+        assert len(expected) == len(actual)
+        for e, a in zip(expected, actual):
+            assert_same(e, a)
+    elif isinstance(expected, float):
+        assert actual == pytest.approx(expected, rel=1e-6)
+    else:
+        assert actual == expected
+
+
+def test_metric_readers(dio, poly_ids):
+    assert_same(dio.get_alltime_metrics(poly_ids), run(lambda a: a.get_alltime_metrics(poly_ids)))
+    assert_same(dio.get_wet_year_metrics(poly_ids), run(lambda a: a.get_wet_year_metrics(poly_ids)))
+    assert_same(dio.get_pv_year_metrics(poly_ids), run(lambda a: a.get_pv_year_metrics(poly_ids)))
+    assert_same(dio.get_event_metrics(poly_ids), run(lambda a: a.get_event_metrics(poly_ids)))
+    assert_same(dio.get_inundation(poly_ids, 1980, 2050, 0), run(lambda a: a.get_inundation(poly_ids, 1980, 2050, 0)))
+
+
+def test_data_readers(dio, poly_ids):
+    assert_same(dio.get_data_by_poly_id(poly_ids[0]), run(lambda a: a.get_data_by_poly_id(poly_ids[0])))
+    assert_same(dio.get_data_by_poly_id(poly_ids[0], typed=True),
+            run(lambda a: a.get_data_by_poly_id(poly_ids[0], typed=True)))
+    assert_same(dio.get_area_by_poly_ids(poly_ids), run(lambda a: a.get_area_by_poly_ids(poly_ids)))
+
+
+def test_iter_data(dio, poly_ids):
+    ids = poly_ids[::-1] + [0]
+    expected = list(dio.iter_data(ids, batch_size=7))
+    assert [poly_id for poly_id, _ in expected] == poly_ids[::-1]
+    assert_same(expected, run(lambda a: collect(a.iter_data(ids, batch_size=7))))
+    assert_same(list(dio.iter_data(ids, typed=True)), run(lambda a: collect(a.iter_data(ids, typed=True))))
+
+
+def test_times(dio, poly_ids):
+    latest = run(lambda a: a.get_latest_time(poly_ids))
+    assert latest == dio.get_latest_time(poly_ids)
+    assert latest is None or isinstance(latest, datetime.datetime)
+    assert run(lambda a: a.get_min_time(poly_ids)) == dio.get_min_time(poly_ids)
+
+
+def test_geometry_readers(dio, poly_ids, geometries):
+    assert_same(dio.get_ids_by_geoms(geometries), run(lambda a: a.get_ids_by_geoms(geometries)))
+    assert_same(dio.get_id_by_geom('polygons', geometries[0]),
+            run(lambda a: a.get_id_by_geom('polygons', geometries[0])))
+    assert_same(dio.get_data_by_geom(geometries[0]), run(lambda a: a.get_data_by_geom(geometries[0])))
+    assert_same(dio.get_alltime_metrics_by_geom(geometries[0]),
+            run(lambda a: a.get_alltime_metrics_by_geom(geometries[0])))
+    assert_same(dio.get_year_metrics_by_geom(geometries[0]), run(lambda a: a.get_year_metrics_by_geom(geometries[0])))
@@ -0,0 +1,112 @@
+"""Test the keys and versions of the result cache of the metric readers"""
+import contextlib
+
+import numpy as np
+import pytest
+
+from wit_tooling.database.cache import DiskStore, MemoryStore, ResultCache, cached_result, normalize_arg
+
+
+def test_normalize_arg_keeps_order():
+    assert normalize_arg([2010, 2000]) == (2010, 2000)
+    assert normalize_arg((1, [3, 2])) == (1, (3, 2))
+    assert normalize_arg(['wet_max', 'wet_min']) != normalize_arg(['wet_min', 'wet_max'])
+
+
+def test_normalize_arg_unordered_keeps_repeats():
+    assert normalize_arg([3, 1, 3], unordered=True) == (1, 3, 3)
+    assert normalize_arg([3, 1, 3], unordered=True) != normalize_arg([1, 3], unordered=True)
+    assert normalize_arg({3, 1}) == (1, 3)
+
+
+def test_normalize_arg_numpy():
+    assert normalize_arg(np.int64(3)) == 3
+    assert type(normalize_arg(np.int64(3))) is int
+    assert normalize_arg(np.array([3, 1]), unordered=True) == (1, 3)
+    assert normalize_arg(np.array([3, 1])) == normalize_arg([3, 1])
+
+
+class Reader(object):
+    """ The parts of DIO used by cached_result """
+
+    def __init__(self, store):
+        self.generation = 1
+        self.result_cache = ResultCache(lambda: self.generation, store)
+        self.calls = []
+        self.pinned = 0
+
+    @contextlib.contextmanager
+    def _pin_read_connection(self):
+        self.pinned += 1
+        yield 'conn'
+
+    def get_metrics_generation(self, conn):
+        assert conn == 'conn'
+        return self.generation
+
+    @cached_result
+    def get_inundation(self, poly_list, start_year, end_year, min_area=1, max_rows=5000):
+        self.calls.append((poly_list, start_year, end_year, min_area, max_rows))
+        return (sorted(poly_list), start_year, end_year, min_area)
+
+
+@pytest.fixture(params=['memory', 'disk'])
+def reader(request, tmp_path):
+    store = MemoryStore() if request.param == 'memory' else DiskStore(str(tmp_path))
+    return Reader(store)
+
+
+def test_argument_order_matters(reader):
+    assert reader.get_inundation([1, 2], 2000, 2010) == ([1, 2], 2000, 2010, 1)
+    assert reader.get_inundation([1, 2], 2010, 2000) == ([1, 2], 2010, 2000, 1)
+    assert len(reader.calls) == 2
+
+
+def test_same_call_hits(reader):
+    reader.get_inundation([3, 1], 2000, 2010)
+    reader.get_inundation([1, 3], 2000, 2010)
+    reader.get_inundation(np.array([3, 1]), np.int64(2000), end_year=2010)
+    reader.get_inundation(poly_list=(1, 3), start_year=2000, end_year=2010, min_area=1)
+    assert len(reader.calls) == 1
+    assert reader.pinned == 1
+
+
+def test_defaults_and_repeats(reader):
+    reader.get_inundation([1, 3], 2000, 2010)
+    reader.get_inundation([1, 3], 2000, 2010, 2)
+    reader.get_inundation([1, 3, 3], 2000, 2010)
+    assert len(reader.calls) == 3
+
+
+def test_generation_change_recomputes(reader):
+    reader.get_inundation([1], 2000, 2010)
+    reader.generation = 2
+    reader.get_inundation([1], 2000, 2010)
+    reader.get_inundation([1], 2000, 2010)
+    assert len(reader.calls) == 2
+
+
+def test_stored_under_version_of_compute():
+    # the version read with the result is stored, not the one of the lookup
+    versions = iter([1, 1, 2])
+    cache = ResultCache(lambda: next(versions), MemoryStore())
+    assert cache.get_or_compute('f', (), lambda: (2, 'new')) == 'new'
+    assert cache.get_or_compute('f', (), lambda: (1, 'old')) == 'old'
+    assert cache.get_or_compute('f', (), lambda: (2, 'recomputed')) == 'recomputed'
+
+
+def test_without_cache_calls_through():
+    reader = Reader(MemoryStore())
+    reader.result_cache = None
+    reader.get_inundation([1], 2000, 2010)
+    reader.get_inundation([1], 2000, 2010)
+    assert len(reader.calls) == 2 and reader.pinned == 0
+
+
+def test_memory_store_evicts_least_recent():
+    store = MemoryStore(max_entries=2)
+    store.set('a', 1)
+    store.set('b', 2)
+    store.get('a')
+    store.set('c', 3)
+    assert store.get('a') == 1 and store.get('b') is None and store.get('c') == 3
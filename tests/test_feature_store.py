@@ -0,0 +1,72 @@
+"""Test the GeoParquet cache of shapefile features, skipped without fiona or
+pyarrow
+"""
+import os
+
+import numpy as np
+import pytest
+import shapely
+
+from wit_tooling.feature_store import FeatureStore, _index_value
+
+SCHEMA = {'geometry': 'Polygon', 'properties': {'SYSID': 'int', 'AREA': 'float', 'NAME': 'str'}}
+
+
+def write_shapefile(path, records):
+    fiona = pytest.importorskip('fiona')
+    with fiona.open(str(path), 'w', driver='ESRI Shapefile', schema=SCHEMA, crs='EPSG:3577') as shapes:
+        for sysid, area, name, box in records:
+            shapes.write(dict(geometry=shapely.geometry.mapping(shapely.box(*box)),
+                properties=dict(SYSID=sysid, AREA=area, NAME=name)))
+
+
+@pytest.fixture
+def shapefile(tmp_path):
+    pytest.importorskip('pyarrow')
+    path = tmp_path / 'wetlands.shp'
+    write_shapefile(path, [(3051, 12.0, 'a', (0, 0, 10, 10)), (3052, 3.5, 'b', (20, 0, 30, 10)),
+        (3051, 7.0, 'c', (40, 0, 50, 10))])
+    return path
+
+
+def test_index_value():
+    assert _index_value(3051.0) == 3051 and type(_index_value(3051.0)) is int
+    assert _index_value(np.float64(3051.0)) == 3051 and type(_index_value(np.float64(3051.0))) is int
+    assert _index_value(np.int32(3051)) == 3051
+    assert _index_value(3051.5) == 3051.5
+    assert _index_value('3051') == '3051'
+
+
+def test_features(shapefile, tmp_path):
+    store = FeatureStore(str(shapefile), cache_dir=str(tmp_path / 'cache'))
+    assert len(store) == 3 and list(store.ids()) == [0, 1, 2]
+    assert store['1']['properties']['NAME'] == 'b'
+    assert store[1]['geometry'].equals(shapely.box(20, 0, 30, 10))
+    assert [f and f['id'] for f in store.get_many([2, 7, '0'])] == ['2', None, '0']
+    assert [f['id'] for f in store.iter_features(batch_size=2)] == ['0', '1', '2']
+
+
+def test_find_matches_int_and_float(shapefile, tmp_path):
+    store = FeatureStore(str(shapefile), cache_dir=str(tmp_path / 'cache'))
+    for value in (3051, 3051.0, np.int64(3051), np.float32(3051)):
+        assert [f['id'] for f in store.find('SYSID', value)] == ['0', '2']
+    assert [f['id'] for f in store.find('AREA', 12)] == ['0']
+    assert [f['id'] for f in store.find('AREA', 3.5)] == ['1']
+    assert store.find('SYSID', 3051.5) == []
+    assert [(v, f['id']) for v, f in store.find_many('SYSID', [3052.0, 3051])] == [(3052.0, '1'), (3051, '0'), (3051, '2')]
+
+
+def test_rebuilt_when_shapefile_changes(shapefile, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    store = FeatureStore(str(shapefile), cache_dir=cache_dir)
+    assert FeatureStore(str(shapefile), cache_dir=cache_dir).path == store.path
+    built = os.stat(store.path).st_mtime_ns
+
+    write_shapefile(shapefile, [(4000, 1.0, 'd', (0, 0, 5, 5))])
+    stat = os.stat(str(shapefile))
+    os.utime(str(shapefile), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    changed = FeatureStore(str(shapefile), cache_dir=cache_dir)
+    assert changed.path != store.path
+    assert len(changed) == 1 and changed[0]['properties']['SYSID'] == 4000
+    assert changed.find('SYSID', 3051) == []
+    assert os.stat(store.path).st_mtime_ns == built
@@ -0,0 +1,69 @@
+"""Test the client side geometry hash and the geometry sql parameters"""
+import pytest
+import shapely
+
+pytest.importorskip('psycopg2')
+
+from wit_tooling.database.geometry import geometry_ewkb, geometry_hash, geometry_param, load_geometry
+
+SQUARE = shapely.Polygon([(0, 0), (10, 0), (10, 10), (0, 10)])
+
+
+def test_hash_ignores_orientation_and_start():
+    reversed_square = shapely.Polygon([(0, 0), (0, 10), (10, 10), (10, 0)])
+    rotated_square = shapely.Polygon([(10, 10), (0, 10), (0, 0), (10, 0)])
+    assert geometry_hash(reversed_square) == geometry_hash(SQUARE)
+    assert geometry_hash(rotated_square) == geometry_hash(SQUARE)
+
+
+def test_hash_ignores_part_order():
+    far = shapely.Polygon([(20, 0), (30, 0), (30, 10), (20, 10)])
+    assert geometry_hash(shapely.MultiPolygon([SQUARE, far])) == geometry_hash(shapely.MultiPolygon([far, SQUARE]))
+
+
+def test_hash_rounding():
+    nudged = shapely.Polygon([(1e-9, 0), (10, 0), (10, 10.0000000004), (-1e-9, 10)])
+    moved = shapely.Polygon([(1e-5, 0), (10, 0), (10, 10), (0, 10)])
+    assert geometry_hash(nudged) == geometry_hash(SQUARE)
+    assert geometry_hash(moved) != geometry_hash(SQUARE)
+    assert geometry_hash(moved, decimals=4) == geometry_hash(SQUARE, decimals=4)
+
+
+def test_hash_same_for_all_inputs():
+    expected = geometry_hash(SQUARE)
+    assert len(expected) == 32
+    assert geometry_hash(SQUARE.wkt) == expected
+    assert geometry_hash('SRID=3577;' + SQUARE.wkt) == expected
+    assert geometry_hash(SQUARE.wkb) == expected
+    assert geometry_hash(memoryview(shapely.to_wkb(shapely.set_srid(SQUARE, 3577), include_srid=True))) == expected
+
+
+def test_load_geometry():
+    assert load_geometry('srid=4326;' + SQUARE.wkt).equals(SQUARE)
+    assert load_geometry(bytearray(SQUARE.wkb)).equals(SQUARE)
+    assert load_geometry(SQUARE) is SQUARE
+
+
+def srid_of(param):
+    return shapely.get_srid(shapely.from_wkb(bytes(param.adapted)))
+
+
+def test_param_passes_ewkt_through():
+    assert geometry_param('SRID=4326;' + SQUARE.wkt) == 'SRID=4326;' + SQUARE.wkt
+
+
+def test_param_shapely_gets_srid():
+    assert srid_of(geometry_param(SQUARE)) == 3577
+    assert srid_of(geometry_param(SQUARE, srid=4326)) == 4326
+    assert shapely.from_wkb(bytes(geometry_param(SQUARE).adapted)).equals(SQUARE)
+
+
+def test_param_keeps_ewkb_srid():
+    ewkb = geometry_ewkb(SQUARE, 4326)
+    assert bytes(geometry_param(ewkb).adapted) == ewkb
+    assert srid_of(geometry_param(memoryview(ewkb), srid=3577)) == 4326
+
+
+def test_param_wkb_gets_srid():
+    assert srid_of(geometry_param(SQUARE.wkb)) == 3577
+    assert srid_of(geometry_param(bytearray(SQUARE.wkb), srid=4326)) == 4326
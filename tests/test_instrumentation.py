@@ -0,0 +1,62 @@
+"""Test the histograms of the connection instrumentation and their Prometheus
+text output
+"""
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from wit_tooling.database.instrumentation import METRICS, ROWS_BUCKETS, Histogram, Instrumentation
+
+
+def test_histogram_buckets():
+    histogram = Histogram((1, 10))
+    for value in (0, 1, 2, 10, 11, 100):
+        histogram.observe(value)
+    # a value equal to an upper bound counts in that bucket, le is inclusive
+    assert histogram.counts == [2, 2, 2]
+    assert histogram.snapshot() == dict(count=6, sum=124, buckets={1: 2, 10: 4, float('inf'): 6})
+
+
+def test_snapshot_by_metric_and_tag():
+    instrumentation = Instrumentation()
+    instrumentation.observe('wit_db_statement_rows', 'get_inundation', 5)
+    instrumentation.observe('wit_db_statement_rows', 'get_inundation', 50)
+    instrumentation.observe('wit_db_statement_rows', 'iter_data', 0)
+    snapshot = instrumentation.snapshot()
+    assert list(snapshot) == ['wit_db_statement_rows']
+    assert snapshot['wit_db_statement_rows']['get_inundation']['count'] == 2
+    assert snapshot['wit_db_statement_rows']['iter_data']['buckets'][0] == 1
+    assert len(snapshot['wit_db_statement_rows']['iter_data']['buckets']) == len(ROWS_BUCKETS) + 1
+    instrumentation.reset()
+    assert instrumentation.snapshot() == {}
+
+
+def test_unknown_metric():
+    with pytest.raises(KeyError):
+        Instrumentation().observe('wit_db_unknown', 'get_inundation', 1)
+
+
+def test_to_prometheus():
+    instrumentation = Instrumentation()
+    instrumentation.observe('wit_db_statement_rows', 'get_"quoted"', 10)
+    instrumentation.observe('wit_db_statement_rows', 'get_"quoted"', 20)
+    lines = instrumentation.to_prometheus().splitlines()
+    label = 'method="get_\\"quoted\\""'
+    assert lines[0] == '# HELP wit_db_statement_rows %s' % (METRICS['wit_db_statement_rows'][0],)
+    assert lines[1] == '# TYPE wit_db_statement_rows histogram'
+    assert lines[2] == 'wit_db_statement_rows_bucket{%s,le="0.0"} 0' % (label,)
+    assert 'wit_db_statement_rows_bucket{%s,le="10.0"} 1' % (label,) in lines
+    assert 'wit_db_statement_rows_bucket{%s,le="100.0"} 2' % (label,) in lines
+    assert lines[-3] == 'wit_db_statement_rows_bucket{%s,le="+Inf"} 2' % (label,)
+    assert lines[-2] == 'wit_db_statement_rows_sum{%s} 30.0' % (label,)
+    assert lines[-1] == 'wit_db_statement_rows_count{%s} 2' % (label,)
+
+
+def test_write_prometheus(tmp_path):
+    instrumentation = Instrumentation()
+    instrumentation.observe('wit_db_hold_seconds', 'get_inundation', 0.002)
+    path = tmp_path / 'wit.prom'
+    path.write_text('stale')
+    instrumentation.write_prometheus(str(path))
+    assert path.read_text() == instrumentation.to_prometheus()
+    assert [p.name for p in tmp_path.iterdir()] == ['wit.prom']
@@ -0,0 +1,82 @@
+"""Test that the bulk and the per shape conversion of the geometries of shapes
+agree, so that a polygon hashes the same whichever registered it, and that a
+reused plot renderer draws the same pngs as a fresh one
+"""
+import io
+
+import numpy as np
+import pytest
+import shapely
+
+from wit_tooling.database.geometry import geometry_hash
+from wit_tooling.poly_tools import WitPlotRenderer, convert_shape_to_polygon, convert_shapes_to_polygons
+
+SQUARE = [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]
+HOLE = [(2, 2), (2, 4), (4, 4), (4, 2), (2, 2)]
+BOWTIE = [(0, 0), (10, 10), (10, 0), (0, 10), (0, 0)]
+FAR_SQUARE = [(20, 0), (30, 0), (30, 10), (20, 10), (20, 0)]
+# collinear, buffers to an empty polygon
+DEGENERATE = [(40, 0), (45, 5), (50, 10), (40, 0)]
+
+GEOMETRIES = {
+    'square': dict(type='Polygon', coordinates=[SQUARE]),
+    'holed': dict(type='Polygon', coordinates=[SQUARE, HOLE]),
+    'bowtie': dict(type='Polygon', coordinates=[BOWTIE]),
+    'multipart': dict(type='MultiPolygon', coordinates=[[SQUARE, HOLE], [FAR_SQUARE]]),
+    'multipart_bowtie': dict(type='MultiPolygon', coordinates=[[BOWTIE], [FAR_SQUARE]]),
+    'empty_part': dict(type='MultiPolygon', coordinates=[[SQUARE], [DEGENERATE]]),
+    'bowtie_and_empty_part': dict(type='MultiPolygon', coordinates=[[BOWTIE], [DEGENERATE], [FAR_SQUARE]]),
+    'only_empty_part': dict(type='MultiPolygon', coordinates=[[DEGENERATE]]),
+}
+
+
+@pytest.mark.parametrize('name', sorted(GEOMETRIES))
+def test_bulk_matches_per_shape(name):
+    single = convert_shape_to_polygon(GEOMETRIES[name])
+    bulk = convert_shapes_to_polygons([GEOMETRIES[name]])[0]
+    assert single.is_valid and bulk.is_valid
+    assert single.geom_type == bulk.geom_type
+    assert shapely.equals_exact(shapely.normalize(single), shapely.normalize(bulk), tolerance=0)
+    assert geometry_hash(single) == geometry_hash(bulk)
+
+
+@pytest.mark.parametrize('convert', [convert_shape_to_polygon, lambda g: convert_shapes_to_polygons([g])[0]])
+def test_empty_part_dropped(convert):
+    polygon = convert(GEOMETRIES['empty_part'])
+    assert len(polygon.geoms) == 1
+    assert not any(part.is_empty for part in polygon.geoms)
+
+
+def test_bulk_in_order():
+    names = sorted(GEOMETRIES)
+    bulk = convert_shapes_to_polygons([GEOMETRIES[name] for name in names])
+    assert [geometry_hash(p) for p in bulk] == \
+            [geometry_hash(convert_shape_to_polygon(GEOMETRIES[name])) for name in names]
+
+
+def wit_data(start, years, seed):
+    """ wit data as a dict of columns, with a sparse year to be hatched """
+    rng = np.random.default_rng(seed)
+    time = np.datetime64(start) + np.sort(rng.choice(365 * years, 12 * years, replace=False)).astype('timedelta64[D]')
+    time = time[(time < np.datetime64(start) + np.timedelta64(365, 'D')) | (time > np.datetime64(start) + np.timedelta64(700, 'D'))]
+    values = rng.dirichlet(np.ones(5), len(time)).astype('float32')
+    return dict(TIME=time, **{name: values[:, i] for i, name in enumerate(['BS', 'NPV', 'PV', 'WET', 'WATER'])})
+
+
+def pixels(png):
+    import matplotlib.image
+    return matplotlib.image.imread(io.BytesIO(png.getvalue()), format='png')
+
+
+@pytest.mark.parametrize('with_title', [True, False])
+def test_reused_renderer_matches_fresh(with_title):
+    pytest.importorskip('matplotlib')
+    pytest.importorskip('pandas')
+    plots = [(wit_data('1990-01-01', 30, 0), 'a wetland with a name long enough to wrap the title over two lines ' * 2),
+            (wit_data('2009-06-01', 6, 1), "Lake O'Brien"),
+            (wit_data('1995-01-01', 20, 2), 'a wetland with a name long enough to wrap the title over two lines ' * 2)]
+    renderer = WitPlotRenderer(with_title)
+    for count, name in plots:
+        reused = renderer.render(count, name)
+        fresh = WitPlotRenderer(with_title).render(count, name)
+        np.testing.assert_array_equal(pixels(reused), pixels(fresh))
@@ -0,0 +1,59 @@
+"""Test the grouping of polygons into the footprints of datacube queries"""
+import numpy as np
+import shapely
+
+from wit_tooling.query_planner import cluster_bounds, plan_queries
+
+
+def members_of(clusters):
+    return sorted(sorted(members.tolist()) for members, _ in clusters)
+
+
+def test_empty():
+    assert cluster_bounds([]) == []
+    assert plan_queries([]) == []
+
+
+def test_single_box():
+    assert [(m.tolist(), e) for m, e in cluster_bounds([(0, 0, 10, 10)])] == [([0], (0., 0., 10., 10.))]
+
+
+def test_close_boxes_stay_together():
+    bounds = [(0, 0, 10, 10), (20, 0, 30, 10), (0, 20, 10, 30)]
+    clusters = cluster_bounds(bounds, max_size=100, min_fill=0.1)
+    assert members_of(clusters) == [[0, 1, 2]]
+    assert clusters[0][1] == (0., 0., 30., 30.)
+
+
+def test_far_groups_split_at_gap():
+    bounds = [(0, 0, 10, 10), (1e6, 0, 1e6 + 10, 10), (15, 0, 25, 10), (1e6 + 15, 0, 1e6 + 25, 10)]
+    clusters = cluster_bounds(bounds, max_size=1000, min_fill=0.05)
+    assert members_of(clusters) == [[0, 2], [1, 3]]
+    for members, extent in clusters:
+        assert extent[2] - extent[0] <= 1000 and extent[3] - extent[1] <= 1000
+
+
+def test_sparse_cluster_split_by_fill():
+    bounds = [(0, 0, 1, 1), (99, 99, 100, 100)]
+    assert members_of(cluster_bounds(bounds, max_size=1000, min_fill=0.5)) == [[0], [1]]
+    assert members_of(cluster_bounds(bounds, max_size=1000, min_fill=0)) == [[0, 1]]
+
+
+def test_every_box_in_one_cluster():
+    rng = np.random.default_rng(0)
+    corners = rng.uniform(0, 1e6, (200, 2))
+    bounds = np.hstack([corners, corners + rng.uniform(10, 5000, (200, 2))])
+    clusters = cluster_bounds(bounds, max_size=50000)
+    assert sorted(np.concatenate([members for members, _ in clusters]).tolist()) == list(range(200))
+    for members, extent in clusters:
+        assert np.all(bounds[members, :2] >= extent[:2]) and np.all(bounds[members, 2:] <= extent[2:])
+        assert len(members) == 1 or (extent[2] - extent[0] <= 50000 and extent[3] - extent[1] <= 50000)
+
+
+def test_plan_queries_skips_missing():
+    polygons = [shapely.box(0, 0, 10, 10), None, shapely.box(1e6, 0, 1e6 + 10, 10), shapely.box(20, 0, 30, 10)]
+    plan = plan_queries(polygons, max_size=1000)
+    assert sorted(sorted(members.tolist()) for members, _ in plan) == [[0, 3], [2]]
+    for members, footprint in plan:
+        for index in members:
+            assert footprint.contains(polygons[index])
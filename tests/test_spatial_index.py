@@ -0,0 +1,50 @@
+"""Test the bulk sorting of polygons into path/rows and their overlaps"""
+import shapely
+
+from wit_tooling.spatial_index import PathRowIndex, overlap_graph, to_polygons
+
+# two path/rows overlapping on 80 <= x <= 100
+FOOTPRINTS = [shapely.box(0, 0, 100, 100), shapely.box(80, 0, 180, 100)]
+
+
+def test_to_polygons_keeps_missing():
+    square = dict(type='Polygon', coordinates=[[(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]])
+    polygons = to_polygons([None, square, None])
+    assert polygons[0] is None and polygons[2] is None
+    assert polygons[1].equals(shapely.box(0, 0, 1, 1))
+    assert len(to_polygons([None])) == 1
+
+
+def test_classify():
+    index = PathRowIndex(['p1', 'p2'], FOOTPRINTS)
+    polygons = [
+        shapely.box(10, 10, 20, 20),    # in p1 only
+        shapely.box(85, 10, 95, 20),    # in the overlap of both
+        shapely.box(95, 10, 105, 20),   # half in p1, all in p2
+        shapely.box(170, 10, 190, 20),  # half in p2
+        shapely.box(500, 0, 510, 10),   # in none
+        None,
+    ]
+    assert index.classify(polygons) == [
+        (['p1'], []),
+        (['p1', 'p2'], []),
+        (['p2'], ['p1']),
+        ([], ['p2']),
+        ([], []),
+        ([], []),
+    ]
+    assert index.classify(polygons[2:4], contain_ratio=0.5) == [(['p1', 'p2'], []), (['p2'], [])]
+
+
+def test_classify_follows_footprint_order():
+    index = PathRowIndex(['p2', 'p1'], FOOTPRINTS[::-1])
+    assert index.classify([shapely.box(85, 10, 95, 20)]) == [(['p2', 'p1'], [])]
+
+
+def test_overlap_graph():
+    polygons = [shapely.box(0, 0, 10, 10), shapely.box(5, 5, 15, 15), shapely.box(12, 12, 20, 20),
+            shapely.box(50, 50, 60, 60), None]
+    graph = overlap_graph(polygons, ids=[11, 12, 13, 14, 15])
+    assert {poly_id: sorted(others) for poly_id, others in graph.items()} == \
+            {11: [12], 12: [11, 13], 13: [12], 14: [], 15: []}
+    assert sorted(overlap_graph(polygons[:2])[0]) == [1]
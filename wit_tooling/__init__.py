@@ -1,10 +1,37 @@
-from .poly_tools import convert_shape_to_polygon, poly_wkt, query_wit_data, plot_to_png, query_wit_metrics, load_timeslice, generate_raster, shape_list
-from .datacube_util import construct_product, query_datasets, load_wofs_fc
-from .database.io import DIO
-from .aws_util import *
-import pandas as pd
+import importlib
+import importlib.util
 from datetime import datetime, timezone
-import xarray as xr
+
+# The names of the submodules are imported on first use, so that a worker only
+#  needing e.g. DIO doesn't load datacube, matplotlib, rasterio or boto3. The
+#  submodules themselves, e.g. wit_tooling.poly_tools, are imported on first
+#  access too.
+_LAZY_NAMES = {
+    'convert_shape_to_polygon': 'poly_tools', 'poly_wkt': 'poly_tools', 'poly_wkb': 'poly_tools',
+    'query_wit_data': 'poly_tools', 'iter_wit_data': 'poly_tools', 'wit_frame': 'poly_tools',
+    'plot_to_png': 'poly_tools', 'WitPlotRenderer': 'poly_tools', 'query_wit_metrics': 'poly_tools',
+    'load_timeslice': 'poly_tools', 'generate_raster': 'poly_tools', 'shape_list': 'poly_tools',
+    'convert_shapes_to_polygons': 'poly_tools', 'repair_polygons': 'poly_tools', 'shapefile_polygons': 'poly_tools',
+    'construct_product': 'datacube_util', 'query_datasets': 'datacube_util', 'load_wofs_fc': 'datacube_util',
+    'DIO': 'database.io',
+    'FeatureStore': 'feature_store',
+    'PathRowIndex': 'spatial_index', 'overlap_graph': 'spatial_index', 'to_polygons': 'spatial_index',
+    'plan_queries': 'query_planner', 'cluster_bounds': 'query_planner',
+    'load_wit_s3': 'aws_util', 'set_output_name': 'aws_util',
+}
+
+def __getattr__(name):
+    module = _LAZY_NAMES.get(name)
+    if module is None:
+        if not name.startswith('_') and importlib.util.find_spec('.' + name, __name__) is not None:
+            return importlib.import_module('.' + name, __name__)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
 
 C3 = False
 if C3:
@@ -41,15 +68,37 @@ def load_wit_data(**kwargs):
     output:
     pandas dataframe of wit data
     """
+    import pandas as pd
+    from .poly_tools import query_wit_data
     if kwargs.get("csv") is not None:
         wit_data = pd.read_csv(kwargs['csv'])
     elif kwargs.get('shape') is not None:
-        _, wit_data = query_wit_data(kwargs['shape'])
-        wit_data = pd.DataFrame(data=wit_data, columns=['TIME', 'BS', 'NPV', 'PV', 'WET', 'WATER'])
-        wit_data[wit_data.columns[1:]] = wit_data[wit_data.columns[1:]] * 100
+        _, wit_data = query_wit_data(kwargs['shape'], typed=True)
+        wit_data = _db_wit_data(wit_data)
     elif kwargs.get('s3_url') is not None:
         wit_data = pd.read_csv(kwargs['s3_url'], infer_datetime_format=True)
+    return _rename_wit_data(wit_data)
 
+def iter_load_wit_data(shapes, batch_size=1000):
+    """
+    Load pre-computed wit data of many shapes from the database, streamed in batches
+    input parameters:
+    shapes: an iterable of shapes from shape file
+    batch_size: number of shapes per database query
+    output:
+    generator of (shape, pandas dataframe of wit data) in the order of shapes
+    """
+    from .poly_tools import iter_wit_data
+    for shape, _, wit_data in iter_wit_data(shapes, batch_size, typed=True):
+        yield shape, _rename_wit_data(_db_wit_data(wit_data))
+
+def _db_wit_data(wit_data):
+    from .poly_tools import wit_frame
+    wit_data = wit_frame(wit_data)
+    wit_data[wit_data.columns[1:]] = wit_data[wit_data.columns[1:]] * 100
+    return wit_data
+
+def _rename_wit_data(wit_data):
     wit_data.index.name = 'no'
     #Rename the columns so they are easier to understand and plot
     wit_data = wit_data.rename(columns={
@@ -75,6 +124,7 @@ def spatial_wit(fc_wofs_data, mask):
     output:
     spatial wit results: xr.Dataset
     """
+    import xarray as xr
     none_water_vars = list(fc_wofs_data.data_vars)[:-1]
     water_var = list(fc_wofs_data.data_vars)[-1]
     fc_data = fc_wofs_data[none_water_vars].where(fc_wofs_data[water_var] < 1)
@@ -91,22 +141,30 @@ def spatial_wit(fc_wofs_data, mask):
     return sw_result
 
 def get_alltime_metrics(poly_list):
+    import pandas as pd
+    from .database.io import DIO
     dio = DIO.get()
     rows = dio.get_alltime_metrics(poly_list)
     return pd.DataFrame(rows, columns=['poly_id', 'pv_perc', 'openwater_penc',
                                        'wet_perc', 'pv_fot', 'openwater_fot', 'wet_fot'])
 
 def get_wet_year_metrics(poly_list):
+    import pandas as pd
+    from .database.io import DIO
     dio = DIO.get()
     rows = dio.get_wet_year_metrics(poly_list)
     return pd.DataFrame(rows, columns=['poly_id', 'year', 'min', 'max', 'mean'])
 
 def get_pv_year_metrics(poly_list):
+    import pandas as pd
+    from .database.io import DIO
     dio = DIO.get()
     rows = dio.get_pv_year_metrics(poly_list)
     return pd.DataFrame(rows, columns=['poly_id', 'year', 'min', 'max', 'mean'])
 
-def get_year_metrics_with_type_area(poly_list, wtype):
+def get_year_metrics_with_type_area(poly_list, wtype='SystemType'):
+    import pandas as pd
+    from .database.io import DIO
     dio = DIO.get()
     rows = dio.get_year_metrics_with_type_area(poly_list, wtype)
     return pd.DataFrame(rows, columns=['poly_id', 'year', 'wet_min', 'wet_max', 'wet_mean',
@@ -114,16 +172,37 @@ def get_year_metrics_with_type_area(poly_list, wtype):
                                         'pv_min', 'pv_max', 'pv_mean', 'poly_name', 'area', 'type'])
 
 def get_event_metrics(poly_list):
+    import pandas as pd
+    from .database.io import DIO
     dio = DIO.get()
     rows = dio.get_event_metrics(poly_list)
     return  pd.DataFrame(rows, columns=['poly_id', 'start_time', 'end_time', 'duration', 'max', 'mean', 'area'])
 
 def get_inundation(poly_list, start_date, end_date, min_area, max_rows):
+    import pandas as pd
+    from .database.io import DIO
     dio = DIO.get()
     rows = dio.get_inundation(poly_list, start_date, end_date, min_area, max_rows)
     return pd.DataFrame(rows, columns=['poly_id', 'poly_name', 'wet_years', 'percent', 'area'])
 
 def get_area_by_poly_id(poly_list):
+    import pandas as pd
+    from .database.io import DIO
     dio = DIO.get()
-    rows = dio.get_area_by_poly_id(poly_list)
-    return pd.DataFrame(rows, columns=['time', 'area', 'bare soil', 'dry veg', 'green veg', 'wet', 'open water'])
+    data = dio.get_area_by_poly_ids(poly_list)
+    return pd.DataFrame(dict(time=data['datetime'], area=data['area'], **{'bare soil': data['fc_bs'],
+        'dry veg': data['fc_npv'], 'green veg': data['fc_pv'], 'wet': data['tci_w'], 'open water': data['wofs_water']}))
+
+def get_area_by_poly_ids(poly_list):
+    import pandas as pd
+    from .database.io import DIO
+    dio = DIO.get()
+    data = dio.get_area_by_poly_ids(poly_list)
+    return pd.DataFrame(dict(poly_id=data['poly_id'], time=data['datetime'], area=data['area'],
+        **{'bare soil': data['fc_bs'], 'dry veg': data['fc_npv'], 'green veg': data['fc_pv'],
+            'wet': data['tci_w'], 'open water': data['wofs_water']}))
+
+__all__ = sorted(_LAZY_NAMES) + ['C3', 'ls_timezone', 'ls8_on', 'ls7_on', 'ls5_on_1ym', 'load_wit_data',
+        'iter_load_wit_data', 'spatial_wit', 'get_alltime_metrics', 'get_wet_year_metrics', 'get_pv_year_metrics',
+        'get_year_metrics_with_type_area', 'get_event_metrics', 'get_inundation', 'get_area_by_poly_id',
+        'get_area_by_poly_ids']
@@ -0,0 +1,410 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero Public License for more details.
+#
+# You should have received a copy of the GNU Affero Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+
+import datetime
+import json
+import logging
+import os
+import re
+
+import asyncpg
+
+from .connection import get_database_args
+from .geometry import geometry_ewkb, geometry_hash, geometry_param, load_geometry
+from .io import DIO
+from .special_sql import inundation_by_years
+
+_LOGGER = logging.getLogger(__name__)
+
+_PLACEHOLDER = re.compile(r'%%|%s|%\((\w+)\)s')
+
+
+def to_asyncpg(query, sqlParams):
+    """ Turn a query with psycopg2 placeholders into one with $n placeholders
+
+    Parameters:
+    ----------------------------------------------------------------
+    query:          sql with %s or %(name)s placeholders; asyncpg doesn't expand
+                      tuples, use = ANY(%s) instead of IN %s
+    sqlParams:      sequence or dict of parameters, None for none
+    retval:         (query, list of arguments)
+    """
+    args = []
+    numbers = {}
+    positional = iter(sqlParams if isinstance(sqlParams, (list, tuple)) else ())
+
+    def number(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is None:
+            args.append(next(positional))
+            return '$%d' % len(args)
+        name = match.group(1)
+        if name not in numbers:
+            args.append(sqlParams[name])
+            numbers[name] = len(args)
+        return '$%d' % numbers[name]
+
+    query = _PLACEHOLDER.sub(number, query)
+    return query, [list(a) if isinstance(a, (tuple, set)) else a for a in args]
+
+
+def geometry_bytes(geometry, srid=3577):
+    """ Return a geometry as EWKB bytes, asyncpg sends them as a bytea to be
+    cast with ::bytea::geometry, see geometry_param
+
+    Parameters:
+    ----------------------------------------------------------------
+    geometry:       shapely geometry, (E)WKB bytes or (E)WKT
+    srid:           srid of a geometry not carrying one
+    """
+    if isinstance(geometry, str):
+        if geometry[:5].upper() == 'SRID=':
+            srid = int(geometry[5:].split(';', 1)[0])
+        geometry = geometry_ewkb(load_geometry(geometry), srid)
+    return bytes(geometry_param(geometry, srid).adapted)
+
+
+class AsyncDIO(object):
+    """ The readers of DIO as coroutines on asyncpg, so that many of them can
+    run concurrently with asyncio.gather, each on a connection of the pool.
+
+    Usage Example:
+      async with AsyncDIO() as dio:
+        metrics, inundation = await asyncio.gather(dio.get_alltime_metrics(poly_list),
+                dio.get_inundation(poly_list, 2000, 2010))
+
+    Reads go to WIT_DB_READ_HOSTNAME if it is set, without the freshness check
+    of ReadWriteSplitPolicy, except for get_latest_time and get_min_time which
+    are read on the primary like DIO does.
+
+    It has all the readers of DIO. The writers, the tables set up by
+    DIO.connect, the cache of get_id_by_geom and the result cache are DIO's
+    only.
+    """
+
+    _SEQUENCE_TYPES = DIO._SEQUENCE_TYPES
+
+    def __init__(self, args=None, min_size=None, max_size=None, primary_args=None):
+        """
+        Parameters:
+        ----------------------------------------------------------------
+        args:           connection arguments, get_database_args(read=True) if None
+        min_size:       connections kept open, WIT_DB_POOL_MIN if None
+        max_size:       connections open at most, WIT_DB_POOL_MAX if None
+        primary_args:   connection arguments of the primary, get_database_args()
+                          if None; the pool of args is used if they are the same
+        """
+        self._logger = _LOGGER
+        self._args = args if args is not None else get_database_args(read=True)
+        self._primary_args = primary_args if primary_args is not None else get_database_args()
+        self._primary_pool = None
+        self._min_size = min_size if min_size is not None else int(os.getenv('WIT_DB_POOL_MIN', '1'))
+        self._max_size = max_size if max_size is not None else int(os.getenv('WIT_DB_POOL_MAX', '8'))
+        self._pool = None
+
+        self.data_tablename = 'data'
+        self.poly_tablename = 'polygons'
+        self.alltime_tablename = 'alltime_count'
+        self.first_observe_tablename = 'first_observe'
+        self.year_metrics_tablename = 'year_metrics'
+        self.event_metrics_tablename = 'event_metrics'
+        self.catchment_tablename = 'catchments'
+        self.catchment_members_tablename = 'catchment_members'
+        self.poly_sources_tablename = 'poly_sources'
+        self.landsat_path_tablename = 'landsat_path'
+
+    async def open(self):
+        """ Create the pool of connections """
+        if self._pool is None:
+            self._pool = await self._create_pool(self._args, self._min_size)
+            self._logger.info("Created pool of %s to %s connections", self._min_size, self._max_size)
+        return self
+
+    async def _create_pool(self, args, min_size):
+        return await asyncpg.create_pool(database=args['dbname'], host=args['host'],
+                port=args['port'], user=args['user'], password=args['password'],
+                min_size=min_size, max_size=max(self._max_size, min_size, 1),
+                # asyncpg prepares every statement, not possible behind pgbouncer
+                #  in transaction mode, see DIO._PREPARED_STATEMENTS
+                statement_cache_size=100 if DIO._PREPARED_STATEMENTS else 0,
+                init=self._init_connection)
+
+    async def _primary(self):
+        """ The pool of the primary, created on first use """
+        if self._primary_args == self._args:
+            return self._pool
+        if self._primary_pool is None:
+            self._primary_pool = await self._create_pool(self._primary_args, 0)
+        return self._primary_pool
+
+    @staticmethod
+    async def _init_connection(conn):
+        # decode json like psycopg2 does, asyncpg returns the text
+        await conn.set_type_codec('json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        if self._primary_pool is not None:
+            await self._primary_pool.close()
+            self._primary_pool = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+        return False
+
+    async def get_matching_rows(self, query, sqlParams=None, maxRows=None, pool=None):
+        """ Run the query on a connection of the pool
+
+        Parameters:
+        ----------------------------------------------------------------
+        query:          sql with psycopg2 placeholders, see to_asyncpg
+        sqlParams:      sequence or dict of parameters
+        maxRows:        number of rows returned at most, all if None
+        pool:           pool to run it on, the pool of the read endpoint if None
+        retval:         list of row tuples
+        """
+        query, args = to_asyncpg(query, sqlParams)
+        rows = await (pool or self._pool).fetch(query, *args)
+        if maxRows is not None:
+            rows = rows[:maxRows]
+        return [tuple(r) for r in rows]
+
+    def _poly_list(self, poly_list):
+        if not isinstance(poly_list, self._SEQUENCE_TYPES):
+            poly_list = [poly_list]
+        return [int(i) for i in poly_list]
+
+    async def get_data_by_poly_id(self, poly_id, typed=False):
+        """ See DIO.get_data_by_poly_id """
+        query = "SELECT %s FROM %s WHERE poly_id = ANY(%%s::int[]) ORDER BY datetime ASC" \
+                % (','.join(DIO._DATA_FIELDS), self.data_tablename)
+        rows = await self.get_matching_rows(query, (self._poly_list(poly_id),))
+        if typed:
+            return DIO.rows_to_columns(rows, DIO._DATA_FIELDS, DIO._DATA_DTYPES)
+        return rows
+
+    async def get_area_by_poly_ids(self, poly_ids):
+        """ See DIO.get_area_by_poly_ids """
+        query = DIO._AREA_QUERY % (self.poly_tablename, self.data_tablename)
+        rows = await self.get_matching_rows(query, (self._poly_list(poly_ids),))
+        return DIO.rows_to_columns(rows, DIO._AREA_FIELDS, DIO._AREA_DTYPES)
+
+    async def get_name_by_id(self, table_name, poly_id):
+        if table_name == self.catchment_tablename:
+            query = "SELECT catchment_name FROM %s WHERE catchment_id = %%s" % (self.catchment_tablename,)
+        else:
+            query = "SELECT poly_name FROM %s WHERE poly_id = %%s" % (self.poly_tablename,)
+        row = await self.get_matching_rows(query, (int(poly_id),))
+        if len(row) == 0:
+            return ''
+        return row
+
+    async def get_catchment_list(self, vague_string):
+        query = "SELECT catchment_id, catchment_name FROM %s WHERE shapefile ~ %%s" % (self.catchment_tablename,)
+        row = await self.get_matching_rows(query, ('.*%s.*' % (vague_string,),))
+        if len(row) == 0:
+            return ''
+        return row
+
+    async def get_polys_by_catchment_id(self, catchment_id, vague_string='', maxrows=None):
+        query = "SELECT poly_id from %s WHERE catchment_id = %%s " \
+                " AND source_id IN (SELECT source_id FROM %s WHERE shapefile ~ %%s) " \
+                " ORDER BY area_ha DESC" % (self.catchment_members_tablename, self.poly_sources_tablename)
+        if maxrows is not None:
+            query += " LIMIT %s" % (int(maxrows),)
+        return await self.get_matching_rows(query, (int(catchment_id), '.*%s.*' % (vague_string,)))
+
+    async def get_alltime_metrics(self, poly_list):
+        query = "SELECT * FROM (SELECT poly_id, coalesce(pv/total::float, 0) as pv_perc, " \
+                " coalesce(openwater/total::float, 0) as openwater_penc, coalesce(wet/total::float, 0) as wet_perc " \
+                " FROM %s) AS a NATURAL JOIN (SELECT poly_id, pv as pv_fot, openwater as openwater_fot, " \
+                " wet as wet_fot FROM %s) AS b WHERE poly_id = ANY(%%s::int[])" \
+                % (self.alltime_tablename, self.first_observe_tablename)
+        return await self.get_matching_rows(query, (self._poly_list(poly_list),))
+
+    async def get_year_metrics(self, poly_list, mlist):
+        mlist = ['poly_id', 'year'] + mlist
+        query = "SELECT %s FROM %s WHERE poly_id = ANY(%%s::int[]) ORDER BY poly_id ASC, year ASC" \
+                % (','.join(mlist), self.year_metrics_tablename)
+        return await self.get_matching_rows(query, (self._poly_list(poly_list),))
+
+    async def get_wet_year_metrics(self, poly_list):
+        return await self.get_year_metrics(poly_list, ['wet_min', 'wet_max', 'wet_mean'])
+
+    async def get_pv_year_metrics(self, poly_list):
+        return await self.get_year_metrics(poly_list, ['pv_min', 'pv_max', 'pv_mean'])
+
+    async def get_year_metrics_with_type_area(self, poly_list, wtype='SystemType'):
+        query = "SELECT a.poly_id, a.year, a.wet_min, a.wet_max, a.wet_mean, a.water_min, a.water_max, a.water_mean, "\
+                " a.pv_min, a.pv_max, a.pv_mean, "\
+                " c.properties::json->'ORIG_FID', ST_Area(b.geometry)/10000 as area, c.properties::json->%%s as type "\
+                " FROM %s as a, %s as b, %s as c WHERE a.poly_id=b.poly_id AND a.poly_id=c.poly_id "\
+                " AND a.poly_id = ANY(%%s::int[]) ORDER by a.poly_id ASC, a.year ASC"\
+                % (self.year_metrics_tablename, self.poly_tablename, "poly_properties")
+        return await self.get_matching_rows(query, (wtype, self._poly_list(poly_list)))
+
+    async def get_event_metrics(self, poly_list, set_str=''):
+        table_name = self.event_metrics_tablename
+        if set_str != '':
+            table_name += '_' + set_str
+        query = "SELECT poly_id, start_time, end_time, duration, max, mean, area FROM %s " \
+                " WHERE poly_id = ANY(%%s::int[]) ORDER BY poly_id ASC, start_time ASC" % (table_name,)
+        return await self.get_matching_rows(query, (self._poly_list(poly_list),))
+
+    async def get_inundation(self, poly_list, start_year, end_year, min_area=1, max_rows=5000):
+        """ See DIO.get_inundation """
+        sql_params = dict(poly_list=self._poly_list(poly_list), start_year=int(start_year),
+                end_year=int(end_year), end_time=datetime.datetime(int(end_year), 1, 1),
+                year_interval=int(end_year)-int(start_year), min_area=min_area, max_rows=int(max_rows))
+        return await self.get_matching_rows(inundation_by_years, sql_params)
+
+    async def get_latest_time(self, poly_list):
+        """ See DIO.get_latest_time, read on the primary """
+        return await self._get_time('max', poly_list)
+
+    async def get_min_time(self, poly_list):
+        """ See DIO.get_min_time, read on the primary """
+        return await self._get_time('min', poly_list)
+
+    async def _get_time(self, func, poly_list):
+        query = "SELECT %s(last_update) FROM %s WHERE poly_id = ANY(%%s::int[]) AND result_ready = FALSE" \
+                % (func, self.poly_tablename)
+        row = await self.get_matching_rows(query, (self._poly_list(poly_list),), pool=await self._primary())
+        return row[0][0]
+
+    async def iter_data(self, poly_ids, batch_size=10000, typed=False):
+        """ See DIO.iter_data, an async generator streaming the rows over a cursor
+        of a connection of the pool, which is held until it is exhausted or closed
+        """
+        poly_ids = self._poly_list(poly_ids)
+        if len(poly_ids) == 0:
+            return
+
+        query = "SELECT ids.n, b.poly_id, datetime, fc_bs, fc_npv, fc_pv, tci_w, wofs_water "\
+                " FROM unnest($1::int[]) WITH ORDINALITY AS ids (poly_id, n), %s AS b "\
+                " WHERE b.poly_id = ids.poly_id ORDER BY ids.n ASC, datetime ASC" % (self.data_tablename)
+        async with self._pool.acquire() as conn:
+            # a cursor only lives in a transaction
+            async with conn.transaction(readonly=True):
+                current, poly_id, rows = None, None, []
+                async for row in conn.cursor(query, poly_ids, prefetch=batch_size):
+                    if row[0] != current:
+                        if rows:
+                            yield poly_id, self._format_data(rows, typed)
+                        current, poly_id, rows = row[0], row[1], []
+                    rows.append(tuple(row)[2:])
+                if rows:
+                    yield poly_id, self._format_data(rows, typed)
+
+    def _format_data(self, rows, typed):
+        if typed:
+            return DIO.rows_to_columns(rows, DIO._DATA_FIELDS, DIO._DATA_DTYPES)
+        return rows
+
+    async def get_id_by_geom(self, table_name, geometry):
+        """ See DIO.get_id_by_geom, without its cache of ids """
+        row = ()
+        if table_name == self.poly_tablename:
+            row = await self._query_id(table_name, "poly_hash = %s", geometry_hash(geometry))
+        if len(row) == 0:
+            row = await self._query_id(table_name, "ST_Equals(geometry, %s::bytea::geometry)",
+                    geometry_bytes(geometry))
+        if len(row) == 0:
+            if table_name == self.catchment_tablename:
+                return 0, ''
+            return 0, '', ''
+        return row[0]
+
+    async def _query_id(self, table_name, condition, param):
+        if table_name == self.catchment_tablename:
+            query = "SELECT catchment_id, catchment_name"
+        else:
+            query = "SELECT poly_id, poly_name, result_ready"
+        query += " FROM %s WHERE " % (table_name,) + condition
+        return await self.get_matching_rows(query, (param,))
+
+    async def get_ids_by_geoms(self, geometries):
+        """ See DIO.get_ids_by_geoms """
+        hashes = [geometry_hash(geometry) for geometry in geometries]
+        query = "SELECT poly_hash, poly_id, poly_name, result_ready FROM %s WHERE poly_hash = ANY(%%s::text[])" \
+                % (self.poly_tablename,)
+        found = {row[0]: row[1:] for row in await self.get_matching_rows(query, (list(set(hashes)),))}
+        result = []
+        for geometry, poly_hash in zip(geometries, hashes):
+            if poly_hash not in found:
+                found[poly_hash] = await self.get_id_by_geom(self.poly_tablename, geometry)
+            result.append(found[poly_hash])
+        return result
+
+    async def get_data_by_geom(self, geometry, typed=False):
+        poly_id, poly_name, state = await self.get_id_by_geom(self.poly_tablename, geometry)
+        if poly_id == 0:
+            return '', self._format_data([], typed)
+        return poly_name, await self.get_data_by_poly_id(poly_id, typed)
+
+    async def get_polys_by_geom(self, geometry, maxrows=None):
+        catchment_id, catchment_name = await self.get_id_by_geom(self.catchment_tablename, geometry)
+        if catchment_id == 0:
+            return '', []
+        return catchment_name, await self.get_polys_by_catchment_id(catchment_id, maxrows=maxrows)
+
+    async def get_alltime_metrics_by_geom(self, geometry):
+        poly_id, poly_name, state = await self.get_id_by_geom(self.poly_tablename, geometry)
+        if poly_id == 0:
+            return []
+        return await self.get_alltime_metrics(poly_id)
+
+    async def get_year_metrics_by_geom(self, geometry):
+        poly_id, poly_name, state = await self.get_id_by_geom(self.poly_tablename, geometry)
+        if poly_id == 0:
+            return []
+        return await self.get_year_metrics(poly_id, ['wet_min', 'wet_max', 'wet_mean',
+                                                     'water_min', 'water_max', 'water_mean',
+                                                     'pv_min', 'pv_max', 'pv_min'])
+
+    async def get_event_metrics_by_geom(self, geometry, set_str=''):
+        poly_id, poly_name, state = await self.get_id_by_geom(self.poly_tablename, geometry)
+        if poly_id == 0:
+            return []
+        query = "SELECT ev.poly_id, ev.start_time, ev.end_time, ev.duration, max(data.tci_w+data.wofs_water) as max, " \
+                " avg(data.tci_w+data.wofs_water) as mean, " \
+                " max(data.tci_w+data.wofs_water)*max(ST_area(polygons.geometry))/10000 as area " \
+                " FROM data, polygons, %s as ev WHERE polygons.poly_id = %%(poly_id)s " \
+                " AND polygons.poly_id = ev.poly_id AND data.poly_id = polygons.poly_id " \
+                " AND data.datetime >= ev.start_time AND data.datetime <= ev.end_time GROUP BY ev.event_id"
+        query = query % ('event_metrics_time',) + " UNION ALL " + query % ('incomplete_event',)
+        return await self.get_matching_rows(query, dict(poly_id=int(poly_id)))
+
+    async def get_intersect_polygons(self, poly_id, geometry, shapefile):
+        query = "SELECT poly_id FROM %s WHERE ST_Intersects(%%s::bytea::geometry, geometry) AND poly_id <> %%s " \
+                " AND shapefile ~* %%s" % (self.poly_tablename,)
+        return await self.get_matching_rows(query, (geometry_bytes(geometry), int(poly_id),
+                '.*' + shapefile.split('/')[-1] + '.*'))
+
+    async def get_intersect_landsat_pathrow(self, geometry):
+        query = "SELECT pathrow_id, ST_Area(ST_Intersection(%%(geometry)s::bytea::geometry, " \
+                " ST_Transform(geometry, 3577)))/ST_Area(%%(geometry)s::bytea::geometry) FROM %s " \
+                " WHERE ST_Intersects(%%(geometry)s::bytea::geometry, ST_Transform(geometry, 3577))" \
+                % (self.landsat_path_tablename,)
+        return await self.get_matching_rows(query, dict(geometry=geometry_bytes(geometry)))
+
+    async def get_landsat_pathrows(self):
+        """ See DIO.get_landsat_pathrows """
+        query = "SELECT pathrow_id, pathrow_label, ST_AsEWKB(ST_Transform(geometry, 3577)) FROM %s " \
+                " ORDER BY pathrow_id ASC" % (self.landsat_path_tablename,)
+        return await self.get_matching_rows(query)
@@ -0,0 +1,212 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero Public License for more details.
+#
+# You should have received a copy of the GNU Affero Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+
+import collections
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class MemoryStore(object):
+    """ In-process store keeping the most recently used max_entries results """
+
+    def __init__(self, max_entries=256):
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskStore(object):
+    """ Store of pickled results in a local directory, shared by the processes
+    using the same directory. The least recently used files are removed once
+    the directory holds more than max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def set(self, key, value):
+        # write to a temporary file first so that readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
+
+
+UNORDERED_ARGS = ('poly_list',)
+""" arguments whose order doesn't change the result, e.g. the poly_list of
+the cached readers which select by poly_id = ANY or IN
+"""
+
+
+def normalize_arg(value, unordered=False):
+    """ Return a hashable form of an argument in which numpy types don't
+    matter. The items of a sequence keep their order, unless unordered where
+    they are sorted, repeated items included.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple, set)):
+        values = [normalize_arg(v) for v in value]
+        if unordered or isinstance(value, set):
+            try:
+                return tuple(sorted(values))
+            except TypeError:
+                pass
+        return tuple(values)
+    return value
+
+
+class ResultCache(object):
+    """ Cache of query results keyed by the method name and its normalized
+    arguments. Every entry carries the version of the data it was computed
+    from, an entry is only used while version() returns the same.
+
+    The version is checked at most every check_interval seconds, a result may
+    be that much out of date.
+    """
+
+    def __init__(self, version, store, check_interval=0):
+        """
+        Parameters:
+        ----------------------------------------------------------------
+        version:        callable returning the current version of the data
+        store:          MemoryStore or DiskStore
+        check_interval: seconds a checked version is trusted for
+        """
+        self._version = version
+        self._store = store
+        self._check_interval = check_interval
+        self._checked = None
+
+    def current_version(self):
+        now = time.monotonic()
+        if self._checked is None or now - self._checked[0] >= self._check_interval:
+            self._checked = (now, self._version())
+        return self._checked[1]
+
+    def get_or_compute(self, name, arguments, compute):
+        """ Return the cached result of name called with arguments or compute() it
+
+        Parameters:
+        ----------------------------------------------------------------
+        name:           name of the method
+        arguments:      hashable arguments of the call, see cached_result
+        compute:        callable returning (version, result), the version being
+                          read before the result on the same connection so that
+                          the result is never older than it
+        """
+        key = (name, arguments)
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        version = self.current_version()
+        entry = self._store.get(digest)
+        if entry is not None and entry[0] == version and entry[1] == key:
+            _LOGGER.debug('result cache hit %s', name)
+            return entry[2]
+        version, value = compute()
+        self._store.set(digest, (version, key, value))
+        return value
+
+    def clear(self):
+        self._store.clear()
+        self._checked = None
+
+
+def cached_result(method):
+    """ Decorate a DIO method to go through DIO.result_cache, if there is one.
+    The arguments are bound to the parameters of the method, so that the same
+    call keys the same whether its arguments are passed by position or name.
+    The metrics generation and the result are read on one pinned read connection,
+    a lagging replica can't store an old result under a newer generation.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.result_cache is None:
+            return method(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = tuple((name, normalize_arg(value, name in UNORDERED_ARGS))
+                for name, value in list(bound.arguments.items())[1:])
+        def compute():
+            with self._pin_read_connection() as conn:
+                return self.get_metrics_generation(conn), method(self, *args, **kwargs)
+        return self.result_cache.get_or_compute(method.__name__, arguments, compute)
+    return wrapper
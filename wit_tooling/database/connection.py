@@ -10,8 +10,12 @@
 # You should have received a copy of the GNU Affero Public License
 # along with this program.  If not, see http://www.gnu.org/licenses.
 
+import atexit
+import datetime
 import logging
 import platform
+import threading
+import time
 import traceback
 import os
 from subprocess import Popen, PIPE, call
@@ -20,9 +24,13 @@ from time import sleep
 import psycopg2
 from psycopg2 import pool
 
+from .instrumentation import Instrumentation, InstrumentedCursor, caller_name
+
 max_concurrency = None
 max_concurrency_raise_exception = False
 
+instrumentation = None
+
 class ConcurrencyExceededError(Exception):
     """ This exception is raised when g_max_concurrency is exceeded """
     pass
@@ -66,6 +74,43 @@ def disableConcurrencyChecks():
 
 
 
+def enableInstrumentation(instrument=None, textfile=None):
+    """ Record the time waiting for a connection, the time it is held and the
+    time and row count of each statement into histograms tagged by the name of
+    the method acquiring the connection, e.g. get_inundation.
+
+    NOTE: Only the connections acquired after this call are instrumented.
+
+    Parameters:
+    ----------------------------------------------------------------
+    instrument:       the Instrumentation to record into, a new one if None
+    textfile:         write the histograms to this Prometheus textfile when the
+                        process exits, %(pid)s is replaced by the process id
+    retval:           the Instrumentation, see its snapshot() and write_prometheus()
+    """
+    global instrumentation
+
+    instrumentation = instrument if instrument is not None else Instrumentation()
+    if textfile is not None:
+        atexit.register(instrumentation.write_prometheus, textfile % dict(pid=os.getpid()))
+    return instrumentation
+
+
+
+def disableInstrumentation():
+    global instrumentation
+
+    instrumentation = None
+    return
+
+
+
+# e.g. for the MPI workers of wit-cal, see enableInstrumentation
+if os.getenv('WIT_DB_METRICS_FILE') is not None:
+    enableInstrumentation(textfile=os.getenv('WIT_DB_METRICS_FILE'))
+
+
+
 class ConnectionFactory(object):
     """ Database connection factory.
 
@@ -99,8 +144,11 @@ class ConnectionFactory(object):
     """
 
     _connectionPolicy = None
+    _pid = None
+    """ process that created _connectionPolicy """
+
     @classmethod
-    def get(cls):
+    def get(cls, readonly=False, fresh_after=None):
         """ Acquire a ConnectionWrapper instance that represents a connection
         to the SQL server per nupic.cluster.database.* configuration settings.
 
@@ -126,18 +174,33 @@ class ConnectionFactory(object):
 
         Parameters:
         ----------------------------------------------------------------
+        readonly:     the connection is only used for reading, it may go to the
+                        read endpoint of the policy
+        fresh_after:  with readonly, only use the read endpoint if it has seen
+                        polygons updated up to this timestamp
         retval:       A ConnectionWrapper instance. NOTE: Caller is responsible
                         for releasing resources as described above.
         """
+        if cls._connectionPolicy is not None and cls._pid != os.getpid():
+            cls._forgetForkedPolicy()
+
         if cls._connectionPolicy is None:
             logger = _getLogger(cls)
             logger.info("Creating db connection policy via provider %r",
                         cls._createDefaultPolicy)
             cls._connectionPolicy = cls._createDefaultPolicy()
+            cls._pid = os.getpid()
 
             logger.debug("Created connection policy: %r", cls._connectionPolicy)
 
-        return cls._connectionPolicy.acquireConnection()
+        if instrumentation is None:
+            return cls._connectionPolicy.acquireConnection(readonly=readonly, fresh_after=fresh_after)
+
+        tag = caller_name(__file__)
+        start = time.monotonic()
+        connWrap = cls._connectionPolicy.acquireConnection(readonly=readonly, fresh_after=fresh_after)
+        connWrap.instrument(instrumentation, tag, start)
+        return connWrap
 
 
     @classmethod
@@ -156,6 +219,18 @@ class ConnectionFactory(object):
 
         return
 
+    @classmethod
+    def _forgetForkedPolicy(cls):
+        """ [private] Drop the connection policy inherited from the parent process,
+        e.g. by a forked MPI worker. Its connections are detached rather than
+        closed, closing them would end the sessions of the parent.
+        """
+        logger = _getLogger(cls)
+        logger.info("Process forked from %s, creating a new connection policy", cls._pid)
+        cls._connectionPolicy.detach()
+        cls._connectionPolicy = None
+        return
+
     @classmethod
     def _createDefaultPolicy(cls):
         """ [private] Create the default database connection policy instance
@@ -170,7 +245,10 @@ class ConnectionFactory(object):
           "Creating database connection policy: platform=%r; psycopg2.VERSION=%r",
           platform.system(), psycopg2.__version__)
 
-        policy = PooledConnectionPolicy()
+        if os.getenv('WIT_DB_READ_HOSTNAME') is not None:
+            policy = ReadWriteSplitPolicy()
+        else:
+            policy = PooledConnectionPolicy()
         return policy
 
     # <-- End of class ConnectionFactory
@@ -222,6 +300,9 @@ class ConnectionWrapper(object):
             self._creationTracebackString = None
             """ Instance creation traceback string (if g_max_concurrency is enabled) """
 
+            self._instrumentation = None
+            """ (Instrumentation, tag, acquire time) if instrumentation is enabled """
+
 
             if max_concurrency is not None:
             # NOTE: must be called *before* _clsNumOutstanding is incremented
@@ -243,6 +324,18 @@ class ConnectionWrapper(object):
         return
 
 
+    def instrument(self, instrument, tag, start):
+        """ Record the wait since start and later the hold time of this instance
+        and the statements run on its cursor into instrument under tag
+        """
+        now = time.monotonic()
+        instrument.observe('wit_db_acquire_wait_seconds', tag, now - start)
+        self._instrumentation = (instrument, tag, now)
+        if isinstance(self.cursor, InstrumentedCursor):
+            self.cursor.instrumentation = instrument
+            self.cursor.tag = tag
+
+
     def __repr__(self):
         return "%s<dbConn=%r, dbConnImpl=%r, cursor=%r, creationTraceback=%r>" % (
           self.__class__.__name__, self.dbConn,
@@ -287,6 +380,11 @@ class ConnectionWrapper(object):
 
         self._releaser(dbConn=self.dbConn, cursor=self.cursor)
 
+        if self._instrumentation is not None:
+            instrument, tag, start = self._instrumentation
+            instrument.observe('wit_db_hold_seconds', tag, time.monotonic() - start)
+            self._instrumentation = None
+
         self.__class__._clsNumOutstanding -= 1
         assert self._clsNumOutstanding >= 0,  \
                "_clsNumOutstanding=%r" % (self._clsNumOutstanding,)
@@ -343,17 +441,46 @@ class PooledConnectionPolicy(object):
     as needed for each transaction.  NOTE: Appropriate for multi-threaded
     applications. NOTE: The connections are NOT shared concurrently between
     threads.
+
+    The pool keeps MIN_CONNECTIONS open and opens up to MAX_CONNECTIONS, an
+    acquire waits up to ACQUIRE_TIMEOUT seconds for a connection to be released
+    beyond that. A connection that was idle for longer than IDLE_CHECK_SECONDS
+    is checked before it is handed out, broken connections are closed instead
+    of going back to the pool.
     """
 
+    MIN_CONNECTIONS = int(os.getenv('WIT_DB_POOL_MIN', '1'))
+    MAX_CONNECTIONS = int(os.getenv('WIT_DB_POOL_MAX', '8'))
+    IDLE_CHECK_SECONDS = float(os.getenv('WIT_DB_POOL_IDLE_CHECK', '60'))
+    ACQUIRE_TIMEOUT = float(os.getenv('WIT_DB_POOL_TIMEOUT', '60'))
 
-    def __init__(self):
+    CONNECT_RETRIES = 5
+    """ number of attempts to get a working connection """
+
+    RETRY_BACKOFF = 0.5
+    """ seconds before the second attempt, doubled for every further attempt """
+
+    def __init__(self, args=None, minconn=None, maxconn=None):
         """ Consruct an instance. The instance's open() method must be
         called to make it ready for acquireConnection() calls.
+
+        Parameters:
+        ----------------------------------------------------------------
+        args:         connection arguments, get_database_args() if None
+        minconn:      connections kept open, MIN_CONNECTIONS if None
+        maxconn:      connections open at most, MAX_CONNECTIONS if None
         """
         self._logger = _getLogger(self.__class__)
 
-        self._pool = pool.ThreadedConnectionPool(1, 1, **get_database_args())
-        self._logger.info("Created %s", self.__class__.__name__)
+        self._args = args if args is not None else get_database_args()
+        self._minconn = minconn if minconn is not None else self.MIN_CONNECTIONS
+        self._maxconn = max(maxconn if maxconn is not None else self.MAX_CONNECTIONS, self._minconn, 1)
+        self._slots = threading.BoundedSemaphore(self._maxconn)
+        # id of the pooled connection -> time it was last released
+        self._last_used = {}
+        self._pool = self._retry(lambda: pool.ThreadedConnectionPool(self._minconn, self._maxconn, **self._args))
+        self._logger.info("Created %s with %s to %s connections", self.__class__.__name__,
+                self._minconn, self._maxconn)
         return
 
 
@@ -364,17 +491,81 @@ class PooledConnectionPolicy(object):
         if self._pool is not None:
             self._pool.closeall()
             self._pool = None
+            self._last_used.clear()
         else:
             self._logger.warning(
                 "close() called, but connection policy was alredy closed")
         return
 
 
-    def acquireConnection(self):
+    def detach(self):
+        """ Give up the connections of the pool in a forked process, see
+        detachConnection
+        """
+        if self._pool is not None:
+            for dbConn in list(self._pool._pool) + list(self._pool._used.values()):
+                detachConnection(dbConn)
+            self._pool = None
+            self._last_used.clear()
+        return
+
+
+    def _retry(self, func):
+        """ Call func until it doesn't raise psycopg2.OperationalError, at most
+        CONNECT_RETRIES times with an exponential backoff in between
+        """
+        delay = self.RETRY_BACKOFF
+        for attempt in range(self.CONNECT_RETRIES):
+            try:
+                return func()
+            except psycopg2.OperationalError as e:
+                if attempt + 1 == self.CONNECT_RETRIES:
+                    raise
+                self._logger.warning("connection error %s, retrying in %ss" % (e, delay))
+                sleep(delay)
+                delay *= 2
+
+
+    def _getconn(self):
+        """ Get a connection from the pool that is known to work, either used
+        recently or passing a health check. Broken connections are replaced by
+        new ones right away, only failures to connect are retried.
+        """
+        while True:
+            dbConn = self._pool.getconn()
+            last_used = self._last_used.get(id(dbConn))
+            if last_used is None or time.monotonic() - last_used <= self.IDLE_CHECK_SECONDS:
+                if not dbConn.closed:
+                    return dbConn
+            else:
+                try:
+                    cursor = dbConn.cursor()
+                    cursor.execute("SELECT 1")
+                    cursor.close()
+                    dbConn.rollback()
+                except psycopg2.Error as e:
+                    self._logger.warning("idle connection failed health check %s" % (e))
+                else:
+                    return dbConn
+            self._discard(dbConn)
+
+
+    def _discard(self, dbConn):
+        """ Close a broken connection and drop it from the pool """
+        self._last_used.pop(id(dbConn), None)
+        try:
+            self._pool.putconn(dbConn, close=True)
+        except psycopg2.Error:
+            pass
+
+
+    def acquireConnection(self, readonly=False, fresh_after=None):
         """ Get a connection from the pool.
 
         Parameters:
         ----------------------------------------------------------------
+        readonly:     ignored, all connections go to the same database
+        fresh_after:  ignored
         retval:       A ConnectionWrapper instance. NOTE: Caller
                         is responsible for calling the  ConnectionWrapper
                         instance's release() method or use it in a context manager
@@ -382,18 +573,19 @@ class PooledConnectionPolicy(object):
         """
         self._logger.debug("Acquiring connection")
 
-        while True:
-            try:
-                dbConn = self._pool.getconn(key=1)
-                cursor = dbConn.cursor()
-                # to avoid connection idle too long and then closed by the server
-                # not sure if it is a good idea
-                cursor.execute("SELECT 1")
-            except psycopg2.Error as e:
-                self._logger.warning("connection error %s" % (e))
-                self._pool = pool.ThreadedConnectionPool(1, 1, **get_database_args())
+        # the pool raises rather than waits when all connections are in use
+        if not self._slots.acquire(timeout=self.ACQUIRE_TIMEOUT):
+            raise pool.PoolError("no connection released within %ss, %s in use"
+                    % (self.ACQUIRE_TIMEOUT, self._maxconn))
+        try:
+            dbConn = self._retry(self._getconn)
+            if instrumentation is not None:
+                cursor = dbConn.cursor(cursor_factory=InstrumentedCursor)
             else:
-                break
+                cursor = dbConn.cursor()
+        except:
+            self._slots.release()
+            raise
 
         connWrap = ConnectionWrapper(dbConn=dbConn,
                                      cursor=cursor,
@@ -409,18 +601,129 @@ class PooledConnectionPolicy(object):
         self._logger.debug("Releasing connection")
 
         try:
-            dbConn.commit()
-        except:
-            pass
+            try:
+                dbConn.commit()
+            except psycopg2.Error:
+                if not dbConn.closed:
+                    dbConn.rollback()
 
-        # Close the cursor
-        cursor.close()
+            # Close the cursor
+            cursor.close()
+        except psycopg2.Error as e:
+            self._logger.warning("connection error %s" % (e))
 
-        # ... then return db connection back to the pool
-        #dbConn.close()
-        self._pool.putconn(dbConn, key=1)
+        # ... then return db connection back to the pool, unless it is broken
+        try:
+            if dbConn.closed:
+                self._discard(dbConn)
+            else:
+                self._last_used[id(dbConn)] = time.monotonic()
+                self._pool.putconn(dbConn)
+                # the pool closes the connections beyond minconn
+                if dbConn.closed:
+                    self._last_used.pop(id(dbConn), None)
+        finally:
+            self._slots.release()
+        return
+
+class ReadWriteSplitPolicy(object):
+    """This connection policy sends connections acquired as readonly to a read
+    endpoint, e.g. a streaming replica, and all other connections to the
+    primary. Each endpoint is pooled by a PooledConnectionPolicy.
+
+    The read endpoint is given by WIT_DB_READ_HOSTNAME and WIT_DB_READ_PORT.
+    A read that requires fresh_after goes to the primary if the newest
+    polygons.last_update on the read endpoint is older. The newest update seen
+    on the read endpoint is remembered, it is only queried again for a
+    fresh_after beyond it and at most every WIT_DB_FRESHNESS_RECHECK seconds.
+    """
+
+    FRESHNESS_QUERY = "SELECT max(last_update) FROM polygons"
+    """ the newest update the read endpoint has seen """
+
+    FRESHNESS_RECHECK = float(os.getenv('WIT_DB_FRESHNESS_RECHECK', '1'))
+    """ seconds the reads go to the primary after finding the read endpoint behind """
+
+    def __init__(self):
+        """ Consruct an instance with a pool for each endpoint. """
+        self._logger = _getLogger(self.__class__)
+
+        self._primary = PooledConnectionPolicy(get_database_args())
+        self._replica = PooledConnectionPolicy(get_database_args(read=True))
+        # newest polygons.last_update seen on the read endpoint, it only grows
+        self._seen = None
+        self._checked = None
+        self._logger.info("Created %s", self.__class__.__name__)
         return
 
+
+    def close(self):
+        """ Close the pools of both endpoints. """
+        self._logger.info("Closing")
+        self._primary.close()
+        self._replica.close()
+        return
+
+
+    def detach(self):
+        """ Give up the connections of both pools in a forked process """
+        self._primary.detach()
+        self._replica.detach()
+        return
+
+
+    def acquireConnection(self, readonly=False, fresh_after=None):
+        """ Get a connection from the pool of the read endpoint if readonly and
+        fresh enough, from the pool of the primary otherwise.
+
+        Parameters:
+        ----------------------------------------------------------------
+        readonly:     the connection is only used for reading
+        fresh_after:  timestamp the read endpoint must have seen in
+                        polygons.last_update, None for any; see as_timestamp
+        retval:       A ConnectionWrapper instance
+        """
+        if not readonly:
+            return self._primary.acquireConnection()
+
+        fresh_after = as_timestamp(fresh_after)
+        if fresh_after is None or (self._seen is not None and fresh_after <= self._seen):
+            return self._replica.acquireConnection()
+        if self._checked is not None and time.monotonic() - self._checked < self.FRESHNESS_RECHECK:
+            return self._primary.acquireConnection()
+
+        connWrap = self._replica.acquireConnection()
+        self._checked = time.monotonic()
+        try:
+            connWrap.cursor.execute(self.FRESHNESS_QUERY)
+            seen = connWrap.cursor.fetchall()[0][0]
+        except:
+            connWrap.release()
+            raise
+        if seen is not None:
+            self._seen = seen if self._seen is None else max(self._seen, seen)
+            if fresh_after <= seen:
+                return connWrap
+
+        self._logger.debug("read endpoint older than %s, reading from primary", fresh_after)
+        connWrap.release()
+        return self._primary.acquireConnection()
+
+def detachConnection(dbConn):
+    """ Make a connection inherited from the parent process unusable in this one
+    without touching the session of the parent: its socket is replaced by
+    /dev/null, so closing it here neither sends a terminate message nor shuts
+    down the socket shared with the parent.
+    """
+    if dbConn.closed:
+        return
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        os.dup2(devnull, dbConn.fileno())
+    finally:
+        os.close(devnull)
+    return
+
 def _getLogger(cls, logLevel=None):
     """ Gets a logger for the given class in this module
     """
@@ -432,9 +735,29 @@ def _getLogger(cls, logLevel=None):
 
     return logger
 
-def get_database_args():
+def as_timestamp(value):
+    """ Return a timestamp given as datetime, numpy datetime64 or ISO 8601
+    string as a naive datetime in UTC, comparable to a TIMESTAMP WITHOUT TIME
+    ZONE column; None stays None
+    """
+    if value is None or isinstance(value, datetime.datetime):
+        pass
+    elif isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    else:
+        value = value.astype('datetime64[us]').item()
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+def get_database_args(read=False):
     """ Returns a dictionary of arguments for DBUtils.SteadyDB.SteadyDBConnection
     constructor.
+
+    Parameters:
+    ----------------------------------------------------------------
+    read:         arguments of the read endpoint, WIT_DB_READ_HOSTNAME and
+                    WIT_DB_READ_PORT
     """
 
     from .io import DIO
@@ -447,6 +770,9 @@ def get_database_args():
     if user is None:
         user = os.getenv('LOGNAME')
     port = 5432
+    if read:
+        host = os.getenv('WIT_DB_READ_HOSTNAME', host)
+        port = int(os.getenv('WIT_DB_READ_PORT', port))
 
     #command = "SELECT 1 FROM pg_database WHERE datname= '%s'" % (dbname)
     #args = ['psql','-At', '-U', user,  '-d', 'postgres', '-h', host, '-p', str(port), '-c', command]
@@ -0,0 +1,75 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero Public License for more details.
+#
+# You should have received a copy of the GNU Affero Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+
+import hashlib
+
+import numpy as np
+import psycopg2
+import shapely
+
+HASH_DECIMALS = 6
+""" coordinates are rounded to this many decimals before hashing, so that the
+hash survives text round trips of the geometry
+"""
+
+
+def load_geometry(geometry):
+    """ Return a shapely geometry from a shapely geometry, (E)WKT string or
+    (E)WKB bytes
+    """
+    if isinstance(geometry, (bytes, bytearray, memoryview)):
+        return shapely.from_wkb(bytes(geometry))
+    if isinstance(geometry, str):
+        if geometry[:5].upper() == 'SRID=':
+            geometry = geometry.split(';', 1)[1]
+        return shapely.from_wkt(geometry)
+    return geometry
+
+
+def geometry_hash(geometry, decimals=HASH_DECIMALS):
+    """ Compute the canonical hash of a geometry on the client side.
+
+    The geometry is snapped to `decimals`, normalized (ring orientation, start
+    vertex and part order) and the md5 of its WKB is returned, so that the same
+    polygon read from different sources hashes the same.
+
+    Parameters:
+    ----------------------------------------------------------------
+    geometry:       shapely geometry, (E)WKT string or (E)WKB bytes
+    retval:         32 chars hex digest
+    """
+    geometry = load_geometry(geometry)
+    # adding 0. turns -0. into 0. which has a different WKB
+    geometry = shapely.transform(geometry, lambda coords: np.round(coords, decimals) + 0.)
+    geometry = shapely.normalize(geometry)
+    return hashlib.md5(shapely.to_wkb(geometry, byte_order=1, include_srid=False)).hexdigest()
+
+
+def geometry_ewkb(geometry, srid=3577):
+    """ Return a shapely geometry as EWKB bytes carrying srid """
+    return shapely.to_wkb(shapely.set_srid(geometry, srid), include_srid=True)
+
+
+def geometry_param(geometry, srid=3577):
+    """ Return the geometry as an sql parameter to be cast with ::geometry.
+    Strings are passed through as they are expected to be EWKT already, (E)WKB
+    bytes and shapely geometries are sent as bytea, which postgis casts without
+    parsing text. WKB bytes, which carry no SRID, are given srid.
+    """
+    if isinstance(geometry, str):
+        return geometry
+    if isinstance(geometry, (bytes, bytearray, memoryview)):
+        parsed = load_geometry(geometry)
+        if shapely.get_srid(parsed) != 0:
+            return psycopg2.Binary(bytes(geometry))
+        geometry = parsed
+    return psycopg2.Binary(geometry_ewkb(geometry, srid))
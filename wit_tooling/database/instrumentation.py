@@ -0,0 +1,153 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero Public License for more details.
+#
+# You should have received a copy of the GNU Affero Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+
+import bisect
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import psycopg2.extensions
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+METRICS = {
+    'wit_db_acquire_wait_seconds': ('Time waiting for a connection from the policy', SECONDS_BUCKETS),
+    'wit_db_hold_seconds': ('Time a connection is held until it is released', SECONDS_BUCKETS),
+    'wit_db_statement_seconds': ('Execution time of a statement including the transfer of its rows', SECONDS_BUCKETS),
+    'wit_db_statement_rows': ('Rows returned or affected by a statement', ROWS_BUCKETS),
+}
+""" name -> (help, bucket upper bounds) of the recorded histograms """
+
+
+class Histogram(object):
+    """ Counts of observations per bucket, with their sum and count """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """ retval: dict of count, sum and the cumulative count per upper bound """
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return dict(count=self.count, sum=self.sum, buckets=buckets)
+
+
+class Instrumentation(object):
+    """ Histograms of the METRICS tagged by the name of the method that
+    acquired the connection, see enableInstrumentation in connection.py
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, tag, value):
+        with self._lock:
+            histogram = self._histograms.get((metric, tag))
+            if histogram is None:
+                histogram = self._histograms[(metric, tag)] = Histogram(METRICS[metric][1])
+            histogram.observe(value)
+
+    def snapshot(self):
+        """ retval: {metric: {tag: Histogram.snapshot()}} """
+        result = {}
+        with self._lock:
+            for (metric, tag), histogram in sorted(self._histograms.items()):
+                result.setdefault(metric, {})[tag] = histogram.snapshot()
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def to_prometheus(self):
+        """ retval: the histograms in the Prometheus text exposition format """
+        lines = []
+        for metric, tags in self.snapshot().items():
+            lines.append('# HELP %s %s' % (metric, METRICS[metric][0]))
+            lines.append('# TYPE %s histogram' % (metric,))
+            for tag, histogram in tags.items():
+                label = 'method="%s"' % (tag.replace('\\', '\\\\').replace('"', '\\"'),)
+                for bound, count in histogram['buckets'].items():
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (metric, label, le, count))
+                lines.append('%s_sum{%s} %r' % (metric, label, float(histogram['sum'])))
+                lines.append('%s_count{%s} %s' % (metric, label, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """ Write the histograms to a textfile of the node exporter, replacing it
+        at once so that it is never read half written
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """ Cursor recording the time and row count of every statement into
+    instrumentation under tag, both are set by ConnectionFactory.get
+    """
+
+    instrumentation = None
+    tag = None
+
+    def execute(self, query, vars=None):
+        start = time.monotonic()
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        finally:
+            self._record(start)
+
+    def executemany(self, query, vars_list):
+        start = time.monotonic()
+        try:
+            return super(InstrumentedCursor, self).executemany(query, vars_list)
+        finally:
+            self._record(start)
+
+    def _record(self, start):
+        if self.instrumentation is None:
+            return
+        self.instrumentation.observe('wit_db_statement_seconds', self.tag, time.monotonic() - start)
+        if self.rowcount >= 0:
+            self.instrumentation.observe('wit_db_statement_rows', self.tag, self.rowcount)
+
+
+def caller_name(skip_file, skip_names=()):
+    """ Name of the innermost function on the stack outside skip_file that is
+    not private nor in skip_names, e.g. the DIO method behind _read_connection
+    or _update_events
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename != skip_file and code.co_name[0] not in '_<' and code.co_name not in skip_names:
+            return code.co_name
+        frame = frame.f_back
+    return 'unknown'
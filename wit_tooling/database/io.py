@@ -11,18 +11,30 @@
 # along with this program.  If not, see http://www.gnu.org/licenses.
 
 import collections
+import contextlib
+import hashlib
+import json
 import logging
+import random
+import re
 import sys
+import threading
+import time
 import traceback
 import uuid
 import os
+import weakref
 from subprocess import call
 import psycopg2
 from time import sleep
 import numpy as np
 from psycopg2.extensions import register_adapter, AsIs
+from psycopg2.extras import execute_values
 
-from .connection import ConnectionFactory
+from .cache import DiskStore, MemoryStore, ResultCache, cached_result
+from .connection import ConnectionFactory, as_timestamp, get_database_args
+from .geometry import geometry_hash, geometry_param
+from .instrumentation import caller_name
 from .special_sql import *
 
 _LOGGER = logging.getLogger(__name__)
@@ -55,7 +67,8 @@ class DIO(object):
     data table.
     field     description
     ---------------------------------------------------------------------------
-    item_id: Generated by the database when a new item is entered
+    item_id: Generated by the database when a new item is entered (not in the
+             compact layout, where (poly_id, datetime) is the primary key)
     poly_id: Generated id of polygon when a new polygon is entered
     datetime: Datetime of the data
     fc_bs: BS from fractional cover
@@ -91,6 +104,11 @@ class DIO(object):
         def __init__(self):
             super().__init__()
 
+            self.compact = False
+            """ True if the table uses the compact layout: REAL values, no item_id
+            and a covering primary key on (poly_id, datetime)
+            """
+
 
     class PolyTableInfo(TableInfoBase):
         def __init__(self):
@@ -124,10 +142,22 @@ class DIO(object):
         def __init__(self):
             super().__init__()
 
+    class InundationInfo(TableInfoBase):
+        def __init__(self):
+            super().__init__()
+
     class CatchmentInfo(TableInfoBase):
         def __init__(self):
             super().__init__()
 
+    class CatchmentMemberInfo(TableInfoBase):
+        def __init__(self):
+            super().__init__()
+
+    class SourceInfo(TableInfoBase):
+        def __init__(self):
+            super().__init__()
+
     class LandsatInfo(TableInfoBase):
         def __init__(self):
             super().__init__()
@@ -141,6 +171,54 @@ class DIO(object):
     #  something of the form "client_jobs_v2_suffix".
     _DB_ROOT_NAME = 'wit_test'
 
+    # Create the data table in the compact layout, see DataTableInfo.compact.
+    #  It only applies when the table is created, an existing table is used
+    #  with whatever layout it has.
+    _COMPACT_DATA = os.getenv('WIT_DB_COMPACT_DATA', 'false').lower() in ('1', 'true', 'yes')
+
+    # PREPARE the hot statements once per connection and EXECUTE them by name.
+    #  Set it to false behind pgbouncer in transaction mode, where the next
+    #  transaction may run on a server connection that hasn't prepared them.
+    _PREPARED_STATEMENTS = os.getenv('WIT_DB_PREPARED_STATEMENTS', 'true').lower() in ('1', 'true', 'yes')
+
+    # Number of geometries kept in the cache of get_id_by_geom, 0 to disable it.
+    #  The cache is per process, result_ready updated by other processes is
+    #  only seen once the entry is evicted.
+    _ID_CACHE_SIZE = int(os.getenv('WIT_DB_ID_CACHE_SIZE', '4096'))
+
+    # Cache the results of the metric readers, 'memory' or a directory shared
+    #  by the processes on this host, see enable_result_cache. The results are
+    #  dropped when the metrics generation changes.
+    _RESULT_CACHE = os.getenv('WIT_DB_RESULT_CACHE', '')
+    _RESULT_CACHE_SIZE = int(os.getenv('WIT_DB_RESULT_CACHE_SIZE', '256'))
+    _RESULT_CACHE_MB = int(os.getenv('WIT_DB_RESULT_CACHE_MB', '1024'))
+
+    # Append the statements of get_matching_rows and execute_prepared slower
+    #  than WIT_DB_SLOW_QUERY_MS to this JSONL file, with the EXPLAIN (ANALYZE,
+    #  BUFFERS) plan of the WIT_DB_SLOW_QUERY_SAMPLE fraction of them. EXPLAIN
+    #  ANALYZE runs the statement again, in a savepoint that is rolled back.
+    _SLOW_QUERY_LOG = os.getenv('WIT_DB_SLOW_QUERY_LOG', '')
+    _SLOW_QUERY_MS = float(os.getenv('WIT_DB_SLOW_QUERY_MS', '1000'))
+    _SLOW_QUERY_SAMPLE = float(os.getenv('WIT_DB_SLOW_QUERY_SAMPLE', '0.1'))
+
+    # Version of the tables created by init_tables, to be increased with any
+    #  change of init_tables. Processes finding it in schema_version skip
+    #  init_tables.
+    _SCHEMA_VERSION = 3
+
+    # The time series scaled by the area of the polygon in ha, the area is
+    #  computed once per polygon.
+    _AREA_QUERY = "SELECT b.poly_id, datetime, a.area, a.area*fc_bs, a.area*fc_npv, a.area*fc_pv, "\
+            " a.area*tci_w, a.area*wofs_water FROM (SELECT poly_id, ST_Area(geometry)/10000 AS area "\
+            " FROM %s WHERE poly_id = ANY(%%s::int[])) AS a, %s AS b WHERE b.poly_id = a.poly_id "\
+            " ORDER BY b.poly_id ASC, datetime ASC"
+    _AREA_FIELDS = ['poly_id', 'datetime', 'area', 'fc_bs', 'fc_npv', 'fc_pv', 'tci_w', 'wofs_water']
+    _AREA_DTYPES = ['int64', 'datetime64[us]'] + ['float64'] * 6
+
+    # The typed time series, see rows_to_columns
+    _DATA_FIELDS = ['datetime', 'fc_bs', 'fc_npv', 'fc_pv', 'tci_w', 'wofs_water']
+    _DATA_DTYPES = ['datetime64[us]'] + ['float32'] * 5
+
     @classmethod
     def get_db_name(cls):
         return cls._DB_ROOT_NAME
@@ -207,12 +285,53 @@ class DIO(object):
         self.incomplete_event = self.IncompleteEventInfo()
         self.incomplete_event.tableName = 'incomplete_event'
 
+        self.inundation_year = self.InundationInfo()
+        self.inundation_year.tableName = 'inundation_year'
+
         self.catchment = self.CatchmentInfo()
         self.catchment.tableName = 'catchments'
 
+        self.catchment_members = self.CatchmentMemberInfo()
+        self.catchment_members.tableName = 'catchment_members'
+
+        self.poly_sources = self.SourceInfo()
+        self.poly_sources.tableName = 'poly_sources'
+
         self.landsat_path = self.LandsatInfo()
         self.landsat_path.tableName = 'landsat_path'
 
+        # get_id_by_geom cache of (table_name, geometry_hash) -> row, and
+        #  (table_name, id) -> key to drop changed rows; shared by the threads
+        #  of the dashboards, hence the lock
+        self._id_cache = collections.OrderedDict()
+        self._id_cache_keys = {}
+        self._id_cache_lock = threading.Lock()
+
+        # reads only use the read endpoint if it has seen the polygons updated
+        #  up to this timestamp, see ReadWriteSplitPolicy; set to the newest
+        #  update committed by insert_update_result
+        self.read_fresh_after = None
+        # connection handed out by _read_connection in this thread, see
+        #  _pin_read_connection
+        self._pinned_read = threading.local()
+
+        # names of the statements prepared on each connection, prepared
+        #  statements live as long as the connection
+        self._prepared = weakref.WeakKeyDictionary()
+
+        # slow query log, see _SLOW_QUERY_LOG and enable_slow_query_log
+        self.slow_query_log = self._SLOW_QUERY_LOG or None
+        self.slow_query_ms = self._SLOW_QUERY_MS
+        self.slow_query_sample = self._SLOW_QUERY_SAMPLE
+        self._slow_query_lock = threading.Lock()
+
+        # cache of the metric readers, None to always query
+        self.result_cache = None
+        if self._RESULT_CACHE == 'memory':
+            self.enable_result_cache()
+        elif self._RESULT_CACHE != '':
+            self.enable_result_cache(directory=self._RESULT_CACHE)
+
     @property
     def data_tablename(self):
         return self.data.tableName
@@ -222,18 +341,45 @@ class DIO(object):
         return self.polygons.tableName
 
     def connect(self):
+        """ Initialize the tables, unless schema_version says they are current
+        which takes a single query
         """
-        """
-        # Initialize tables, if needed
         with ConnectionFactory.get() as conn:
-            # Initialize tables
-            self.init_tables(conn=conn)
+            if self._schema_is_current(conn):
+                return
+
+            # only one process initializes the tables, the others wait for the
+            #  lock and find them current
+            conn.cursor.execute("SELECT pg_advisory_lock(1)")
+            try:
+                if not self._schema_is_current(conn):
+                    self.init_tables(conn=conn)
+                conn.dbConn.commit()
+            finally:
+                conn.dbConn.rollback()
+                conn.cursor.execute("SELECT pg_advisory_unlock(1)")
 
         return
 
+    def _schema_is_current(self, conn):
+        """ Check schema_version against _SCHEMA_VERSION and pick up the layout
+        of the data table recorded by init_tables
+        """
+        try:
+            conn.cursor.execute("SELECT version, data_compact FROM schema_version")
+            row = conn.cursor.fetchall()
+        except psycopg2.ProgrammingError:
+            conn.dbConn.rollback()
+            return False
+        if len(row) == 0 or row[0][0] < self._SCHEMA_VERSION:
+            return False
+        self.data.compact = row[0][1]
+        return True
+
 
     def init_tables(self, conn):
-        """ Initialize tables, if needed
+        """ Initialize tables, if needed, and record _SCHEMA_VERSION. The caller
+        holds advisory lock 1, see connect.
 
         Parameters:
         ----------------------------------------------------------------
@@ -253,25 +399,11 @@ class DIO(object):
         output = conn.cursor.fetchall()
         matview_names = [x[0] for x in output]
 
-        # only one process can create table
-        lock = False
-        if self.data_tablename not in table_names or self.poly_tablename not in table_names:
-            conn.cursor.execute("SELECT pg_try_advisory_lock(1)")
-            row = conn.cursor.fetchall()
-            lock = row[0][0]
-
-        # wait table to be created by some process
-        if not lock:
-            while self.data_tablename not in table_names or self.poly_tablename not in table_names:
-                conn.cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema='public'")
-                output = conn.cursor.fetchall()
-                table_names = [x[0] for x in output]
-
         # ------------------------------------------------------------------------
         # Create the models table if it doesn't exist
         # Fields that start with '_eng' are intended for private use by the engine
         #  and should not be used by the UI
-        if self.poly_tablename not in table_names and lock:
+        if self.poly_tablename not in table_names:
             self._logger.info("Creating table %r", self.poly_tablename)
             fields = [
               "poly_id          BIGSERIAL",
@@ -297,12 +429,35 @@ class DIO(object):
             query = "CREATE INDEX polygons_gix ON %s USING GIST (%s)" % \
                     (self.poly_tablename, ",".join(['geometry']))
             conn.cursor.execute(query)
+        else:
+            # polygons inserted before geometry_hash are keyed by ST_GeoHash,
+            #  register_polygons wouldn't find them
+            self.rehash_polygons(conn=conn)
 
         # ------------------------------------------------------------------------
         # Create the jobs table if it doesn't exist
         # Fields that start with '_eng' are intended for private use by the engine
         #  and should not be used by the UI
-        if self.data_tablename not in table_names and lock:
+        if self.data_tablename not in table_names and self._COMPACT_DATA:
+            # values are fractions in [0, 1], REAL keeps more precision than we
+            # measure; the covering key makes time series reads index-only scans
+            self._logger.info("Creating compact table %r", self.data_tablename)
+            fields = [
+              "poly_id    INT NOT NULL REFERENCES polygons (poly_id)",
+              "datetime     TIMESTAMP WITHOUT TIME ZONE NOT NULL",
+              "fc_bs        REAL DEFAULT 0",
+              "fc_pv        REAL DEFAULT 0",
+              "fc_npv       REAL DEFAULT 0",
+              "tci_w        REAL DEFAULT 0",
+              "wofs_water   REAL DEFAULT 0",
+              "PRIMARY KEY (poly_id, datetime) INCLUDE (fc_bs, fc_pv, fc_npv, tci_w, wofs_water)"
+              ]
+
+            query = "CREATE TABLE %s (%s)" % \
+                      (self.data_tablename, ",".join(fields))
+            conn.cursor.execute(query)
+
+        elif self.data_tablename not in table_names:
             self._logger.info("Creating table %r", self.data_tablename)
             fields = [
               "item_id    BIGSERIAL",
@@ -321,56 +476,74 @@ class DIO(object):
                       (self.data_tablename, ",".join(fields))
             conn.cursor.execute(query)
 
-        if lock:
-            conn.dbConn.commit()
-            conn.cursor.execute("SELECT pg_advisory_unlock(1)")
+        conn.dbConn.commit()
         # ---------------------------------------------------------------------
         # Get the field names for each table
         conn.cursor.execute("SELECT column_name from information_schema.columns WHERE table_name='%s'" % (self.data_tablename))
         fields = conn.cursor.fetchall()
         self.data.dbFieldNames = [str(field[0]) for field in fields]
+        self.data.compact = 'item_id' not in self.data.dbFieldNames
 
         conn.cursor.execute("SELECT column_name from information_schema.columns WHERE table_name='%s'" % (self.poly_tablename))
         fields = conn.cursor.fetchall()
         self.polygons.dbFieldNames = [str(field[0]) for field in fields]
 
-        if self.alltime_metrics.tableName not in matview_names:
-            conn.cursor.execute(alltime_count_view)
-
-        if self.first_observe.tableName not in matview_names:
-            conn.cursor.execute(first_observe_view)
-
-        if self.year_metrics.tableName not in matview_names:
-            conn.cursor.execute(year_metric_view)
-
-
+        conn.cursor.execute(metrics_version_table)
+        conn.cursor.execute(metrics_version_row)
+        conn.cursor.execute("DROP SEQUENCE IF EXISTS metrics_generation")
+
+        # the metrics used to be materialized views that were never refreshed,
+        # they are tables maintained on insert now
+        metric_tables = [(self.alltime_metrics.tableName, alltime_count_table),
+                         (self.first_observe.tableName, first_observe_table),
+                         (self.year_metrics.tableName, year_metric_table)]
+        backfill = False
+        for table_name, create_table in metric_tables:
+            if table_name in table_names:
+                continue
+            self._logger.info("Creating table %r", table_name)
+            if table_name in matview_names:
+                conn.cursor.execute("DROP MATERIALIZED VIEW %s" % (table_name,))
+            conn.cursor.execute(create_table)
+            backfill = True
+        conn.dbConn.commit()
+        if backfill:
+            self._refresh_metrics(conn, None)
+
+
+        populate_events = False
         if self.event_metrics_time.tableName not in table_names:
-            # this is messy and you don't want this
             conn.cursor.execute(event_metrics_time_table)
-            conn.dbConn.commit()
-            # popularize the table
-            conn.cursor.execute(first_event_metrics)
-            conn.dbConn.commit()
-            conn.cursor.execute("SELECT count(poly_id) from %s" % (self.event_metrics_time.tableName))
-            last_size = conn.cursor.fetchall()[0][0]
-            this_size = 0
-            while last_size != this_size:
-                last_size = this_size
-                conn.cursor.execute(update_event_metrics)
-                conn.dbConn.commit()
-                conn.cursor.execute("SELECT count(poly_id) from %s" % (self.event_metrics_time.tableName))
-                this_size = conn.cursor.fetchall()[0][0]
+            populate_events = True
 
         if self.incomplete_event.tableName not in table_names:
             conn.cursor.execute(incomplete_event_table)
-            conn.cursor.execute("alter table incomplete_event add primary key (event_id)")
-            conn.cursor.execute("alter table incomplete_event add constraint incomplete_event_fk foreign" \
+            conn.cursor.execute("alter table incomplete_event add constraint incomplete_event_fk foreign " \
                     "key (poly_id) references polygons (poly_id)")
-            conn.cursor.execute(update_incomplete_event)
+            populate_events = True
+
+        # event_metrics used to be a materialized view, it is a table maintained
+        # together with the events now and inundation_year is derived from it
+        derive_events = False
+        if self.event_metrics.tableName not in table_names:
+            self._logger.info("Creating table %r", self.event_metrics.tableName)
+            if self.event_metrics.tableName in matview_names:
+                conn.cursor.execute("DROP MATERIALIZED VIEW %s" % (self.event_metrics.tableName,))
+            conn.cursor.execute(event_metrics_table)
+            conn.cursor.execute(event_metrics_index)
+            derive_events = True
+
+        if self.inundation_year.tableName not in table_names:
+            self._logger.info("Creating table %r", self.inundation_year.tableName)
+            conn.cursor.execute(inundation_year_table)
+            derive_events = True
+
+        if populate_events:
             conn.dbConn.commit()
-
-        if self.event_metrics.tableName not in matview_names:
-            conn.cursor.execute(event_metrics_view)
+            self._update_events(conn, None)
+        elif derive_events:
+            conn.dbConn.commit()
+            self._derive_events(conn, None)
 
         if self.catchment.tableName not in table_names:
             self._logger.info("Creating table %r", self.catchment.tableName)
@@ -392,6 +565,19 @@ class DIO(object):
                     (self.catchment.tableName, ",".join(['geometry']))
             conn.cursor.execute(query)
 
+        # polygons contained by each catchment, maintained on insert of either
+        if self.poly_sources.tableName not in table_names:
+            self._logger.info("Creating table %r", self.poly_sources.tableName)
+            conn.cursor.execute(poly_sources_table)
+
+        if self.catchment_members.tableName not in table_names:
+            self._logger.info("Creating table %r", self.catchment_members.tableName)
+            conn.cursor.execute(catchment_members_table)
+            conn.cursor.execute(catchment_members_index)
+            conn.cursor.execute(insert_poly_sources % ("TRUE",))
+            conn.cursor.execute(insert_catchment_members % ("TRUE",))
+            conn.dbConn.commit()
+
         if self.landsat_path.tableName not in table_names:
             self._logger.info("Creating table %r", self.landsat_path.tableName)
             fields = [
@@ -410,6 +596,10 @@ class DIO(object):
                     (self.landsat_path.tableName, ",".join(['geometry']))
             conn.cursor.execute(query)
 
+        conn.cursor.execute(schema_version_table)
+        conn.cursor.execute("DELETE FROM schema_version")
+        conn.cursor.execute("INSERT INTO schema_version (version, data_compact) VALUES (%s, %s)",
+                (self._SCHEMA_VERSION, self.data.compact))
         return
 
     def construct_query(self, tableInfo, fieldsToMatch, selectFieldNames, func=None, maxRows=None):
@@ -468,9 +658,15 @@ class DIO(object):
             sqlParams.append(maxRows)
         return query, sqlParams, maxRows
 
-    def get_matching_rows(self, conn, query, sqlParams, maxRows):
-        conn.cursor.execute(query, sqlParams)
+    def get_matching_rows(self, conn, query, sqlParams, maxRows, prepared=False):
+        start = time.monotonic()
+        if prepared:
+            self.execute_prepared(conn, query, sqlParams)
+        else:
+            conn.cursor.execute(query, sqlParams)
         rows = conn.cursor.fetchall()
+        if not prepared:
+            self._log_slow_query(conn, query, sqlParams, start)
         if rows:
             assert maxRows is None or len(rows) <= maxRows, "%d !<= %d" % (
               len(rows), maxRows)
@@ -478,6 +674,132 @@ class DIO(object):
             rows = tuple()
         return rows
 
+    def _read_connection(self):
+        """ Acquire a connection for read only queries, which goes to the read
+        endpoint if the connection policy has one and it is fresh enough. Within
+        _pin_read_connection it is the pinned connection.
+        """
+        pinned = getattr(self._pinned_read, 'conn', None)
+        if pinned is not None:
+            return contextlib.nullcontext(pinned)
+        return ConnectionFactory.get(readonly=True, fresh_after=self.read_fresh_after)
+
+    @contextlib.contextmanager
+    def _pin_read_connection(self):
+        """ Acquire a read connection which _read_connection returns in this
+        thread until the block ends, so that several reads go to the same endpoint
+        in order, e.g. the metrics generation and the result cached under it.
+        """
+        previous = getattr(self._pinned_read, 'conn', None)
+        with self._read_connection() as conn:
+            self._pinned_read.conn = conn
+            try:
+                yield conn
+            finally:
+                self._pinned_read.conn = previous
+
+    def execute_prepared(self, conn, query, sqlParams):
+        """ Execute the query as a prepared statement, named after the hash of the
+        query and prepared on first use on the connection. Falls back to a plain
+        execute if prepared statements are disabled.
+
+        Parameters:
+        ----------------------------------------------------------------
+        conn:           ConnectionWrapper
+        query:          sql with %s placeholders only, so that the same query text
+                          is used for any parameters; use = ANY(%s) instead of IN %s
+        sqlParams:      sequence of parameters
+        """
+        start = time.monotonic()
+        if not self._PREPARED_STATEMENTS:
+            conn.cursor.execute(query, sqlParams)
+            self._log_slow_query(conn, query, sqlParams, start)
+            return
+
+        name = 'wit_' + hashlib.md5(query.encode()).hexdigest()[:16]
+        prepared = self._prepared.setdefault(conn.dbConn, set())
+        if name not in prepared:
+            count = iter(range(1, len(sqlParams) + 1))
+            conn.cursor.execute("PREPARE %s AS %s" % (name, re.sub('%s', lambda m: '$%d' % next(count), query)))
+            prepared.add(name)
+            self._logger.debug('prepared %s: %s' % (name, _abbreviate(query, 80)))
+        conn.cursor.execute("EXECUTE %s (%s)" % (name, ', '.join(['%s'] * len(sqlParams))), sqlParams)
+        self._log_slow_query(conn, query, sqlParams, start)
+
+    def enable_slow_query_log(self, path, threshold_ms=None, sample=None):
+        """ Log the statements slower than threshold_ms, see _SLOW_QUERY_LOG
+
+        Parameters:
+        ----------------------------------------------------------------
+        path:           JSONL file the statements are appended to, None to disable
+        threshold_ms:   minimal duration of a logged statement, WIT_DB_SLOW_QUERY_MS if None
+        sample:         fraction of the logged statements explained, WIT_DB_SLOW_QUERY_SAMPLE if None
+        """
+        self.slow_query_log = path
+        if threshold_ms is not None:
+            self.slow_query_ms = threshold_ms
+        if sample is not None:
+            self.slow_query_sample = sample
+
+    def _log_slow_query(self, conn, query, sqlParams, start):
+        if self.slow_query_log is None:
+            return
+        duration = (time.monotonic() - start) * 1000
+        if duration < self.slow_query_ms:
+            return
+
+        record = collections.OrderedDict()
+        record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        record['pid'] = os.getpid()
+        record['method'] = caller_name(None, ('get_matching_rows', 'execute_prepared'))
+        record['duration_ms'] = round(duration, 3)
+        record['query'] = query
+        record['params'] = self._summarize_params(sqlParams)
+        record['plan'] = None
+        if random.random() < self.slow_query_sample:
+            record['plan'] = self._explain(conn, query, sqlParams)
+        self._logger.info('slow query %s ms in %s' % (record['duration_ms'], record['method']))
+
+        line = json.dumps(record, default=str)
+        with self._slow_query_lock:
+            with open(self.slow_query_log, 'a') as f:
+                f.write(line + '\n')
+
+    @classmethod
+    def _summarize_params(cls, value):
+        """ Replace the binary parameters, e.g. EWKB geometries, by their size
+        and sha1 for the slow query log
+        """
+        if isinstance(value, psycopg2.Binary):
+            value = value.adapted
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value)
+            return '<bytes len=%s sha1=%s>' % (len(value), hashlib.sha1(value).hexdigest())
+        if isinstance(value, dict):
+            return {k: cls._summarize_params(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [cls._summarize_params(v) for v in value]
+        return value
+
+    def _explain(self, conn, query, sqlParams):
+        """ Run EXPLAIN (ANALYZE, BUFFERS) of the query in a savepoint, so that
+        the changes of a write are rolled back, and return the JSON plan
+        """
+        cursor = conn.dbConn.cursor()
+        try:
+            cursor.execute("SAVEPOINT wit_explain")
+            try:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, sqlParams)
+                return cursor.fetchall()[0][0]
+            finally:
+                cursor.execute("ROLLBACK TO SAVEPOINT wit_explain")
+                cursor.execute("RELEASE SAVEPOINT wit_explain")
+        except psycopg2.Error as e:
+            self._logger.warning('explain failed %s' % (e,))
+            return None
+        finally:
+            cursor.close()
+
     @classmethod
     def normalize_hash(cls, hashValue):
         hashLen = len(hashValue)
@@ -501,16 +823,17 @@ class DIO(object):
         poly_id = 0
         query = "INSERT  INTO %s (poly_name, poly_hash, geometry, " \
                 " shapefile, feature_id, result_ready, last_update) " \
-                " VALUES (%%s, ST_GeoHash(ST_Transform(%%s::geometry, 4326), 32), %%s, %%s, %%s, FALSE, to_timestamp(0)) " \
+                " VALUES (%%s, %%s, %%s::geometry, %%s, %%s, FALSE, to_timestamp(0)) " \
                 " RETURNING poly_id, result_ready" \
                 % (self.poly_tablename,)
-        sqlParams = (poly_name, geometry, geometry, shapefile, feature_id)
+        sqlParams = (poly_name, geometry_hash(geometry), geometry_param(geometry), shapefile, feature_id)
         conn.cursor.execute(query, sqlParams)
         numRowsInserted = conn.cursor.fetchall()
         assert len(numRowsInserted) == 1, 'Unexpected num fields: ' + repr(len(numRowsInserted))
 
         poly_id = numRowsInserted[0][0]
         state = numRowsInserted[0][1]
+        self._update_catchment_members(conn, poly_list=[poly_id])
         self._logger.debug('polygon insert %s' %(poly_id))
         return poly_id, state
 
@@ -523,6 +846,9 @@ class DIO(object):
             query += key + "=%s"
             if key == 'last_update':
                 query += key + "=to_timestamp(%%s, 'YYYY-MM-DD HH24:MI:SS.US') "
+            if key == 'geometry':
+                query += "::geometry"
+                value = geometry_param(value)
             sqlParams += (value, )
         sqlParams += (poly_id, )
 
@@ -530,6 +856,11 @@ class DIO(object):
                 " RETURNING poly_id"
         conn.cursor.execute(query, sqlParams)
         numRowsAffected = conn.cursor.fetchall()
+        self._forget_id(self.poly_tablename, int(poly_id))
+        if 'geometry' in kwargs or 'shapefile' in kwargs:
+            self._update_catchment_members(conn, poly_list=[int(poly_id)])
+        if 'geometry' in kwargs or 'poly_name' in kwargs:
+            self._bump_generation(conn)
 
         if len(numRowsAffected) == 1:
             poly_id = numRowsAffected[0][0]
@@ -543,21 +874,18 @@ class DIO(object):
         The combination of poly_id and datetime are expected to be unique (enforced
         by a unique index on the two columns).
         retval:           item_id of the inserted data row, or of an existing data entry row
-                           with matching poly_id/datetime key
+                           with matching poly_id/datetime key; poly_id of the inserted row
+                           if the data table is compact
         """
 
-        # Create a new data entry
+        # Create a new data entry, alltime_count, first_observe and year_metrics
+        #  are updated by the same statement
         item_id = 0
-        query = "INSERT  INTO %s (poly_id, datetime, fc_bs, fc_pv," \
-                " fc_npv, tci_w, wofs_water) " \
-                " VALUES (%%s, to_timestamp(%%s, 'YYYY-MM-DD HH24:MI:SS.US'), %%s, %%s, %%s, %%s, %%s) " \
-                " ON CONFLICT DO NOTHING " \
-                " RETURNING item_id" \
-                % (self.data_tablename,)
+        query = insert_data_with_metrics % ('poly_id' if self.data.compact else 'item_id',)
 
         sqlParams = (poly_id, datetime, fc_bs, fc_pv, fc_npv, tci_w, wofs_water)
 
-        conn.cursor.execute(query, sqlParams)
+        self.execute_prepared(conn, query, sqlParams)
         numRowsInserted = conn.cursor.fetchall()
 
         if len(numRowsInserted) == 1:
@@ -589,11 +917,12 @@ class DIO(object):
                 " RETURNING result_ready" \
                 % (self.poly_tablename,)
         sqlParams = (ready, update_time, poly_id, update_time)
-        conn.cursor.execute(query, sqlParams)
+        self.execute_prepared(conn, query, sqlParams)
         numRowsAffected = conn.cursor.fetchall()
 
         if len(numRowsAffected) == 1:
             state = numRowsAffected[0][0]
+            self._forget_id(self.poly_tablename, int(poly_id))
         return state
 
     def insert_get_catchment(self, conn, catchment_name,  shapefile, feature_id, geometry):
@@ -607,26 +936,30 @@ class DIO(object):
         """
         catchment_id = 0
         query = "INSERT  INTO %s (catchment_name, catchment_hash, shapefile, feature_id, geometry) " \
-                " VALUES (%%s, ST_GeoHash(ST_Transform(%%s::geometry, 4326), 32), %%s, %%s, %%s) " \
+                " VALUES (%%s, ST_GeoHash(ST_Transform(%%s::geometry, 4326), 32), %%s, %%s, %%s::geometry) " \
                 " ON CONFLICT (catchment_hash) DO UPDATE SET catchment_name=%%s" \
                 " RETURNING catchment_id" \
                 % (self.catchment.tableName,)
+        geometry = geometry_param(geometry)
         sqlParams = (catchment_name, geometry, shapefile, feature_id, geometry, catchment_name)
         conn.cursor.execute(query, sqlParams)
         numRowsInserted = conn.cursor.fetchall()
         assert len(numRowsInserted) == 1, 'Unexpected num fields: ' + repr(len(numRowsInserted))
 
         catchment_id = numRowsInserted[0][0]
+        self._forget_id(self.catchment.tableName, catchment_id)
+        self._update_catchment_members(conn, catchment_id=catchment_id)
         self._logger.debug('catchment insert %s' %(catchment_id))
         return catchment_id
 
     def insert_get_landsat_pathrow(self, conn, pathrow_label, geometry):
         pathrow_id = 0
         query = "INSERT  INTO %s (pathrow_label, pathrow_hash, geometry) " \
-                " VALUES (%%s, ST_GeoHash(%%s::geometry, 32), %%s) " \
+                " VALUES (%%s, ST_GeoHash(%%s::geometry, 32), %%s::geometry) " \
                 " ON CONFLICT (pathrow_hash) DO UPDATE SET pathrow_label=%%s" \
                 " RETURNING pathrow_id" \
                 % (self.landsat_path.tableName,)
+        geometry = geometry_param(geometry)
         sqlParams = (pathrow_label, geometry, geometry, pathrow_label)
         conn.cursor.execute(query, sqlParams)
         numRowsInserted = conn.cursor.fetchall()
@@ -637,13 +970,115 @@ class DIO(object):
         return pathrow_id
 
     def insert_polygon(self, poly_name, geometry, shapefile, feature_id):
-        poly_id, poly_name, state = self.get_id_by_geom(self.poly_tablename, geometry)
+        poly_id, _, state = self.get_id_by_geom(self.poly_tablename, geometry, readonly=False)
         if poly_id > 0:
             return poly_id, state
         with ConnectionFactory.get() as conn:
             poly_id, state = self.insert_get_polygon(conn, poly_name, geometry, shapefile, feature_id)
         return poly_id, state
 
+    def register_polygons(self, features, batch_size=1000):
+        """ Register polygons in batches, keyed by the client side geometry_hash
+        stored in poly_hash. Each batch is upserted with one statement, existing
+        polygons are returned as they are.
+
+        Parameters:
+        ----------------------------------------------------------------
+        features:       iterable of dicts with keys poly_name, geometry, shapefile and
+                          feature_id; geometry is a shapely geometry, EWKB or EWKT
+        batch_size:     number of features per statement
+        retval:         list of (poly_id, result_ready) in the order of features
+        """
+        features = list(features)
+        hashes = [geometry_hash(f['geometry']) for f in features]
+
+        # the same polygon can't be upserted twice in one statement
+        values = collections.OrderedDict()
+        for feature, poly_hash in zip(features, hashes):
+            if poly_hash not in values:
+                values[poly_hash] = (feature.get('poly_name'), poly_hash, geometry_param(feature['geometry']),
+                                     feature.get('shapefile'), feature.get('feature_id'))
+        values = list(values.values())
+
+        query = "WITH input (poly_name, poly_hash, geometry, shapefile, feature_id) AS (VALUES %%s), " \
+                " inserted AS (INSERT INTO %s (poly_name, poly_hash, geometry, shapefile, feature_id, " \
+                " result_ready, last_update) SELECT poly_name, poly_hash, geometry, shapefile, feature_id, " \
+                " FALSE, to_timestamp(0) FROM input ON CONFLICT (poly_hash) DO NOTHING " \
+                " RETURNING poly_id, poly_hash, result_ready) " \
+                " SELECT poly_id, poly_hash, result_ready, TRUE FROM inserted " \
+                " UNION ALL SELECT p.poly_id, p.poly_hash, p.result_ready, FALSE FROM %s AS p, input " \
+                " WHERE p.poly_hash = input.poly_hash" \
+                % (self.poly_tablename, self.poly_tablename)
+        template = "(%s::text, %s::text, %s::geometry, %s::text, %s::int)"
+
+        registered = {}
+        with ConnectionFactory.get() as conn:
+            for i in range(0, len(values), batch_size):
+                batch = values[i:i+batch_size]
+                rows = execute_values(conn.cursor, query, batch, template=template,
+                                      page_size=len(batch), fetch=True)
+                for poly_id, poly_hash, state, _ in rows:
+                    registered[poly_hash] = (poly_id, state)
+                inserted = [poly_id for poly_id, _, _, new in rows if new]
+                if len(inserted) > 0:
+                    self._update_catchment_members(conn, poly_list=inserted)
+                conn.dbConn.commit()
+
+            # polygons inserted by a concurrent transaction are neither inserted
+            # nor visible to the statement above
+            missing = tuple(set(hashes) - set(registered.keys()))
+            if len(missing) > 0:
+                query, sql_params, max_rows = self.construct_query(self.polygons,
+                        dict(poly_hash=missing), ['poly_id', 'poly_hash', 'result_ready'])
+                for poly_id, poly_hash, state in self.get_matching_rows(conn, query, sql_params, max_rows):
+                    registered[poly_hash] = (poly_id, state)
+
+        self._logger.debug('polygons registered %s' % (len(registered)))
+        return [registered[poly_hash] for poly_hash in hashes]
+
+    def rehash_polygons(self, batch_size=1000, conn=None):
+        """ Replace the server side ST_GeoHash keys of existing polygons with
+        geometry_hash, so that they are found by register_polygons. Run by
+        init_tables when upgrading the tables.
+
+        Parameters:
+        ----------------------------------------------------------------
+        batch_size:     number of polygons per statement
+        conn:           connection to run it in without committing, a new
+                          transaction per batch if None
+        retval:         number of polygons rehashed
+        """
+        select_query = "SELECT poly_id, ST_AsEWKB(geometry) FROM %s WHERE poly_id > %%s " \
+                " AND (poly_hash IS NULL OR poly_hash !~ '^[0-9a-f]{32}$') " \
+                " ORDER BY poly_id ASC LIMIT %%s" % (self.poly_tablename,)
+        update_query = "UPDATE %s AS p SET poly_hash = v.poly_hash FROM (VALUES %%s) AS v (poly_id, poly_hash) " \
+                " WHERE p.poly_id = v.poly_id AND NOT EXISTS " \
+                " (SELECT 1 FROM %s AS q WHERE q.poly_hash = v.poly_hash)" \
+                % (self.poly_tablename, self.poly_tablename)
+
+        def rehash_batch(conn, last_id):
+            rows = self.get_matching_rows(conn, select_query, (last_id, batch_size), None)
+            if len(rows) == 0:
+                return None, 0
+            values = {}
+            for poly_id, geometry in rows:
+                values.setdefault(geometry_hash(geometry), poly_id)
+            execute_values(conn.cursor, update_query, [(v, k) for k, v in values.items()],
+                           template="(%s::bigint, %s::text)", page_size=len(values))
+            return rows[-1][0], conn.cursor.rowcount
+
+        last_id = 0
+        total = 0
+        while last_id is not None:
+            if conn is None:
+                with ConnectionFactory.get() as batch_conn:
+                    last_id, count = rehash_batch(batch_conn, last_id)
+            else:
+                last_id, count = rehash_batch(conn, last_id)
+            total += count
+        self._logger.debug('polygons rehashed %s' % (total))
+        return total
+
     def update_polygon_geom(self, poly_id, geometry):
         with ConnectionFactory.get() as conn:
             poly_id = self.update_polygon(conn, poly_id, geometry=geometry)
@@ -657,6 +1092,7 @@ class DIO(object):
         with ConnectionFactory.get() as conn:
             conn.cursor.execute(query, params)
             row = conn.cursor.fetchall()
+            self._bump_generation(conn)
         assert len(row) == 1, 'Unexpected num fields: ' + repr(len(row))
         return row[0][0]
 
@@ -667,6 +1103,13 @@ class DIO(object):
                 item_id = self.insert_get_data(conn, int(poly_id), datetime, fc_bs, fc_pv, fc_npv, tci_w, wofs_water)
             else:
                 item_id = None
+            # the results of the polygon are complete, pick up its new events
+            if ready:
+                self._update_events(conn, int(poly_id))
+        # the reads of this process wait for the read endpoint to see the write
+        update_time = as_timestamp(datetime)
+        if self.read_fresh_after is None or update_time > as_timestamp(self.read_fresh_after):
+            self.read_fresh_after = update_time
         return item_id, state
 
     def insert_catchment(self, catchment_name, shapefile, feature_id, geometry):
@@ -679,9 +1122,88 @@ class DIO(object):
             pathrow_id = self.insert_get_landsat_pathrow(conn, pathrow_label, geometry)
         return pathrow_id
 
+    def refresh_metrics(self, poly_list=None, batch_size=10000):
+        """ Recompute alltime_count, first_observe and year_metrics of the given
+        polygons from the data table, e.g. for a backfill. They are kept current by
+        insert_get_data otherwise.
+
+        Parameters:
+        ----------------------------------------------------------------
+        poly_list:      poly_id or a list of them; all polygons if None
+        batch_size:     number of polygons recomputed per transaction
+        """
+        with ConnectionFactory.get() as conn:
+            self._refresh_metrics(conn, poly_list, batch_size)
+
+    def _refresh_metrics(self, conn, poly_list, batch_size=10000):
+        if poly_list is None:
+            conn.cursor.execute("SELECT poly_id FROM %s ORDER BY poly_id" % (self.poly_tablename,))
+            poly_list = [row[0] for row in conn.cursor.fetchall()]
+        elif not isinstance(poly_list, self._SEQUENCE_TYPES):
+            poly_list = [poly_list]
+        poly_list = list(poly_list)
+
+        for i in range(0, len(poly_list), batch_size):
+            sql_params = (tuple(poly_list[i:i+batch_size]),)
+            for table_name, refresh_query in [(self.alltime_metrics.tableName, refresh_alltime_count),
+                                             (self.first_observe.tableName, refresh_first_observe),
+                                             (self.year_metrics.tableName, refresh_year_metrics)]:
+                conn.cursor.execute("DELETE FROM %s WHERE poly_id IN %%s" % (table_name,), sql_params)
+                conn.cursor.execute(refresh_query, sql_params)
+            self._bump_generation(conn)
+            conn.dbConn.commit()
+            self._logger.debug('metrics refreshed %s' % (min(i+batch_size, len(poly_list))))
+
+    def update_events(self, poly_list=None, batch_size=1000):
+        """ Extract the wet events of the given polygons into event_metrics_time and
+        replace their incomplete_event. Only the data after the last closed event of
+        each polygon is scanned. event_metrics and inundation_year of the polygons
+        are rebuilt from the events.
+
+        Parameters:
+        ----------------------------------------------------------------
+        poly_list:      poly_id or a list of them; all polygons if None
+        batch_size:     number of polygons per statement
+        """
+        with ConnectionFactory.get() as conn:
+            self._update_events(conn, poly_list, batch_size)
+
+    def _update_events(self, conn, poly_list, batch_size=1000):
+        if poly_list is None:
+            conn.cursor.execute("SELECT poly_id FROM %s ORDER BY poly_id" % (self.poly_tablename,))
+            poly_list = [row[0] for row in conn.cursor.fetchall()]
+        elif not isinstance(poly_list, self._SEQUENCE_TYPES):
+            poly_list = [poly_list]
+        poly_list = list(poly_list)
+
+        for i in range(0, len(poly_list), batch_size):
+            conn.cursor.execute(update_events, dict(poly_list=tuple(poly_list[i:i+batch_size])))
+            self._derive_events(conn, poly_list[i:i+batch_size], batch_size)
+            self._logger.debug('events updated %s' % (min(i+batch_size, len(poly_list))))
+
+    def _derive_events(self, conn, poly_list, batch_size=1000):
+        if poly_list is None:
+            conn.cursor.execute("SELECT poly_id FROM %s ORDER BY poly_id" % (self.poly_tablename,))
+            poly_list = [row[0] for row in conn.cursor.fetchall()]
+        elif not isinstance(poly_list, self._SEQUENCE_TYPES):
+            poly_list = [poly_list]
+        poly_list = list(poly_list)
+
+        for i in range(0, len(poly_list), batch_size):
+            params = dict(poly_list=tuple(poly_list[i:i+batch_size]))
+            # the table refresh_event_metrics inserts into
+            conn.cursor.execute("DELETE FROM event_metrics WHERE poly_id IN %(poly_list)s", params)
+            conn.cursor.execute(refresh_event_metrics, params)
+            conn.cursor.execute("DELETE FROM %s WHERE poly_id IN %%(poly_list)s"
+                    % (self.inundation_year.tableName,), params)
+            conn.cursor.execute(refresh_inundation_year, params)
+            self._bump_generation(conn)
+            conn.dbConn.commit()
+
     def get_latest_time(self, poly_list):
         query, sql_params, max_rows = self.construct_query(self.polygons,
                 dict(poly_id=poly_list, result_ready=False), ['last_update'], func='max')
+        # the resume point of wit-cal, a lagging replica would make it redo or skip data
         with ConnectionFactory.get() as conn:
             row = self.get_matching_rows(conn, query, sql_params, max_rows)
         assert len(row) == 1, 'Unexpected num fields: ' + repr(len(row))
@@ -697,7 +1219,42 @@ class DIO(object):
         time = row[0][0]
         return time
 
-    def get_id_by_geom(self, table_name, geometry):
+    def get_id_by_geom(self, table_name, geometry, readonly=True):
+        """ Look up a polygon or catchment by its geometry. Polygons are looked up
+        by geometry_hash first and by ST_Equals if not found, catchments by
+        ST_Equals. Found ids are kept in an in-process LRU cache keyed by the hash.
+
+        Parameters:
+        ----------------------------------------------------------------
+        table_name:     polygons or catchments table name
+        geometry:       shapely geometry, (E)WKB bytes or (E)WKT
+        readonly:       may look it up on the read endpoint, see _read_connection
+        retval:         (poly_id, poly_name, result_ready) of a polygon or
+                          (catchment_id, catchment_name) of a catchment,
+                          (0, '', '') or (0, '') if not found
+        """
+        key = (table_name, geometry_hash(geometry))
+        cached = self._cached_id(key)
+        if cached is not None:
+            return cached
+
+        with self._read_connection() if readonly else ConnectionFactory.get() as conn:
+            row = ()
+            if table_name == self.polygons.tableName:
+                row = self._query_id(conn, table_name, "poly_hash = %s", key[1])
+            if len(row) == 0:
+                row = self._query_id(conn, table_name, "ST_Equals(geometry, %s::geometry)",
+                        geometry_param(geometry))
+
+        if len(row) == 0:
+            if table_name == self.catchment.tableName:
+                return 0, ''
+            elif table_name == self.polygons.tableName:
+                return 0, '', ''
+        self._cache_id(key, tuple(row[0]))
+        return tuple(row[0])
+
+    def _query_id(self, conn, table_name, condition, param):
         query = "SELECT %s, %s"
         if table_name == self.catchment.tableName:
             poly_id = 'catchment_id'
@@ -707,56 +1264,189 @@ class DIO(object):
             poly_name = 'poly_name'
             query += ", result_ready"
 
-        query += " from %s where ST_Equals(geometry, %%s::geometry)"
+        query += " from %s where " + condition.replace('%s', '%%s')
         query = query % (poly_id, poly_name, table_name)
-        sql_params = (geometry,)
-        with ConnectionFactory.get() as conn:
-            row = self.get_matching_rows(conn, query, sql_params, None)
-            if len(row) == 0:
-                if table_name == self.catchment.tableName:
-                    return 0, ''
-                elif table_name == self.polygons.tableName:
-                    return 0, '', ''
+        return self.get_matching_rows(conn, query, (param,), None)
+
+    def _cached_id(self, key):
+        with self._id_cache_lock:
+            value = self._id_cache.get(key)
+            if value is not None:
+                self._id_cache.move_to_end(key)
+            return value
+
+    def _cache_id(self, key, value):
+        if self._ID_CACHE_SIZE <= 0:
+            return
+        with self._id_cache_lock:
+            self._id_cache[key] = value
+            self._id_cache.move_to_end(key)
+            self._id_cache_keys[(key[0], value[0])] = key
+            while len(self._id_cache) > self._ID_CACHE_SIZE:
+                old_key, old_value = self._id_cache.popitem(last=False)
+                self._id_cache_keys.pop((old_key[0], old_value[0]), None)
+
+    def _forget_id(self, table_name, poly_id):
+        """ Drop a polygon or catchment from the id cache once its row changed """
+        with self._id_cache_lock:
+            key = self._id_cache_keys.pop((table_name, poly_id), None)
+            if key is not None:
+                self._id_cache.pop(key, None)
+
+    def get_ids_by_geoms(self, geometries):
+        """ Look up many polygons at once by their geometry_hash, going through the
+        cache of get_id_by_geom. Polygons not found by the hash, e.g. stored before
+        poly_hash was computed on the client, are looked up by ST_Equals.
 
-            poly_id = row[0][0]
-            poly_name = row[0][1]
-            if table_name == self.catchment.tableName:
-                return poly_id, poly_name
-            elif table_name == self.polygons.tableName:
-                return poly_id, poly_name, row[0][2]
+        Parameters:
+        ----------------------------------------------------------------
+        geometries:     list of shapely geometries or (E)WKT
+        retval:         list of (poly_id, poly_name, result_ready) in the order of
+                          geometries, (0, '', '') if not found
+        """
+        hashes = [geometry_hash(geometry) for geometry in geometries]
+        found = {}
+        for poly_hash in hashes:
+            cached = self._cached_id((self.poly_tablename, poly_hash))
+            if cached is not None:
+                found[poly_hash] = cached
+
+        missing = tuple(set(hashes) - set(found.keys()))
+        if len(missing) > 0:
+            query, sql_params, max_rows = self.construct_query(self.polygons,
+                    dict(poly_hash=missing), ['poly_hash', 'poly_id', 'poly_name', 'result_ready'])
+            with self._read_connection() as conn:
+                for poly_hash, poly_id, poly_name, state in self.get_matching_rows(conn, query, sql_params, max_rows):
+                    found[poly_hash] = (poly_id, poly_name, state)
+                    self._cache_id((self.poly_tablename, poly_hash), found[poly_hash])
+
+        result = []
+        for geometry, poly_hash in zip(geometries, hashes):
+            if poly_hash not in found:
+                found[poly_hash] = self.get_id_by_geom(self.poly_tablename, geometry)
+            result.append(found[poly_hash])
+        return result
 
-    def get_data_by_poly_id(self, poly_id):
-        query, sql_params, max_rows = self.construct_query(self.data,
-                dict(poly_id=poly_id), ['datetime', 'fc_bs', 'fc_npv', 'fc_pv', 'tci_w', 'wofs_water'])
-        query += " ORDER BY datetime ASC"
-        with ConnectionFactory.get() as conn:
-            row = self.get_matching_rows(conn, query, sql_params, max_rows)
-        return row
+    @staticmethod
+    def rows_to_columns(rows, fields, dtypes):
+        """ Decode rows into a dict of contiguous numpy columns, which pandas
+        takes as they are.
+
+        Parameters:
+        ----------------------------------------------------------------
+        rows:           sequence of row tuples
+        fields:         name of each column
+        dtypes:         numpy dtype of each column
+        retval:         OrderedDict of numpy arrays keyed by fields
+        """
+        columns = list(zip(*rows)) if len(rows) > 0 else [()] * len(fields)
+        result = collections.OrderedDict()
+        for name, dtype, column in zip(fields, dtypes, columns):
+            result[name] = np.array(column, dtype=dtype)
+        return result
+
+    def get_data_by_poly_id(self, poly_id, typed=False):
+        """ Get the time series of a polygon
+
+        Parameters:
+        ----------------------------------------------------------------
+        poly_id:        poly_id
+        typed:          return a dict of numpy columns, datetime as datetime64 and
+                          the values as float32, instead of rows
+        retval:         rows of (datetime, fc_bs, fc_npv, fc_pv, tci_w, wofs_water)
+                          ordered by datetime
+        """
+        if not isinstance(poly_id, self._SEQUENCE_TYPES):
+            poly_id = [poly_id]
+        query = "SELECT %s FROM %s WHERE poly_id = ANY(%%s::int[]) ORDER BY datetime ASC" \
+                % (','.join(self._DATA_FIELDS), self.data_tablename)
+        sql_params = ([int(i) for i in poly_id],)
+        with self._read_connection() as conn:
+            row = self.get_matching_rows(conn, query, sql_params, None, prepared=True)
+        return self.format_data(row, typed)
+
+    def iter_data(self, poly_ids, batch_size=10000, typed=False):
+        """ Stream the time series of many polygons with one query over a server
+        side cursor on the read endpoint, see _read_connection, fetching
+        batch_size rows per round trip. The connection is held until the
+        generator is exhausted or closed, queries in between need another
+        connection of the pool, see WIT_DB_POOL_MAX.
+
+        Parameters:
+        ----------------------------------------------------------------
+        poly_ids:       list of poly_id
+        batch_size:     number of rows fetched per round trip
+        typed:          yield dicts of numpy columns as get_data_by_poly_id does
+        retval:         generator of (poly_id, rows) in the order of poly_ids, rows are
+                          (datetime, fc_bs, fc_npv, fc_pv, tci_w, wofs_water) ordered by
+                          datetime; polygons without data are skipped
+        """
+        if not isinstance(poly_ids, self._SEQUENCE_TYPES):
+            poly_ids = [poly_ids]
+        poly_ids = [int(poly_id) for poly_id in poly_ids]
+        if len(poly_ids) == 0:
+            return
+
+        query = "SELECT ids.n, b.poly_id, datetime, fc_bs, fc_npv, fc_pv, tci_w, wofs_water "\
+                " FROM unnest(%%s::int[]) WITH ORDINALITY AS ids (poly_id, n), %s AS b "\
+                " WHERE b.poly_id = ids.poly_id ORDER BY ids.n ASC, datetime ASC" % (self.data_tablename)
+        with self._read_connection() as conn:
+            cursor = conn.dbConn.cursor(name='iter_data_%s' % (uuid.uuid4().hex))
+            cursor.itersize = batch_size
+            try:
+                cursor.execute(query, (poly_ids,))
+                current, poly_id, rows = None, None, []
+                for row in cursor:
+                    if row[0] != current:
+                        if rows:
+                            yield poly_id, self.format_data(rows, typed)
+                        current, poly_id, rows = row[0], row[1], []
+                    rows.append(row[2:])
+                if rows:
+                    yield poly_id, self.format_data(rows, typed)
+            finally:
+                cursor.close()
+                conn.dbConn.commit()
+
+    def format_data(self, rows, typed):
+        """ Return rows of the time series as they are or typed, see get_data_by_poly_id """
+        if typed:
+            return self.rows_to_columns(rows, self._DATA_FIELDS, self._DATA_DTYPES)
+        return rows
 
     def get_area_by_poly_id(self, poly_id):
-        query_view = "CREATE OR REPLACE TEMP VIEW data_in_area AS "\
-                " (SELECT a.poly_id, datetime, ST_Area(geometry)/10000 AS area, "\
-                " ST_Area(geometry)/10000*fc_bs AS fc_bs, ST_Area(geometry)/10000*fc_npv AS fc_npv, "\
-                " ST_Area(geometry)/10000*fc_pv AS fc_pv, ST_Area(geometry)/10000*tci_w AS tci_w, "\
-                " ST_Area(geometry)/10000*wofs_water AS wofs_water FROM polygons as a, data as b WHERE a.poly_id=b.poly_id)"
-        query_data = "SELECT datetime, area, fc_bs, fc_npv, fc_pv, tci_w, wofs_water FROM data_in_area WHERE poly_id=%s"\
-                " ORDER BY datetime ASC"
-        query_params = (poly_id, )
-        with ConnectionFactory.get() as conn:
-            conn.cursor.execute(query_view)
-            row = self.get_matching_rows(conn, query_data, query_params, None)
-        return row
+        query = self._AREA_QUERY % (self.poly_tablename, self.data_tablename)
+        with self._read_connection() as conn:
+            row = self.get_matching_rows(conn, query, ([int(poly_id)],), None)
+        return tuple(r[1:] for r in row)
+
+    def get_area_by_poly_ids(self, poly_ids):
+        """ Get the time series of the polygons scaled by their area in ha.
+
+        Parameters:
+        ----------------------------------------------------------------
+        poly_ids:       poly_id or a list of them
+        retval:         dict of numpy arrays keyed by poly_id, datetime, area, fc_bs,
+                        fc_npv, fc_pv, tci_w and wofs_water, ordered by poly_id and datetime
+        """
+        if not isinstance(poly_ids, self._SEQUENCE_TYPES):
+            poly_ids = [poly_ids]
+
+        query = self._AREA_QUERY % (self.poly_tablename, self.data_tablename)
+        with self._read_connection() as conn:
+            rows = self.get_matching_rows(conn, query, ([int(i) for i in poly_ids],), None)
+        return self.rows_to_columns(rows, self._AREA_FIELDS, self._AREA_DTYPES)
 
-    def get_data_by_geom(self, geometry):
+    def get_data_by_geom(self, geometry, typed=False):
         poly_id, poly_name, state = self.get_id_by_geom(self.poly_tablename, geometry)
         if poly_id == 0:
-            return '', []
-        row = self.get_data_by_poly_id(poly_id)
+            return '', self.format_data([], typed)
+        row = self.get_data_by_poly_id(poly_id, typed)
         return poly_name, row
 
     def get_catchment_list(self, vague_string):
         query = "SELECT catchment_id, catchment_name FROM %s WHERE shapefile ~ '.*%s.*'" % (self.catchment.tableName, vague_string)
-        with ConnectionFactory.get() as conn:
+        with self._read_connection() as conn:
             row = self.get_matching_rows(conn, query, None, None)
             if len(row) == 0:
                 return ''
@@ -769,20 +1459,35 @@ class DIO(object):
         elif table_name == self.polygons.tableName:
             query, sql_params, max_rows = self.construct_query(self.polygons,
                 dict(poly_id=poly_id), ['poly_name'])
-        with ConnectionFactory.get() as conn:
+        with self._read_connection() as conn:
             row = self.get_matching_rows(conn, query, sql_params, None)
             if len(row) == 0:
                 return ''
             return row
 
-    def get_polys_by_catchment_id(self, catchment_id, vague_string, maxrows=None):
-        query = "SELECT poly_id from %s as p, %s as c " \
-                " WHERE ST_Contains(c.geometry, p.geometry) AND c.catchment_id=%%s " \
-                " AND p.shapefile ~ '.*%s.*' ORDER BY ST_Area(p.geometry) DESC" % (self.poly_tablename, self.catchment.tableName, vague_string)
+    def _update_catchment_members(self, conn, poly_list=None, catchment_id=None):
+        """ Recompute the catchment_members of the given polygons or catchment """
+        if poly_list is not None:
+            condition = "p.poly_id IN %(poly_list)s"
+            conn.cursor.execute("DELETE FROM %s WHERE poly_id IN %%(poly_list)s"
+                    % (self.catchment_members.tableName,), dict(poly_list=tuple(poly_list)))
+        else:
+            condition = "c.catchment_id = %(catchment_id)s"
+            conn.cursor.execute("DELETE FROM %s WHERE catchment_id = %%(catchment_id)s"
+                    % (self.catchment_members.tableName,), dict(catchment_id=catchment_id))
+        params = dict(poly_list=tuple(poly_list or ()), catchment_id=catchment_id)
+        conn.cursor.execute(insert_poly_sources % ("p.poly_id IN %(poly_list)s" if poly_list is not None else "TRUE",),
+                params)
+        conn.cursor.execute(insert_catchment_members % (condition,), params)
+
+    def get_polys_by_catchment_id(self, catchment_id, vague_string='', maxrows=None):
+        query = "SELECT poly_id from %s WHERE catchment_id=%%s " \
+                " AND source_id IN (SELECT source_id FROM %s WHERE shapefile ~ '.*%s.*') " \
+                " ORDER BY area_ha DESC" % (self.catchment_members.tableName, self.poly_sources.tableName, vague_string)
         if maxrows is not None:
             query += " LIMIT %s" % (maxrows,)
         sql_params = (catchment_id,)
-        with ConnectionFactory.get() as conn:
+        with self._read_connection() as conn:
             row = self.get_matching_rows(conn, query, sql_params, None)
         return row
 
@@ -790,26 +1495,38 @@ class DIO(object):
         catchment_id, catchment_name = self.get_id_by_geom(self.catchment.tableName, geometry)
         if catchment_id == 0:
             return '', []
-        row = self.get_polys_by_catchment_id(catchment_id, maxrows)
+        row = self.get_polys_by_catchment_id(catchment_id, maxrows=maxrows)
         return catchment_name, row
 
     def get_intersect_polygons(self, poly_id, geometry, shapefile):
-        query = "SELECT poly_id from %s WHERE ST_Intersects(%%s, geometry) AND poly_id <> %%s AND shapefile ~* '%s'"\
+        query = "SELECT poly_id from %s WHERE ST_Intersects(%%s::geometry, geometry) AND poly_id <> %%s AND shapefile ~* '%s'"\
                 %(self.poly_tablename, '.*' + shapefile.split('/')[-1] + '.*')
-        sql_params = (geometry, poly_id)
-        with ConnectionFactory.get() as conn:
+        sql_params = (geometry_param(geometry), poly_id)
+        with self._read_connection() as conn:
             row = self.get_matching_rows(conn, query, sql_params, None)
         return row
 
     def get_intersect_landsat_pathrow(self, geometry):
-        query = "SELECT pathrow_id, ST_Area(ST_Intersection(%%s, ST_Transform(geometry, 3577)))/ST_Area(%%s) from %s "\
-                " WHERE ST_Intersects(%%s, ST_Transform(geometry, 3577))"\
+        query = "SELECT pathrow_id, ST_Area(ST_Intersection(%%s::geometry, ST_Transform(geometry, 3577)))/ST_Area(%%s::geometry) from %s "\
+                " WHERE ST_Intersects(%%s::geometry, ST_Transform(geometry, 3577))"\
                 %(self.landsat_path.tableName, )
-        sql_params = ((geometry,) * 3)
-        with ConnectionFactory.get() as conn:
+        sql_params = ((geometry_param(geometry),) * 3)
+        with self._read_connection() as conn:
             row = self.get_matching_rows(conn, query, sql_params, None)
         return row
 
+    def get_landsat_pathrows(self):
+        """ All the path/rows with their footprint in EPSG:3577, e.g. for the
+        PathRowIndex of wit_tooling.spatial_index
+
+        retval:         list of (pathrow_id, pathrow_label, EWKB) ordered by pathrow_id
+        """
+        query = "SELECT pathrow_id, pathrow_label, ST_AsEWKB(ST_Transform(geometry, 3577)) FROM %s " \
+                " ORDER BY pathrow_id ASC" % (self.landsat_path.tableName,)
+        with self._read_connection() as conn:
+            rows = self.get_matching_rows(conn, query, None, None)
+        return rows
+
     def get_alltime_metrics_by_geom(self, geometry):
         poly_id, poly_name, state = self.get_id_by_geom(self.poly_tablename, geometry)
         if poly_id == 0:
@@ -841,20 +1558,21 @@ class DIO(object):
     "GROUP BY ev.event_id"
 
         sql_params = (poly_id, poly_id)
-        with ConnectionFactory.get() as conn:
+        with self._read_connection() as conn:
             row = self.get_matching_rows(conn, query, sql_params, None)
         return row
 
+    @cached_result
     def get_alltime_metrics(self, poly_list):
         if not isinstance(poly_list, self._SEQUENCE_TYPES):
             poly_list = tuple([poly_list])
         query = "SELECT * FROM (SELECT poly_id, coalesce(pv/total::float, 0) as pv_perc, " \
                 " coalesce(openwater/total::float, 0) as openwater_penc, coalesce(wet/total::float, 0) as wet_perc " \
                 " FROM %s) AS a NATURAL JOIN (SELECT poly_id, pv as pv_fot, openwater as openwater_fot, " \
-                " wet as wet_fot FROM %s) AS b WHERE poly_id IN %%s" % (self.alltime_metrics.tableName, self.first_observe.tableName)
-        sql_params = (tuple(poly_list),)
-        with ConnectionFactory.get() as conn:
-            row = self.get_matching_rows(conn, query, sql_params, None)
+                " wet as wet_fot FROM %s) AS b WHERE poly_id = ANY(%%s::int[])" % (self.alltime_metrics.tableName, self.first_observe.tableName)
+        sql_params = ([int(i) for i in poly_list],)
+        with self._read_connection() as conn:
+            row = self.get_matching_rows(conn, query, sql_params, None, prepared=True)
         return row
 
     def get_year_metrics(self, poly_list, mlist):
@@ -862,11 +1580,11 @@ class DIO(object):
             poly_list = tuple([poly_list])
 
         mlist = ['poly_id', 'year'] + mlist
-        query, sql_params, max_rows = self.construct_query(self.year_metrics,
-                dict(poly_id=poly_list), mlist)
-        query = query + " ORDER BY poly_id ASC, year ASC"
-        with ConnectionFactory.get() as conn:
-            row = self.get_matching_rows(conn, query, sql_params, max_rows)
+        query = "SELECT %s FROM %s WHERE poly_id = ANY(%%s::int[]) ORDER BY poly_id ASC, year ASC" \
+                % (','.join(mlist), self.year_metrics.tableName)
+        sql_params = ([int(i) for i in poly_list],)
+        with self._read_connection() as conn:
+            row = self.get_matching_rows(conn, query, sql_params, None, prepared=True)
         return row
 
     def get_wet_year_metrics(self, poly_list):
@@ -877,100 +1595,121 @@ class DIO(object):
         row = self.get_year_metrics(poly_list, ['pv_min', 'pv_max', 'pv_mean'])
         return row
 
+    @cached_result
     def get_year_metrics_with_type_area(self, poly_list, wtype='SystemType'):
         if not isinstance(poly_list, self._SEQUENCE_TYPES):
             poly_list = [poly_list]
 
-        query = "SELECT a.*, c.properties::json->'ORIG_FID', ST_Area(b.geometry)/10000 as area, c.properties::json->%%s as type "\
+        query = "SELECT a.poly_id, a.year, a.wet_min, a.wet_max, a.wet_mean, a.water_min, a.water_max, a.water_mean, "\
+                " a.pv_min, a.pv_max, a.pv_mean, "\
+                " c.properties::json->'ORIG_FID', ST_Area(b.geometry)/10000 as area, c.properties::json->%%s as type "\
                 " FROM %s as a, %s as b, %s as c WHERE a.poly_id=b.poly_id AND a.poly_id=c.poly_id AND a.poly_id IN %%s "\
                 " ORDER by a.poly_id ASC, a.year ASC"\
                 %(self.year_metrics.tableName, self.polygons.tableName, "poly_properties")
         sql_params = (wtype, tuple(poly_list))
-        with ConnectionFactory.get() as conn:
+        with self._read_connection() as conn:
             row = self.get_matching_rows(conn, query, sql_params, None)
         return row
 
+    @cached_result
     def get_event_metrics(self, poly_list, set_str=''):
         if not isinstance(poly_list, self._SEQUENCE_TYPES):
             poly_list = tuple([poly_list])
 
+        # the events of another set live in their own table, self.event_metrics
+        #  is left alone as it is shared by the threads and the writers
+        event_metrics = self.EventInfo()
+        event_metrics.tableName = 'event_metrics'
         if set_str != '':
-            self.event_metrics.tableName += '_' + set_str
-        else:
-            self.event_metrics.tableName = 'event_metrics'
+            event_metrics.tableName += '_' + set_str
 
-        query, sql_params, max_rows = self.construct_query(self.event_metrics,
+        query, sql_params, max_rows = self.construct_query(event_metrics,
                 dict(poly_id=poly_list), ['poly_id', 'start_time', 'end_time', 'duration', 'max', 'mean', 'area'])
         query = query + " ORDER BY poly_id ASC, start_time ASC"
-        with ConnectionFactory.get() as conn:
+        with self._read_connection() as conn:
             row = self.get_matching_rows(conn, query, sql_params, max_rows)
         return row
 
+    @cached_result
     def get_inundation(self, poly_list, start_year, end_year, min_area=1, max_rows=5000):
+        """ Summarize the inundation of the polygons over the years [start_year, end_year)
+        from the yearly summary in inundation_year.
+
+        Parameters:
+        ----------------------------------------------------------------
+        poly_list:      poly_id or a list of them
+        start_year:     first year
+        end_year:       the year after the last one
+        min_area:       minimal average inundated area in ha
+        max_rows:       number of rows returned, largest area first
+        retval:         [(poly_id, poly_name, wet_years, percent, area)]
+        """
         if not isinstance(poly_list, self._SEQUENCE_TYPES):
             poly_list = [poly_list]
 
-        start_time = '-'.join([str(start_year), '01', '01'])
         end_time = '-'.join([str(end_year), '01', '01'])
         year_interval = int(end_year)-int(start_year)
 
-        query_view_s1 = "CREATE OR REPLACE TEMP VIEW decade_%s_%s_s1 AS "\
-                " (SELECT poly_id, EXTRACT(year FROM start_time) AS sy, EXTRACT(year FROM end_time) AS ey, "\
-                " CASE WHEN (EXTRACT(year FROM start_time)>=%%s) THEN SUM(LEAST(duration, %%s-start_time)) "\
-                " WHEN (EXTRACT(year FROM end_time) < %%s) THEN SUM(LEAST(duration, end_time-%%s)) "\
-                " WHEN ((EXTRACT(year FROM start_time) < %%s) AND (EXTRACT(year FROM end_time) >= %%s)) "\
-                " THEN SUM(LEAST(duration, (%%s::TimeStamp - %%s))) ELSE INTERVAL '0D' END AS duration, AVG(area) AS area FROM %s "\
-                " WHERE poly_id IN %%s AND ((start_time<%%s and start_time>=%%s) OR (end_time<%%s and end_time>=%%s) "\
-                " OR (start_time<%%s and end_time>=%%s)) GROUP by poly_id, sy, ey)"\
-                % (str(start_year), str(end_year), self.event_metrics.tableName)
-
-        sql_params_s1 = (start_year, end_time, end_year, start_time, start_year, end_year, end_time, start_time,
-                tuple(poly_list), end_time, start_time, end_time, start_time, start_time, end_time)
-
-
-        query_view_s2 = "CREATE OR REPLACE TEMP VIEW decade_%s_%s_s2 AS "\
-                " (SELECT a.poly_id, wet_years, "\
-                " EXTRACT(epoch FROM SUM(duration))/86400/365/%%s AS percent, AVG(area) AS area FROM decade_%s_%s_s1 AS a, "\
-                " poly_properties AS b, decade_%s_%s_y as c WHERE a.poly_id=b.poly_id AND a.poly_id=c.poly_id "\
-                " GROUP BY a.poly_id, c.wet_years ORDER BY area DESC)"\
-                % ((str(start_year), str(end_year)) * 3)
-
-        sql_params_s2 = (year_interval, )
-
-        query_view_c1 = "CREATE OR REPLACE TEMP VIEW decade_%s_%s_o AS "\
-                " (SELECT poly_id, ey, MAX(LEAST(ey, %%s-1)-GREATEST(sy, %%s)+1) AS wet_years FROM decade_%s_%s_s1 "\
-                " WHERE poly_id IN %%s group by ey, poly_id)" % ((str(start_year), str(end_year)) * 2)
-        sql_params_c1 = (end_year, start_year, tuple(poly_list))
-
-        query_view_c2 = "CREATE OR REPLACE TEMP VIEW decade_%s_%s_r AS "\
-                " (SELECT a.poly_id, COUNT(*) as rep FROM (SELECT poly_id, sy FROM decade_%s_%s_s1 WHERE sy !=ey "\
-                " AND poly_id IN %%s) as a, decade_%s_%s_o AS b WHERE a.poly_id = b.poly_id AND a.sy = b.ey GROUP BY a.poly_id)"\
-                % ((str(start_year), str(end_year)) * 3)
-        sql_params_c2 = (tuple(poly_list), )
-
-        query_view_c3 = "CREATE OR REPLACE TEMP VIEW decade_%s_%s_y AS "\
-                " (SELECT a.poly_id, a.wet_years - b.rep AS wet_years FROM (SELECT poly_id, SUM(wet_years) AS wet_years "\
-                " FROM decade_%s_%s_o GROUP BY poly_id) AS a, (SELECT * FROM decade_%s_%s_r) AS b WHERE a.poly_id = b.poly_id "\
-                " UNION ALL "\
-                " SELECT a.poly_id,  a.wet_years AS wet_years FROM (SELECT poly_id, SUM(wet_years) AS wet_years FROM "\
-                " decade_%s_%s_o GROUP BY poly_id) AS a WHERE NOT EXISTS (SELECT * FROM decade_%s_%s_r as b WHERE a.poly_id = b.poly_id))"\
-                % ((str(start_year), str(end_year)) * 5)
-
-        data_query = "SELECT a.poly_id, properties::json->'ORIG_FID' as poly_name, wet_years, percent, area "\
-                " FROM decade_%s_%s_s2 as a, poly_properties as b WHERE a.area>=%%s "\
-                " AND a.poly_id IN %%s AND a.poly_id = b.poly_id LIMIT %%s" % (str(start_year), str(end_year))
-        data_params = (min_area, tuple(poly_list), max_rows)
-
-        with ConnectionFactory.get() as conn:
-            conn.cursor.execute("SET work_mem='16GB'")
-            conn.cursor.execute(query_view_s1, sql_params_s1)
-            conn.cursor.execute(query_view_c1, sql_params_c1)
-            conn.cursor.execute(query_view_c2, sql_params_c2)
-            conn.cursor.execute(query_view_c3)
-            conn.cursor.execute(query_view_s2, sql_params_s2)
-            row = self.get_matching_rows(conn, data_query, data_params, None)
+        sql_params = dict(poly_list=[int(i) for i in poly_list], start_year=int(start_year), end_year=int(end_year),
+                end_time=end_time, year_interval=year_interval, min_area=min_area, max_rows=max_rows)
+        with self._read_connection() as conn:
+            row = self.get_matching_rows(conn, inundation_by_years, sql_params, None)
         return row
 
+    def get_metrics_generation(self, conn=None):
+        """ Return the generation of the metrics, it changes whenever a polygon
+        is marked ready by insert_update_result or the metrics, events or polygon
+        properties are updated. The data rows inserted in between don't change it,
+        the metrics of a polygon being computed are only final once it is ready.
+        The counter is updated in the transaction of the change, a new
+        generation is only seen once the change is committed.
+
+        A replica may lag behind the primary, a result is cached under the
+        generation read on its own connection before it, see cached_result.
+
+        Parameters:
+        ----------------------------------------------------------------
+        conn:           connection to read it on, a read connection if None
+        retval:         generation in metrics_version
+        """
+        if conn is not None:
+            row = self.get_matching_rows(conn, "SELECT generation FROM metrics_version", None, None)
+            return row[0][0]
+        with self._read_connection() as conn:
+            row = self.get_matching_rows(conn, "SELECT generation FROM metrics_version", None, None)
+        return row[0][0]
+
+    def _bump_generation(self, conn):
+        # the row stays locked until the transaction ends, so it is only bumped
+        #  once per batch of polygons, never per data row
+        conn.cursor.execute("UPDATE metrics_version SET generation = generation + 1")
+
+    def enable_result_cache(self, directory=None, max_entries=None, max_mb=None, check_interval=0):
+        """ Cache the results of get_alltime_metrics, get_year_metrics_with_type_area,
+        get_event_metrics and get_inundation until the metrics generation changes.
+
+        Parameters:
+        ----------------------------------------------------------------
+        directory:      keep the results in files under this directory, shared by the
+                          processes using it; in memory of this process if None
+        max_entries:    number of results kept in memory
+        max_mb:         size of the results kept in the directory
+        check_interval: seconds between checks of the metrics generation, results may
+                          be that much out of date
+        retval:         the ResultCache
+        """
+        if directory is None:
+            store = MemoryStore(max_entries or self._RESULT_CACHE_SIZE)
+        else:
+            # one directory per database, the generations of different databases
+            #  have nothing to do with each other
+            args = get_database_args()
+            name = re.sub(r'[^\w.-]', '_', '%s_%s_%s' % (args['host'], args['port'], args['dbname']))
+            store = DiskStore(os.path.join(directory, name),
+                    (max_mb or self._RESULT_CACHE_MB) << 20)
+        self.result_cache = ResultCache(self.get_metrics_generation, store, check_interval)
+        return self.result_cache
+
     def set_work_mem(self, conn):
         query = "SET work_mem to '8GB'"
         conn.cursor.execute(query)
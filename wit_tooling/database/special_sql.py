@@ -1,30 +1,92 @@
-alltime_count_view = """
-create materialized view alltime_count (poly_id, pv, openwater, wet, total) as
-    (select * from (select poly_id, count(fc_pv) as pv from data where fc_pv > 0 group by poly_id) as a
-        full join (select poly_id, count(wofs_water) as openwater from data where wofs_water > 0 group by poly_id) as b using (poly_id)
-        full join (select poly_id, count(tci_w) as wet from data where tci_w+wofs_water > 0 group by poly_id) as c using (poly_id)
-        full join (select poly_id, count(datetime) as total from data group by poly_id) as d using (poly_id)
-    )
-    """
+alltime_count_table = """
+create table alltime_count (poly_id int primary key references polygons (poly_id),
+    pv bigint default 0, openwater bigint default 0, wet bigint default 0, total bigint default 0)
+"""
 
-first_observe_view = """
-create materialized view first_observe (poly_id, pv, openwater, wet) as
-    (select * from (select poly_id, min(datetime) as pv from data where fc_pv > 0 group by poly_id ) as a
-        full join (select poly_id, min(datetime) as openwater from data where wofs_water > 0 group by poly_id) as b using (poly_id)
-        full join (select poly_id, min(datetime) as wet from data where tci_w+wofs_water > 0 group by poly_id) as c using (poly_id)
-    )
-    """
+refresh_alltime_count = """
+insert into alltime_count (poly_id, pv, openwater, wet, total)
+    (select poly_id, count(fc_pv) filter (where fc_pv > 0), count(wofs_water) filter (where wofs_water > 0),
+        count(tci_w) filter (where tci_w+wofs_water > 0), count(datetime)
+        from data where poly_id in %s group by poly_id)
+"""
+
+first_observe_table = """
+create table first_observe (poly_id int primary key references polygons (poly_id),
+    pv timestamp, openwater timestamp, wet timestamp)
+"""
 
-year_metric_view = """
-create materialized view year_metrics (poly_id, year, wet_min, wet_max, wet_mean, water_min, water_max, water_mean,
-pv_min, pv_max, pv_mean) as
-    (select poly_id, extract(year from datetime) as year, min(tci_w + wofs_water), max(tci_w + wofs_water),
+refresh_first_observe = """
+insert into first_observe (poly_id, pv, openwater, wet)
+    (select poly_id, min(datetime) filter (where fc_pv > 0), min(datetime) filter (where wofs_water > 0),
+        min(datetime) filter (where tci_w+wofs_water > 0)
+        from data where poly_id in %s and (fc_pv > 0 or wofs_water > 0 or tci_w+wofs_water > 0)
+        group by poly_id)
+"""
+
+year_metric_table = """
+create table year_metrics (poly_id int references polygons (poly_id), year int,
+    wet_min float, wet_max float, wet_mean float, water_min float, water_max float, water_mean float,
+    pv_min float, pv_max float, pv_mean float, count bigint,
+    primary key (poly_id, year))
+"""
+
+refresh_year_metrics = """
+insert into year_metrics (poly_id, year, wet_min, wet_max, wet_mean, water_min, water_max, water_mean,
+pv_min, pv_max, pv_mean, count)
+    (select poly_id, extract(year from datetime)::int as year, min(tci_w + wofs_water), max(tci_w + wofs_water),
         avg(tci_w+wofs_water), min(wofs_water), max(wofs_water), avg(wofs_water),
-            min(fc_pv), max(fc_pv), avg(fc_pv)
-        from data group by year, poly_id
-        order by year asc
+            min(fc_pv), max(fc_pv), avg(fc_pv), count(*)
+        from data where poly_id in %s group by year, poly_id
     )
-    """
+"""
+
+# insert a data row and fold it into the metrics tables in one statement,
+# nothing is counted if the row exists already
+insert_data_with_metrics = """
+with inserted as (insert into data (poly_id, datetime, fc_bs, fc_pv, fc_npv, tci_w, wofs_water)
+    values (%%s, to_timestamp(%%s, 'YYYY-MM-DD HH24:MI:SS.US'), %%s, %%s, %%s, %%s, %%s)
+    on conflict do nothing returning *),
+alltime_rows as (insert into alltime_count (poly_id, pv, openwater, wet, total)
+    select poly_id, (fc_pv > 0)::int, (wofs_water > 0)::int, (tci_w+wofs_water > 0)::int, 1 from inserted
+    on conflict (poly_id) do update set pv = alltime_count.pv + excluded.pv,
+        openwater = alltime_count.openwater + excluded.openwater, wet = alltime_count.wet + excluded.wet,
+        total = alltime_count.total + excluded.total),
+first_rows as (insert into first_observe (poly_id, pv, openwater, wet)
+    select poly_id, case when fc_pv > 0 then datetime end, case when wofs_water > 0 then datetime end,
+        case when tci_w+wofs_water > 0 then datetime end from inserted
+        where fc_pv > 0 or wofs_water > 0 or tci_w+wofs_water > 0
+    on conflict (poly_id) do update set pv = least(first_observe.pv, excluded.pv),
+        openwater = least(first_observe.openwater, excluded.openwater), wet = least(first_observe.wet, excluded.wet)),
+year_rows as (insert into year_metrics (poly_id, year, wet_min, wet_max, wet_mean, water_min, water_max, water_mean,
+    pv_min, pv_max, pv_mean, count)
+    select poly_id, extract(year from datetime)::int, tci_w+wofs_water, tci_w+wofs_water, tci_w+wofs_water,
+        wofs_water, wofs_water, wofs_water, fc_pv, fc_pv, fc_pv, 1 from inserted
+    on conflict (poly_id, year) do update set
+        wet_min = least(year_metrics.wet_min, excluded.wet_min), wet_max = greatest(year_metrics.wet_max, excluded.wet_max),
+        wet_mean = (year_metrics.wet_mean * year_metrics.count + excluded.wet_mean) / (year_metrics.count + 1),
+        water_min = least(year_metrics.water_min, excluded.water_min),
+        water_max = greatest(year_metrics.water_max, excluded.water_max),
+        water_mean = (year_metrics.water_mean * year_metrics.count + excluded.water_mean) / (year_metrics.count + 1),
+        pv_min = least(year_metrics.pv_min, excluded.pv_min), pv_max = greatest(year_metrics.pv_max, excluded.pv_max),
+        pv_mean = (year_metrics.pv_mean * year_metrics.count + excluded.pv_mean) / (year_metrics.count + 1),
+        count = year_metrics.count + 1)
+select %s from inserted
+"""
+
+# the version of the tables, see DIO._SCHEMA_VERSION
+schema_version_table = """
+create table if not exists schema_version (version int not null, data_compact bool not null)
+"""
+
+# bumped once per batch of changed polygons within the transaction changing
+# them, see DIO.get_metrics_generation
+metrics_version_table = """
+create table if not exists metrics_version (id int primary key check (id = 1), generation bigint not null)
+"""
+
+metrics_version_row = """
+insert into metrics_version (id, generation) values (1, 0) on conflict (id) do nothing
+"""
 
 event_metrics_time_table = """
 create table event_metrics_time (event_id bigserial primary key,
@@ -34,70 +96,142 @@ create table event_metrics_time (event_id bigserial primary key,
 )
 """
 
-first_event_metrics = """
-insert into event_metrics_time (poly_id, end_time, start_time, duration)
-(select *, f.end-f.start + interval '1D' as duration from
-    (select data.poly_id, max(data.datetime) as end, a.start from data
-        natural join (select data.poly_id, min(data.datetime) as end, b.start from data
-            natural join (select poly_id, min(datetime) as start from data where (tci_w+wofs_water)> 0.01 group by poly_id) as b
-            where data.datetime > start and (tci_w+wofs_water) <= 0.01 group by poly_id, b.start) as a
-        where data.datetime < a.end group by data.poly_id, a.start) as f)
-on conflict do nothing
-"""
-
-update_event_metrics = """
-insert into event_metrics_time (poly_id, end_time, start_time, duration)
-(select *, b.end-b.start + interval '1D' as duration from
-(select data.poly_id, max(data.datetime) as end, a.start from data
-    natural join (select data.poly_id, min(datetime) as end, ns.start from data
-        natural join (select data.poly_id, min(data.datetime) as start from data,
-        (select poly_id, max(end_time) as end_time from event_metrics_time group by poly_id) as ev
-        where (tci_w+wofs_water) > 0.01 and data.datetime > ev.end_time and data.poly_id = ev.poly_id
-        group by data.poly_id) as ns
-        where data.datetime > ns.start and (tci_w+wofs_water) <= 0.01
-        group by data.poly_id, ns.start) as a
-        where data.datetime < a.end group by data.poly_id, a.start) as b)
-on conflict do nothing
-"""
-
-last_event_metrics = """
-insert into event_metrics_time (poly_id, end_time, start_time, duration)
-(select *, b.end-b.start + interval '1D' as duration from (select poly_id, max(datetime) as end, a.start from data
-        natural join (select data.poly_id, min(data.datetime) as start from data,
-                    (select poly_id, max(end_time) as end_time from event_metrics_time group by poly_id) as ev
-                    where (tci_w+wofs_water) > 0.01 and data.datetime > ev.end_time and data.poly_id = ev.poly_id
-                    group by data.poly_id) as a where (tci_w+wofs_water) > 0.01
-                    group by data.poly_id,a.poly_id, a.start) as b)
-on conflict do nothing
-"""
-
 incomplete_event_table = """
 create table incomplete_event (event_id bigserial primary key,
     poly_id int, end_time timestamp,
     start_time timestamp, duration interval)
 """
 
-update_incomplete_event = """
+# An event is a run of consecutive wet observations, (tci_w+wofs_water) > 0.01,
+# it is closed by the next dry observation. The runs are numbered by counting the
+# dry observations so far, so all the events of a polygon come out of one scan
+# from the end of its last closed event. The open run at the end, if any, replaces
+# the polygon's incomplete event.
+update_events = """
+with scan as (select data.poly_id, data.datetime, (data.tci_w+data.wofs_water) > 0.01 as wet from data
+        left join (select poly_id, max(end_time) as end_time from event_metrics_time
+            where poly_id in %(poly_list)s group by poly_id) as ev using (poly_id)
+        where data.poly_id in %(poly_list)s and data.datetime > coalesce(ev.end_time, '-infinity')),
+runs as (select poly_id, datetime, wet,
+        count(*) filter (where not wet) over (partition by poly_id order by datetime) as run,
+        count(*) filter (where not wet) over (partition by poly_id) as dry_total
+        from scan),
+islands as (select poly_id, min(datetime) as start_time, max(datetime) as end_time, run < max(dry_total) as closed
+        from runs where wet group by poly_id, run),
+closed_events as (insert into event_metrics_time (poly_id, end_time, start_time, duration)
+        (select poly_id, end_time, start_time, end_time-start_time + interval '1D' from islands where closed)
+        on conflict do nothing),
+cleared as (delete from incomplete_event where poly_id in %(poly_list)s)
 insert into incomplete_event (poly_id, end_time, start_time, duration)
-(select *, b.end-b.start + interval '1D' as duration from (select poly_id, max(datetime) as end, a.start from data
-        natural join (select data.poly_id, min(data.datetime) as start from data,
-                    (select poly_id, max(end_time) as end_time from event_metrics_time group by poly_id) as ev
-                    where (tci_w+wofs_water) > 0.01 and data.datetime > ev.end_time and data.poly_id = ev.poly_id
-                    group by data.poly_id) as a where (tci_w+wofs_water) > 0.01
-                    group by data.poly_id,a.poly_id, a.start) as b
-        )
+    (select poly_id, end_time, start_time, end_time-start_time + interval '1D' from islands where not closed)
 """
 
-event_metrics_view = """
-create materialized view event_metrics as
+event_metrics_table = """
+create table event_metrics (event_id bigint, poly_id int, end_time timestamp,
+    start_time timestamp, duration interval, max float, mean float, area float)
+"""
+
+event_metrics_index = """
+create index event_metrics_idx on event_metrics (poly_id, start_time)
+"""
+
+refresh_event_metrics = """
+insert into event_metrics (event_id, poly_id, end_time, start_time, duration, max, mean, area)
 (
 select ev.*, max(data.tci_w+data.wofs_water) as max, avg(data.tci_w+data.wofs_water) as mean,
-    max(data.tci_w+data.wofs_water)*max(ST_area(polygons.geometry))/10000 as area from data, polygons, event_metrics_time as ev
-    where polygons.poly_id = ev.poly_id and data.poly_id = polygons.poly_id and data.datetime >= ev.start_time and data.datetime <= ev.end_time
+    max(data.tci_w+data.wofs_water)*max(p.area)/10000 as area from data, event_metrics_time as ev,
+    (select poly_id, ST_Area(geometry) as area from polygons where poly_id in %(poly_list)s) as p
+    where ev.poly_id in %(poly_list)s and p.poly_id = ev.poly_id and data.poly_id = ev.poly_id
+    and data.datetime >= ev.start_time and data.datetime <= ev.end_time
     group by ev.event_id
     union all
 select ev.*, max(data.tci_w+data.wofs_water) as max, avg(data.tci_w+data.wofs_water) as mean,
-    max(data.tci_w+data.wofs_water)*max(ST_area(polygons.geometry))/10000 as area from data, polygons, incomplete_event as ev
-    where polygons.poly_id = ev.poly_id and data.poly_id = polygons.poly_id and data.datetime >= ev.start_time and data.datetime <= ev.end_time
+    max(data.tci_w+data.wofs_water)*max(p.area)/10000 as area from data, incomplete_event as ev,
+    (select poly_id, ST_Area(geometry) as area from polygons where poly_id in %(poly_list)s) as p
+    where ev.poly_id in %(poly_list)s and p.poly_id = ev.poly_id and data.poly_id = ev.poly_id
+    and data.datetime >= ev.start_time and data.datetime <= ev.end_time
+    group by ev.event_id
 )
 """
+
+# Per polygon and calendar year touched by its events:
+# duration:   wet time in the year, an event lasts from start_time to end_time + 1 day
+# spill:      the part of that last day of an event ending this year that falls in the next year
+# event_count, mean_area: events starting and ending in the year
+# span_area:  area of the event starting in the year and ending in a later one
+# carry_end, carry_area: the event started in an earlier year and still wet on Jan 1
+inundation_year_table = """
+create table inundation_year (poly_id int, year int,
+    duration interval, spill interval, event_count int, mean_area float,
+    span_area float, carry_end timestamp, carry_area float,
+    primary key (poly_id, year))
+"""
+
+refresh_inundation_year = """
+insert into inundation_year (poly_id, year, duration, spill, event_count, mean_area, span_area, carry_end, carry_area)
+(select poly_id, year,
+    sum(least(end_time + interval '1D', year_end) - greatest(start_time, year_start)),
+    coalesce(sum(end_time + interval '1D' - year_end) filter (where ey = year and end_time + interval '1D' > year_end),
+        interval '0D'),
+    count(*) filter (where sy = year and ey = year), avg(area) filter (where sy = year and ey = year),
+    max(area) filter (where sy = year and ey > year),
+    max(end_time) filter (where sy < year), max(area) filter (where sy < year)
+    from (select ev.*, year, make_timestamp(year, 1, 1, 0, 0, 0) as year_start,
+            make_timestamp(year + 1, 1, 1, 0, 0, 0) as year_end
+        from (select poly_id, start_time, end_time, area, extract(year from start_time)::int as sy,
+                extract(year from end_time)::int as ey from event_metrics where poly_id in %(poly_list)s) as ev,
+            generate_series(ev.sy, ev.ey) as year) as a
+    group by poly_id, year)
+"""
+
+# Aggregate inundation_year over [start_year, end_year). The events are grouped as
+# they used to be by the decade views over event_metrics: the events within one year
+# form a group, every event spanning years is a group of its own, and an event carried
+# into start_year is counted a day short.
+inundation_by_years = """
+select a.poly_id, b.properties::json->'ORIG_FID' as poly_name, wet_years,
+    extract(epoch from duration)/86400/365/%(year_interval)s as percent, area from
+    (select poly_id, count(*) as wet_years,
+        sum(duration) + coalesce(sum(spill) filter (where year < %(end_year)s - 1), interval '0D')
+            - coalesce(max(least(carry_end + interval '1D', %(end_time)s::timestamp) - carry_end)
+                filter (where year = %(start_year)s and carry_end < %(end_time)s::timestamp), interval '0D') as duration,
+        (coalesce(sum(mean_area), 0) + coalesce(sum(span_area), 0)
+            + coalesce(max(carry_area) filter (where year = %(start_year)s), 0))
+            / (count(mean_area) + count(span_area) + count(carry_area) filter (where year = %(start_year)s)) as area
+        from inundation_year where poly_id = any(%(poly_list)s::int[]) and year >= %(start_year)s and year < %(end_year)s
+        group by poly_id) as a, poly_properties as b
+    where a.poly_id = b.poly_id and a.area >= %(min_area)s
+    order by area desc limit %(max_rows)s
+"""
+
+poly_sources_table = """
+create table poly_sources (source_id serial, shapefile text not null,
+    primary key (source_id), unique (shapefile))
+"""
+
+# insert the shapefiles of the polygons matching the condition
+insert_poly_sources = """
+insert into poly_sources (shapefile)
+(select distinct shapefile from polygons as p where %s and shapefile is not null)
+on conflict (shapefile) do nothing
+"""
+
+catchment_members_table = """
+create table catchment_members (catchment_id int references catchments (catchment_id),
+    poly_id int references polygons (poly_id), area_ha float, source_id int references poly_sources (source_id),
+    primary key (catchment_id, poly_id))
+"""
+
+catchment_members_index = """
+create index catchment_members_area_idx on catchment_members (catchment_id, area_ha desc)
+"""
+
+# insert the memberships matching the condition on polygons p and catchments c
+insert_catchment_members = """
+insert into catchment_members (catchment_id, poly_id, area_ha, source_id)
+(select c.catchment_id, p.poly_id, ST_Area(p.geometry)/10000, s.source_id
+    from polygons as p join catchments as c on ST_Contains(c.geometry, p.geometry)
+    left join poly_sources as s on s.shapefile = p.shapefile
+    where %s)
+on conflict (catchment_id, poly_id) do update set area_ha = excluded.area_ha, source_id = excluded.source_id
+"""
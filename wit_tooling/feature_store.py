@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import shapely
+
+from .poly_tools import convert_shapes_to_polygons, shape_list
+
+_GEO_METADATA = {'version': '1.0.0', 'primary_column': 'geometry',
+        'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Polygon', 'MultiPolygon'], 'crs': None}}}
+
+def _cache_dir(cache_dir):
+    if cache_dir is not None:
+        return cache_dir
+    return os.getenv('WIT_FEATURE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'wit_tooling'))
+
+class FeatureStore(object):
+    """
+    Features of a shapefile converted once into a GeoParquet file with the
+    feature id, the repaired geometry as WKB and a column per property, then
+    looked up by feature id or property value without reading the shapefile again.
+    The parquet file is named after the path, mtime and size of the shapefile,
+    it is rebuilt when the shapefile changes. Needs pyarrow.
+
+    Features are returned like fiona does, as dicts of id (a str), geometry
+    and properties, the geometry being a shapely Polygon or MultiPolygon.
+
+    Usage Example:
+      store = FeatureStore(shapefile)
+      shape = store['1024']
+      shapes = store.get_many(feature_ids)
+      shapes = store.find('SYSID', 3051)
+    """
+
+    def __init__(self, shapefile, cache_dir=None):
+        """
+        input:
+        shapefile: path of the shapefile
+        cache_dir: directory of the parquet files, WIT_FEATURE_CACHE or ~/.cache/wit_tooling if None
+        """
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("FeatureStore needs pyarrow, pip install --user -e .[features]")
+
+        self.shapefile = shapefile
+        stat = os.stat(shapefile)
+        key = hashlib.sha1(repr((os.path.abspath(shapefile), stat.st_mtime_ns, stat.st_size)).encode()).hexdigest()
+        cache_dir = _cache_dir(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, '%s_%s.parquet' % (os.path.splitext(os.path.basename(shapefile))[0], key))
+        if not os.path.exists(self.path):
+            self._build(pq)
+
+        table = pq.read_table(self.path, memory_map=True)
+        metadata = json.loads(table.schema.metadata.get(b'wit_tooling', b'{}'))
+        self.crs_wkt = metadata.get('crs_wkt')
+        self._ids = table.column('id').to_numpy()
+        self._wkb = table.column('geometry').to_pylist()
+        self._properties = {name: table.column(name).to_pylist() for name in metadata.get('properties', [])}
+        self._rows = dict(zip(self._ids.tolist(), range(len(self._ids))))
+        self._indexes = {}
+
+    def _build(self, pq):
+        import fiona
+        import pyarrow as pa
+
+        with fiona.open(self.shapefile) as allshapes:
+            crs_wkt = allshapes.crs_wkt
+            names = list(allshapes.schema['properties'].keys())
+        ids, geometries, columns = [], [], {name: [] for name in names}
+        for shape in shape_list(self.shapefile):
+            ids.append(int(shape['id']))
+            geometries.append(shape['geometry'])
+            for name in names:
+                columns[name].append(shape['properties'].get(name))
+
+        wkb = np.full(len(geometries), None, dtype=object)
+        present = np.array([g is not None for g in geometries], dtype=bool)
+        if present.any():
+            wkb[present] = shapely.to_wkb(convert_shapes_to_polygons([g for g in geometries if g is not None]))
+
+        arrays = dict(id=pa.array(ids, type=pa.int64()), geometry=pa.array(wkb.tolist(), type=pa.binary()))
+        arrays.update((name, pa.array(values)) for name, values in columns.items())
+        table = pa.table(arrays).replace_schema_metadata({
+            b'geo': json.dumps(_GEO_METADATA).encode(),
+            b'wit_tooling': json.dumps(dict(shapefile=os.path.abspath(self.shapefile),
+                crs_wkt=crs_wkt, properties=names)).encode()})
+        # write to a temporary file first so that concurrent jobs never read half a file
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, feature_id):
+        return int(feature_id) in self._rows
+
+    def __getitem__(self, feature_id):
+        return self._features([self._rows[int(feature_id)]])[0]
+
+    def ids(self):
+        """
+        output:
+        np.array of the feature ids in the order of the shapefile
+        """
+        return self._ids
+
+    def get(self, feature_id, default=None):
+        row = self._rows.get(int(feature_id))
+        if row is None:
+            return default
+        return self._features([row])[0]
+
+    def get_many(self, feature_ids):
+        """
+        Fetch many features at once, their geometries are decoded in one batch
+        input:
+        feature_ids: iterable of feature ids, as int or str
+        output:
+        list of features in the order of feature_ids, None for unknown ids
+        """
+        rows = [self._rows.get(int(feature_id)) for feature_id in feature_ids]
+        features = self._features([row for row in rows if row is not None])
+        features = iter(features)
+        return [next(features) if row is not None else None for row in rows]
+
+    def find(self, key, value):
+        """
+        Fetch the features whose property key equals value. The first lookup of
+        a key indexes all the values of its column.
+        input:
+        key: property name, e.g. SYSID
+        value: property value, floats holding integers match the integer
+        output:
+        list of features in the order of the shapefile
+        """
+        return self._features(self._index(key).get(_index_value(value), []))
+
+    def find_many(self, key, values):
+        """
+        output:
+        list of (value, feature) of the features whose property key is in values,
+        in the order of values
+        """
+        index = self._index(key)
+        matches = [(value, row) for value in values for row in index.get(_index_value(value), [])]
+        return list(zip([value for value, _ in matches], self._features([row for _, row in matches])))
+
+    def iter_features(self, feature_ids=None, batch_size=1000):
+        """
+        Iterate the features, all of them in the order of the shapefile or
+        those of feature_ids in their order, fetched batch_size at a time
+        """
+        if feature_ids is None:
+            feature_ids = self._ids
+        feature_ids = list(feature_ids)
+        for i in range(0, len(feature_ids), batch_size):
+            for feature in self.get_many(feature_ids[i:i+batch_size]):
+                if feature is not None:
+                    yield feature
+
+    def _index(self, key):
+        index = self._indexes.get(key)
+        if index is None:
+            index = {}
+            for row, value in enumerate(self._properties[key]):
+                if value is not None:
+                    index.setdefault(_index_value(value), []).append(row)
+            self._indexes[key] = index
+        return index
+
+    def _features(self, rows):
+        geometries = shapely.from_wkb([self._wkb[row] for row in rows])
+        return [dict(id=str(self._ids[row]), geometry=geometry,
+            properties={name: values[row] for name, values in self._properties.items()})
+            for row, geometry in zip(rows, geometries)]
+
+def _index_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
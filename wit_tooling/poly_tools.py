@@ -1,28 +1,30 @@
 from shapely.geometry import Polygon, MultiPolygon
-from rasterio import features
-from rasterio.warp import calculate_default_transform
+from shapely.geometry.base import BaseGeometry
+import shapely
 import hashlib
+import os
+import itertools
 import json
 import numpy as np
 import io
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import matplotlib.patches as mpatches
-from matplotlib.patches import Rectangle
 from textwrap import wrap
 from datetime import datetime
-import fiona
-from pandas.plotting import register_matplotlib_converters
-from datacube.virtual.transformations import MakeMask, ApplyMask
+from .database.cache import DiskStore
+from .database.geometry import geometry_ewkb
 from .database.io import DIO
 
-register_matplotlib_converters()
+# fiona, rasterio, pandas, matplotlib and datacube are imported by the functions
+# using them, workers that don't plot nor load data don't pay for them
+
 def shape_list(shapefile):
+    import fiona
     with fiona.open(shapefile) as allshapes:
         for shape in allshapes:
             yield(shape)
 
 def convert_shape_to_polygon(geometry):
+    if isinstance(geometry, BaseGeometry):
+        return geometry
     if geometry['type'] == 'MultiPolygon':
         pl_wetland = []
         for coords in geometry['coordinates']:
@@ -34,9 +36,11 @@ def convert_shape_to_polygon(geometry):
             if poly.is_valid == False:
                 poly = poly.buffer(0)
                 if poly.geom_type == 'MultiPolygon':
-                    for ep in poly:
+                    for ep in poly.geoms:
                         pl_wetland.append(ep)
-                else:
+                # a degenerate part buffers to nothing, it is dropped as
+                #  repair_polygons does
+                elif not poly.is_empty:
                     pl_wetland.append(poly)
             else:
                 pl_wetland.append(poly)
@@ -51,20 +55,185 @@ def convert_shape_to_polygon(geometry):
         if pl_wetland.is_valid == False:
             pl_wetland = pl_wetland.buffer(0)
     return pl_wetland
-    
+
+def convert_shapes_to_polygons(geometries):
+    """
+    Convert the geometries of many shapes at once with the vectorised functions
+    of shapely 2, repairing the invalid ones as convert_shape_to_polygon does
+    input:
+    geometries: iterable of geometries of shapes, i.e. shape['geometry'], or shapely geometries
+    output:
+    np.array of shapely Polygon or MultiPolygon
+    """
+    geometries = list(geometries)
+    result = np.empty(len(geometries), dtype=object)
+    converted = np.array([isinstance(g, BaseGeometry) for g in geometries], dtype=bool)
+    result[converted] = [g for g, c in zip(geometries, converted) if c]
+    if converted.all():
+        return result
+    result[~converted] = _build_polygons([g for g, c in zip(geometries, converted) if not c])
+    return repair_polygons(result)
+
+def _build_polygons(geometries):
+    # gather the coordinates of all rings into one array, the rings, polygons
+    #  and multipolygons are then built by shapely from their indices
+    coords, ring_sizes, ring_polys, poly_geoms = [], [], [], []
+    multi = np.zeros(len(geometries), dtype=bool)
+    for i, geometry in enumerate(geometries):
+        geometry = getattr(geometry, '__geo_interface__', geometry)
+        if geometry['type'] == 'MultiPolygon':
+            multi[i] = True
+            parts = geometry['coordinates']
+        else:
+            parts = [geometry['coordinates']]
+        for part in parts:
+            for ring in part:
+                coords.extend(ring)
+                ring_sizes.append(len(ring))
+                ring_polys.append(len(poly_geoms))
+            poly_geoms.append(i)
+
+    rings = shapely.linearrings(np.array(coords, dtype='float64'),
+            indices=np.repeat(np.arange(len(ring_sizes)), ring_sizes))
+    polys = shapely.polygons(rings, indices=ring_polys)
+    poly_geoms = np.array(poly_geoms, dtype='int64')
+
+    result = np.empty(len(geometries), dtype=object)
+    single = ~multi[poly_geoms]
+    result[poly_geoms[single]] = polys[single]
+    rows = np.flatnonzero(multi)
+    if len(rows) > 0:
+        # a MultiPolygon without parts stays empty
+        multis = np.full(len(rows), MultiPolygon(), dtype=object)
+        shapely.multipolygons(polys[~single], indices=np.searchsorted(rows, poly_geoms[~single]), out=multis)
+        result[rows] = multis
+    return result
+
+def repair_polygons(polygons):
+    """
+    Repair invalid polygons in batch: a Polygon is buffered by 0, the invalid
+    parts of a MultiPolygon are buffered by 0 and it is rebuilt from the results
+    input:
+    polygons: np.array of shapely Polygon or MultiPolygon
+    output:
+    the array with the invalid polygons replaced
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    multi = shapely.get_type_id(polygons) == 6
+    invalid = ~shapely.is_valid(polygons)
+    single = invalid & ~multi
+    polygons[single] = shapely.buffer(polygons[single], 0)
+
+    rows = np.flatnonzero(invalid & multi)
+    if len(rows) > 0:
+        parts, index = shapely.get_parts(polygons[rows], return_index=True)
+        bad = ~shapely.is_valid(parts)
+        parts[bad] = shapely.buffer(parts[bad], 0)
+        # a buffered part may come out as a MultiPolygon, its polygons become parts
+        parts, sub_index = shapely.get_parts(parts, return_index=True)
+        kept = ~shapely.is_empty(parts)
+        parts, sub_index = parts[kept], sub_index[kept]
+        rebuilt = np.full(len(rows), MultiPolygon(), dtype=object)
+        shapely.multipolygons(parts, indices=index[sub_index], out=rebuilt)
+        polygons[rows] = rebuilt
+    return polygons
+
+_SHAPEFILE_POLYGONS = {}
+
+def shapefile_polygons(shapefile, cache_dir=None):
+    """
+    Read all the polygons of a shapefile into an array, converted and repaired
+    in bulk. The result is kept for the process and, with cache_dir or
+    WIT_GEOMETRY_CACHE, as WKB on disk for the next runs until the shapefile changes.
+    pyogrio reads the features in bulk if it is installed, fiona otherwise.
+    input:
+    shapefile: path of the shapefile
+    cache_dir: directory of the disk cache, WIT_GEOMETRY_CACHE if None, not cached on disk if neither
+    output:
+    (np.array of int feature ids, as shape['id'], np.array of shapely Polygon or MultiPolygon)
+    """
+    stat = os.stat(shapefile)
+    key = hashlib.sha1(repr((os.path.abspath(shapefile), stat.st_mtime_ns, stat.st_size)).encode()).hexdigest()
+    if key in _SHAPEFILE_POLYGONS:
+        return _SHAPEFILE_POLYGONS[key]
+
+    cache_dir = cache_dir if cache_dir is not None else os.getenv('WIT_GEOMETRY_CACHE')
+    store = DiskStore(cache_dir) if cache_dir else None
+    cached = store.get(key) if store is not None else None
+    if cached is not None:
+        ids, polygons = cached[0], shapely.from_wkb(cached[1])
+    else:
+        try:
+            from pyogrio.raw import read
+        except ImportError:
+            read = None
+        if read is not None:
+            _, ids, wkb, _ = read(shapefile, columns=[], return_fids=True)
+            polygons = repair_polygons(shapely.from_wkb(wkb))
+        else:
+            shapes = list(shape_list(shapefile))
+            ids = np.array([int(shape['id']) for shape in shapes])
+            polygons = convert_shapes_to_polygons([shape['geometry'] for shape in shapes])
+        ids = np.asarray(ids, dtype='int64')
+        if store is not None:
+            store.set(key, (ids, shapely.to_wkb(polygons)))
+
+    _SHAPEFILE_POLYGONS[key] = (ids, polygons)
+    return ids, polygons
+
 def poly_wkt(geometry, srid=3577):
     pl_wetland = convert_shape_to_polygon(geometry)
-    return 'SRID=%s;' % (srid)+pl_wetland.to_wkt()
+    return 'SRID=%s;' % (srid)+pl_wetland.wkt
+
+def poly_wkb(geometry, srid=3577):
+    """
+    Convert the geometry of a shape to EWKB, cheaper to produce, send and parse
+    than the EWKT of poly_wkt, DIO accepts either as a geometry
+    input:
+    geometry: the geometry of a shape, i.e. shape['geometry'], or a shapely geometry
+    output:
+    EWKB bytes
+    """
+    return geometry_ewkb(convert_shape_to_polygon(geometry), srid)
 
-def query_wit_data(shape):
+def query_wit_data(shape, typed=False):
     dio = DIO.get()
-    poly_hash = poly_wkt(shape['geometry'])
-    poly_name, rows = dio.get_data_by_geom(poly_hash)
+    poly_hash = poly_wkb(shape['geometry'])
+    poly_name, rows = dio.get_data_by_geom(poly_hash, typed)
+    if typed:
+        return poly_name, rows
     return poly_name, np.array(rows)
 
+def iter_wit_data(shapes, batch_size=1000, typed=False):
+    """
+    Query wit data of many shapes with one polygon lookup and one streamed
+    data query per batch of shapes
+    input:
+    shapes: an iterable of shapes from shape file
+    batch_size: number of shapes per batch
+    typed: return the wit data as a dict of numpy columns, see DIO.get_data_by_poly_id
+    output:
+    generator of (shape, poly_name, wit data) in the order of shapes
+    """
+    dio = DIO.get()
+    shapes = iter(shapes)
+    while True:
+        batch = list(itertools.islice(shapes, batch_size))
+        if len(batch) == 0:
+            break
+        polys = dio.get_ids_by_geoms(list(convert_shapes_to_polygons([shape['geometry'] for shape in batch])))
+        blocks = dio.iter_data([poly_id for poly_id, _, _ in polys if poly_id > 0], typed=typed)
+        block = next(blocks, None)
+        for shape, (poly_id, poly_name, _) in zip(batch, polys):
+            if block is not None and poly_id > 0 and block[0] == poly_id:
+                yield shape, poly_name, block[1] if typed else np.array(block[1])
+                block = next(blocks, None)
+            else:
+                yield shape, poly_name, dio.format_data([], typed) if typed else np.array([])
+
 def query_wit_metrics(shape, mtype='alltime', set_str=''):
     dio = DIO.get()
-    poly_hash = poly_wkt(shape['geometry'])
+    poly_hash = poly_wkb(shape['geometry'])
     if mtype == 'alltime':
         rows = dio.get_alltime_metrics_by_geom(poly_hash)
     elif mtype == 'year':
@@ -74,6 +243,7 @@ def query_wit_metrics(shape, mtype='alltime', set_str=''):
     return rows
 
 def load_timeslice(fc_product, to_split, mask_by_wofs=True):
+    from datacube.virtual.transformations import MakeMask, ApplyMask
     results = fc_product.fetch(to_split)
     #results = fc_product.fetch(to_split,  dask_chunks={'time':1, 'y':2000, 'x':2000})
     results = ApplyMask('pixelquality', apply_to=['BS', 'PV', 'NPV', 'TCW']).compute(results)
@@ -102,6 +272,8 @@ def load_timeslice(fc_product, to_split, mask_by_wofs=True):
     return results
 
 def generate_raster(shapes, geobox):
+    from rasterio import features
+    from rasterio.warp import calculate_default_transform
     yt, xt = geobox.shape
     transform, width, height = calculate_default_transform(
         geobox.crs, geobox.crs.crs_str, yt, xt, *geobox.extent.boundingbox)
@@ -109,100 +281,184 @@ def generate_raster(shapes, geobox):
         (yt, xt), fill=-1, transform=transform, all_touched=True)
     return target_ds
 
-def plot_to_png(count, polyName, with_title=True):
-    min_observe = 4
-    pal = ['#030aa7',
-            '#04d9ff',
-            '#3f9b0b',
-            '#e6daa6',
-            '#60460f']
-    labels = ['open water',
-            'wet',
-            'green veg',
-            'dry veg',
-            'bare soil',
-            ]
-
-    fig = plt.figure(figsize = (22,6))
-    plt.stackplot(count[:, 0].astype('datetime64[s]'),
-            count[:, 5].astype('float32') * 100,
-            count[:, 4].astype('float32') * 100,
-            count[:, 3].astype('float32') * 100,
-            count[:, 2].astype('float32') * 100,
-            count[:, 1].astype('float32') * 100,
-            colors=pal, alpha = 0.6)
-    #set axis limits to the min and max
-    time_min = count[:, 0].astype('datetime64[s]')[0]
-    time_max = count[:, 0].astype('datetime64[s]')[-1]
-    plt.axis(xmin = time_min, xmax = time_max, ymin = 0, ymax = 100)
-    #add a legend and a tight plot box
-    legend_handles = []
-    pal.reverse()
-    labels.reverse()
-    for p, l in zip(pal, labels):
-        legend_handles.append(mpatches.Patch(color=p, alpha=0.6, label=l))
-
-    if with_title:
-        plt.legend(handles=legend_handles, loc='lower left', framealpha=0.6)
-    plt.tight_layout()
-    years = mdates.YearLocator(1)
-    yearsFmt = mdates.DateFormatter('%Y')
-    ax = plt.gca()
-    ax.xaxis.set_major_locator(years)
-    ax.xaxis.set_major_formatter(yearsFmt)
-    if with_title:
-        ax.set_xlabel(f'The Fractional Cover algorithm developed by the Joint Remote'
-        f' Sensing Research Program and \n the Water Observations from Space algorithm '
-        f'developed by Geoscience Australia are used in the production of this data',style='italic')
+def wit_columns(count):
+    """
+    Split wit data into its time and value columns
+    input:
+    count: wit data as returned by query_wit_data, either an array of rows or a dict of columns
+    output:
+    (np.array of datetime64[s], [np.array of float32] of bs, npv, pv, wet, water)
+    """
+    if isinstance(count, dict):
+        columns = list(count.values())
+        return columns[0].astype('datetime64[s]'), [c.astype('float32', copy=False) for c in columns[1:6]]
+    return count[:, 0].astype('datetime64[s]'), [count[:, i].astype('float32') for i in range(1, 6)]
 
-    gap_start = None
-    gap_end = None
+def wit_frame(count):
+    """
+    Convert wit data into a dataframe with the columns TIME, BS, NPV, PV, WET, WATER
+    """
+    import pandas as pd
+    if isinstance(count, dict):
+        return pd.DataFrame(dict(zip(['TIME', 'BS', 'NPV', 'PV', 'WET', 'WATER'], count.values())))
+    return pd.DataFrame(data=count.reshape(-1, 6), columns=['TIME', 'BS', 'NPV', 'PV', 'WET', 'WATER'])
 
-    def plot_patch(gap_start, gap_end):
-        tmp_start = mdates.date2num(gap_start.astype('object'))
-        tmp_end = mdates.date2num(gap_end.astype('object'))
-        gap = tmp_end - tmp_start
-        slc_rectangle= Rectangle((tmp_start,0), gap, 100,alpha = 0.5, facecolor='#ffffff',
-                edgecolor='#ffffff', hatch="////",linewidth=2)
-        ax.add_patch(slc_rectangle)
+_WIT_PALETTE = ['#030aa7', '#04d9ff', '#3f9b0b', '#e6daa6', '#60460f']
+_WIT_LABELS = ['open water', 'wet', 'green veg', 'dry veg', 'bare soil']
+_WIT_CAPTION = (f'The Fractional Cover algorithm developed by the Joint Remote'
+        f' Sensing Research Program and \n the Water Observations from Space algorithm '
+        f'developed by Geoscience Australia are used in the production of this data')
 
+def wit_gaps(time, min_observe=4):
+    """
+    Find the spans of years with less than min_observe observations, merged
+    with the landsat7 gap, to be hatched on the plot
+    input:
+    time: np.array of datetime64 in ascending order
+    output:
+    list of (start, end) as np.datetime64
+    """
     ls7_gap_start = np.datetime64('2011-11-01')
     ls7_gap_end =  np.datetime64('2013-04-01')
+    gaps = []
+    gap_start = None
+    gap_end = None
 
     # mark observations < min_observe per year
     # and landsat7 gap
-    for y in np.arange(time_min.astype('datetime64[Y]'), time_max.astype('datetime64[Y]')+1):
-        if (np.count_nonzero((count[:, 0].astype('datetime64[s]') >= y) &
-                (count[:, 0].astype('datetime64[s]') < y + 1)) < min_observe):
+    years = time.astype('datetime64[Y]')
+    for y in np.arange(years[0], years[-1]+1):
+        if (np.count_nonzero(years == y) < min_observe):
             if gap_start is None:
                 gap_start = y
                 gap_end = y+1
             elif y > gap_end:
-                plot_patch(gap_start, gap_end)
+                gaps.append((gap_start, gap_end))
                 gap_start = y
             gap_end = max(gap_end, y+1)
 
         if y == ls7_gap_start.astype('datetime64[Y]'):
             if gap_end is not None:
                 if y > gap_end:
-                    plot_patch(gap_start, gap_end)
+                    gaps.append((gap_start, gap_end))
                     gap_start = ls7_gap_start
             else:
                 gap_start = ls7_gap_start
             gap_end = ls7_gap_end
     if gap_start is not None and gap_end is not None:
-        plot_patch(gap_start, gap_end)
+        gaps.append((gap_start, gap_end))
+    return gaps
+
+class WitPlotRenderer(object):
+    """
+    Renders wit data to png on one Agg figure built once, with its axes,
+    legend and caption; only the stackplot, the hatched gaps and the title
+    are replaced per polygon. The layout is computed once per number of
+    lines of the title, and the figure is drawn once per png.
 
-    # this section wraps text for polygon names that are too long
-    if with_title:
-        polyName=polyName.replace("'","\\'")
-        title=ax.set_title("\n".join(wrap(f'Percentage of area dominated by WOfS, Wetness, Fractional Cover for {polyName}')))
-        title.set_y(1.05)
-    fig.tight_layout()
+    It doesn't use pyplot, a renderer per process can run in a process pool,
+    see plot_to_png.
+    """
 
-    bytes_image = io.BytesIO()
-    plt.savefig(bytes_image, format='png')
-    bytes_image.seek(0)
-    plt.close()
+    def __init__(self, with_title=True, figsize=(22, 6), compress_level=6):
+        """
+        input:
+        with_title: add title, legend and caption
+        figsize: size of the figure in inches
+        compress_level: zlib level of the png, 1 is several times faster to
+            encode than the default 6 for a slightly larger file
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        import matplotlib.dates as mdates
+        import matplotlib.patches as mpatches
+        from pandas.plotting import register_matplotlib_converters
+        register_matplotlib_converters()
 
-    return bytes_image
+        self.with_title = with_title
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.ax.set_ylim(0, 100)
+        self.ax.xaxis.set_major_locator(mdates.YearLocator(1))
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y'))
+        self.title = None
+        if with_title:
+            legend_handles = [mpatches.Patch(color=p, alpha=0.6, label=l)
+                    for p, l in zip(reversed(_WIT_PALETTE), reversed(_WIT_LABELS))]
+            self.ax.legend(handles=legend_handles, loc='lower left', framealpha=0.6)
+            self.ax.set_xlabel(_WIT_CAPTION, style='italic')
+            self.title = self.ax.set_title('')
+            self.title.set_y(1.05)
+        self._pil_kwargs = dict(compress_level=compress_level)
+        self._artists = []
+        self._layouts = {}
+
+    def render(self, count, polyName):
+        """
+        input:
+        count: wit data as returned by query_wit_data
+        polyName: name of the polygon in the title
+        output:
+        io.BytesIO of the png
+        """
+        from matplotlib.patches import Rectangle
+        import matplotlib.dates as mdates
+
+        for artist in self._artists:
+            artist.remove()
+        time, values = wit_columns(count)
+        self._artists = self.ax.stackplot(time,
+                values[4] * 100,
+                values[3] * 100,
+                values[2] * 100,
+                values[1] * 100,
+                values[0] * 100,
+                colors=_WIT_PALETTE, alpha = 0.6)
+        #set axis limits to the min and max
+        self.ax.set_xlim(time[0], time[-1])
+
+        for gap_start, gap_end in wit_gaps(time):
+            tmp_start = mdates.date2num(gap_start.astype('object'))
+            tmp_end = mdates.date2num(gap_end.astype('object'))
+            slc_rectangle = Rectangle((tmp_start,0), tmp_end - tmp_start, 100, alpha = 0.5, facecolor='#ffffff',
+                    edgecolor='#ffffff', hatch="////", linewidth=2)
+            self._artists.append(self.ax.add_patch(slc_rectangle))
+
+        # this section wraps text for polygon names that are too long
+        title_lines = 0
+        if self.with_title:
+            polyName = polyName.replace("'","\\'")
+            title = wrap(f'Percentage of area dominated by WOfS, Wetness, Fractional Cover for {polyName}')
+            self.title.set_text("\n".join(title))
+            title_lines = len(title)
+        if title_lines in self._layouts:
+            self.figure.subplots_adjust(**self._layouts[title_lines])
+        else:
+            self.figure.tight_layout()
+            params = self.figure.subplotpars
+            self._layouts[title_lines] = dict(left=params.left, right=params.right,
+                    bottom=params.bottom, top=params.top)
+
+        # savefig would draw the figure twice, once for the layout engine
+        bytes_image = io.BytesIO()
+        self.figure.canvas.print_png(bytes_image, pil_kwargs=self._pil_kwargs)
+        bytes_image.seek(0)
+        return bytes_image
+
+_RENDERERS = {}
+
+def plot_to_png(count, polyName, with_title=True):
+    """
+    Plot wit data to png with the WitPlotRenderer of this process
+    input:
+    count: wit data as returned by query_wit_data
+    polyName: name of the polygon in the title
+    with_title: add title, legend and caption
+    output:
+    io.BytesIO of the png
+    """
+    renderer = _RENDERERS.get(with_title)
+    if renderer is None:
+        renderer = _RENDERERS[with_title] = WitPlotRenderer(with_title)
+    return renderer.render(count, polyName)
@@ -0,0 +1,63 @@
+import numpy as np
+import shapely
+
+def _split(bounds, axis):
+    """
+    Split bounding boxes in two along axis, at the widest gap between them or
+    at the median if they all overlap along it
+    output:
+    (indices of the lower half, indices of the upper half) into bounds
+    """
+    order = np.argsort(bounds[:, axis], kind='stable')
+    lower = bounds[order, axis]
+    upper = np.maximum.accumulate(bounds[order, axis + 2])
+    gaps = lower[1:] - upper[:-1]
+    cut = int(np.argmax(gaps)) + 1
+    if gaps[cut - 1] <= 0:
+        cut = len(order) // 2
+    return order[:cut], order[cut:]
+
+def cluster_bounds(bounds, max_size=50000, min_fill=0.05):
+    """
+    Group bounding boxes into compact clusters by splitting them recursively
+    along the longer side of their extent, at the widest gap between them.
+    A cluster is split until its extent is within max_size on both sides and
+    its boxes cover at least min_fill of it, or it holds a single box.
+    input:
+    bounds: np.array of (minx, miny, maxx, maxy) per polygon
+    max_size: largest width and height of a cluster, in the units of the crs,
+        e.g. 50000m is 2000x2000 pixels of 25m
+    min_fill: smallest share of the extent of a cluster covered by the boxes
+    output:
+    list of (indices into bounds, (minx, miny, maxx, maxy) of the cluster)
+    """
+    bounds = np.asarray(bounds, dtype='float64').reshape(-1, 4)
+    areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+    clusters = []
+    pending = [np.arange(len(bounds))] if len(bounds) > 0 else []
+    while pending:
+        members = pending.pop()
+        member_bounds = bounds[members]
+        extent = np.concatenate([member_bounds[:, :2].min(axis=0), member_bounds[:, 2:].max(axis=0)])
+        width, height = extent[2] - extent[0], extent[3] - extent[1]
+        fill = areas[members].sum() / max(width * height, 1e-12)
+        if len(members) == 1 or (width <= max_size and height <= max_size and fill >= min_fill):
+            clusters.append((members, tuple(extent.tolist())))
+            continue
+        first, second = _split(member_bounds, 0 if width >= height else 1)
+        pending.extend([members[second], members[first]])
+    return clusters
+
+def plan_queries(polygons, max_size=50000, min_fill=0.05):
+    """
+    Plan the datacube queries of polygons as a few compact footprints instead
+    of the bounding box of all of them, see cluster_bounds
+    input:
+    polygons: shapely polygons, see wit_tooling.spatial_index.to_polygons; None for no geometry
+    output:
+    list of (indices into polygons, shapely box of the footprint), polygons without geometry are left out
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    present = np.flatnonzero(~shapely.is_missing(polygons))
+    clusters = cluster_bounds(shapely.bounds(polygons[present]), max_size, min_fill)
+    return [(present[members], shapely.box(*extent)) for members, extent in clusters]
@@ -0,0 +1,134 @@
+import os
+
+import numpy as np
+import shapely
+
+from .poly_tools import convert_shapes_to_polygons
+
+LANDSAT_SHAPEFILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'auxfiles', 'landsat_au.zip')
+
+def to_polygons(geometries):
+    """
+    Convert the geometries of shapes in bulk, see convert_shapes_to_polygons,
+    keeping the missing ones as None
+    input:
+    geometries: iterable of geometries of shapes or shapely geometries, or None
+    output:
+    np.array of shapely Polygon, MultiPolygon or None
+    """
+    geometries = list(geometries)
+    polygons = np.full(len(geometries), None, dtype=object)
+    present = np.array([g is not None for g in geometries], dtype=bool)
+    if present.any():
+        polygons[present] = convert_shapes_to_polygons([g for g in geometries if g is not None])
+    return polygons
+
+class PathRowIndex(object):
+    """
+    STRtree of the footprints of the Landsat path/rows in EPSG:3577, to sort
+    polygons into the path/rows containing or intersecting them in bulk
+    instead of a query of landsat_path per polygon.
+
+    Usage Example:
+      index = PathRowIndex.from_database()
+      for contain, intersect in index.classify(to_polygons(shape['geometry'] for shape in shapes)):
+          ...
+    """
+
+    def __init__(self, labels, footprints):
+        """
+        input:
+        labels: the label of each footprint, e.g. its pathrow_id
+        footprints: shapely geometries of the footprints in EPSG:3577
+        """
+        self.labels = list(labels)
+        self.footprints = np.asarray(footprints, dtype=object)
+        shapely.prepare(self.footprints)
+        self._tree = shapely.STRtree(self.footprints)
+
+    @classmethod
+    def from_database(cls, dio=None):
+        """
+        Load the footprints of the landsat_path table, labelled by pathrow_id
+        as DIO.get_intersect_landsat_pathrow returns them
+        """
+        if dio is None:
+            from .database.io import DIO
+            dio = DIO.get()
+        rows = dio.get_landsat_pathrows()
+        return cls([row[0] for row in rows], shapely.from_wkb([bytes(row[2]) for row in rows]))
+
+    @classmethod
+    def from_shapefile(cls, shapefile=LANDSAT_SHAPEFILE, label='PR'):
+        """
+        Load the footprints from a shapefile, by default auxfiles/landsat_au.zip,
+        reprojected to EPSG:3577 with pyproj
+        input:
+        shapefile: path of the shapefile, or of a zip holding it
+        label: property labelling the footprints
+        """
+        import fiona
+        from pyproj import Transformer
+
+        if shapefile.endswith('.zip'):
+            shapefile = 'zip://' + shapefile
+        with fiona.open(shapefile) as allshapes:
+            crs_wkt = allshapes.crs_wkt
+            shapes = list(allshapes)
+        footprints = convert_shapes_to_polygons([shape['geometry'] for shape in shapes])
+        transformer = Transformer.from_crs(crs_wkt, 'EPSG:3577', always_xy=True)
+        footprints = shapely.transform(footprints, lambda coords: np.column_stack(
+            transformer.transform(coords[:, 0], coords[:, 1])))
+        return cls([shape['properties'][label] for shape in shapes], footprints)
+
+    def classify(self, polygons, contain_ratio=0.9):
+        """
+        Sort polygons into the path/rows containing or intersecting them, like
+        intersect_with_landsat of the wit examples, in one pass
+        input:
+        polygons: shapely polygons in EPSG:3577, see to_polygons; None for no geometry
+        contain_ratio: share of the area of a polygon in a path/row for it to be contained
+        output:
+        list of (contain, intersect) in the order of polygons, each a list of
+        labels in the order of the footprints
+        """
+        polygons = np.asarray(polygons, dtype=object)
+        poly_index, footprint_index = self._tree.query(polygons, predicate='intersects')
+        order = np.lexsort((footprint_index, poly_index))
+        poly_index, footprint_index = poly_index[order], footprint_index[order]
+
+        # a polygon covered by the footprint is all in it, the intersection
+        #  is only computed for the others
+        ratio = np.ones(len(poly_index))
+        covered = shapely.covers(self.footprints[footprint_index], polygons[poly_index])
+        partial = np.flatnonzero(~covered)
+        ratio[partial] = shapely.area(shapely.intersection(polygons[poly_index[partial]],
+            self.footprints[footprint_index[partial]])) / shapely.area(polygons[poly_index[partial]])
+
+        result = [([], []) for _ in range(len(polygons))]
+        for i, j, r in zip(poly_index.tolist(), footprint_index.tolist(), ratio.tolist()):
+            result[i][0 if r >= contain_ratio else 1].append(self.labels[j])
+        return result
+
+def overlap_graph(polygons, ids=None):
+    """
+    Find the polygons intersecting each other with one STRtree query instead
+    of a query of the polygons table per polygon
+    input:
+    polygons: shapely polygons, see to_polygons; None for no geometry
+    ids: the id of each polygon, e.g. poly_id, their positions if None
+    output:
+    dict of id -> list of the ids of the other polygons intersecting it
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    if ids is None:
+        ids = range(len(polygons))
+    ids = list(ids)
+    tree = shapely.STRtree(polygons)
+    left, right = tree.query(polygons, predicate='intersects')
+    graph = {poly_id: [] for poly_id in ids}
+    for i, j in zip(left.tolist(), right.tolist()):
+        if i != j:
+            graph[ids[i]].append(ids[j])
+    return graph